@@ -6,7 +6,7 @@ import os
 import random
 import time
 from queue import Queue
-from threading import Thread
+from threading import Event, Thread
 from typing import List, Tuple, Union
 
 import numpy as np
@@ -16,6 +16,7 @@ from lmdeploy.cli.utils import ArgumentHelper, DefaultsAndTypesHelpFormatter
 from lmdeploy.messages import (GenerationConfig, PytorchEngineConfig,
                                TurbomindEngineConfig)
 from lmdeploy.pytorch.engine import EngineInstance
+from lmdeploy.serve.prefix_planner import plan_prefix_groups
 from lmdeploy.tokenizer import DetokenizeState, Tokenizer
 from lmdeploy.utils import get_logger
 
@@ -93,8 +94,11 @@ class Engine:
         stats = []
         # get each generated token's latency
         per_token_latency_stats = []
-        for prompt, input_seqlen, output_seqlen in iter(
-                req_queue.get, [None, None, None]):
+        for prompt, input_seqlen, output_seqlen, leader, warmed in iter(
+                req_queue.get, [None, None, None, None, None]):
+            if leader is not None:
+                # wait for the prefill of the leader of the prefix group
+                leader.wait()
             _per_token_latency_stats = [0] * (output_seqlen + 1)
             prev = time.perf_counter()
             n_prev_token = 0
@@ -113,6 +117,8 @@ class Engine:
                     sequence_start=True,
                     sequence_end=True,
                     stream_output=stream_output):
+                if warmed is not None:
+                    warmed.set()
                 res, n_token = input_ids + outputs.token_ids, outputs.num_token
                 _, state = self.tokenizer.detokenize_incrementally(res, state)
                 now = time.perf_counter()
@@ -121,6 +127,8 @@ class Engine:
                         now - prev, 3)
                     n_prev_token = n_token
                 prev = now
+            if warmed is not None:
+                warmed.set()
             # for pytorch engine to restart a session
             if isinstance(model_inst, EngineInstance):
                 model_inst.end(session_id)
@@ -141,19 +149,47 @@ class Engine:
             self.pbar.update(1)
         res_queue.put((session_id, stats, per_token_latency_stats))
 
-    def process_request(self, requests, concurrency, temperature, top_p, top_k,
-                        stream_output):
+    def _plan_requests(self, requests, block_size: int):
+        """order the requests by their shared prefixes.
+
+        The leaders of all the groups are fed first, so they are not blocked
+        by the followers waiting for the prefill of their own leaders to
+        reuse its prefix cache.
+        """
+        input_ids = self.tokenizer([prompt
+                                    for prompt, _, _ in requests]).input_ids
+        groups = plan_prefix_groups(input_ids, block_size)
+        leaders, followers = [], []
+        for group in groups:
+            warmed = Event() if len(group) > 1 else None
+            leaders.append((*requests[group[0]], None, warmed))
+            followers += [(*requests[i], warmed, None) for i in group[1:]]
+        return leaders + followers
+
+    def process_request(self,
+                        requests,
+                        concurrency,
+                        temperature,
+                        top_p,
+                        top_k,
+                        stream_output,
+                        prefix_aware=False,
+                        block_size=64):
         res_queue = Queue()
         req_queue = Queue()
         threads = []
 
         self.pbar = tqdm(total=len(requests))
 
+        if prefix_aware:
+            requests = self._plan_requests(requests, block_size)
+        else:
+            requests = [(*req, None, None) for req in requests]
         # feed request to q
         for req in requests:
             req_queue.put(req)
         for i in range(concurrency):
-            req_queue.put([None, None, None])
+            req_queue.put([None, None, None, None, None])
 
         start = time.time()
 
@@ -273,6 +309,11 @@ def parse_args():
                         type=int,
                         default=0,
                         help='Seed used in sampling prompts from dataset')
+    parser.add_argument('--prefix-aware',
+                        action='store_true',
+                        help='Group the prompts by their shared prefixes and '
+                        'feed the groups back to back to reuse the prefix '
+                        'cache')
     # other args
     ArgumentHelper.top_p(parser)
     ArgumentHelper.temperature(parser)
@@ -340,7 +381,9 @@ def main():
                            top_p=args.top_p,
                            top_k=args.top_k,
                            concurrency=args.concurrency,
-                           stream_output=True)
+                           stream_output=True,
+                           prefix_aware=args.prefix_aware,
+                           block_size=args.cache_block_seq_len)
 
 
 if __name__ == '__main__':
@@ -145,6 +145,89 @@ class CLI(object):
                             'support file format in `json`, `yml`,'
                             ' `pkl`')
 
+    @staticmethod
+    def add_parser_batch():
+        """Add parser for batch command."""
+        parser = CLI.subparsers.add_parser(
+            'batch',
+            formatter_class=DefaultsAndTypesHelpFormatter,
+            description=CLI.batch.__doc__,
+            help=CLI.batch.__doc__)
+        parser.set_defaults(run=CLI.batch)
+        parser.add_argument(
+            'model_path',
+            type=str,
+            help='The path of a model. it could be one of the following '
+            'options: - i) a local directory path of a turbomind model'
+            ' which is converted by `lmdeploy convert` command or '
+            'download from ii) and iii). - ii) the model_id of a '
+            'lmdeploy-quantized model hosted inside a model repo on '
+            'huggingface.co, such as "internlm/internlm-chat-20b-4bit",'
+            ' "lmdeploy/llama2-chat-70b-4bit", etc. - iii) the model_id'
+            ' of a model hosted inside a model repo on huggingface.co,'
+            ' such as "internlm/internlm-chat-7b", "qwen/qwen-7b-chat "'
+            ', "baichuan-inc/baichuan2-7b-chat" and so on')
+        parser.add_argument('-i',
+                            '--input',
+                            type=str,
+                            required=True,
+                            help='The JSONL file of the requests in the '
+                            'format of the OpenAI batch api')
+        parser.add_argument('-o',
+                            '--output',
+                            type=str,
+                            required=True,
+                            help='The JSONL file of the results. A job run '
+                            'again with the same output resumes from where '
+                            'it stopped')
+        parser.add_argument('--error-output',
+                            type=str,
+                            default=None,
+                            help='The JSONL file of the failed requests. '
+                            'They are written to the output if not set')
+        parser.add_argument('--max-concurrency',
+                            type=int,
+                            default=64,
+                            help='Max number of the requests in flight')
+        parser.add_argument('--window-size',
+                            type=int,
+                            default=4096,
+                            help='Number of the requests read and sorted '
+                            'together to reuse the prefix cache')
+        # common args
+        ArgumentHelper.backend(parser)
+        ArgumentHelper.log_level(parser)
+        ArgumentHelper.model_name(parser)
+        # chat template args
+        ArgumentHelper.chat_template(parser)
+        # model args
+        ArgumentHelper.revision(parser)
+        ArgumentHelper.download_dir(parser)
+
+        # pytorch engine args
+        pt_group = parser.add_argument_group('PyTorch engine arguments')
+        ArgumentHelper.adapters(pt_group)
+        ArgumentHelper.device(pt_group)
+        # common engine args
+        tp_act = ArgumentHelper.tp(pt_group)
+        session_len_act = ArgumentHelper.session_len(pt_group)
+        max_batch_size_act = ArgumentHelper.max_batch_size(pt_group)
+        cache_max_entry_act = ArgumentHelper.cache_max_entry_count(pt_group)
+        cache_block_seq_len_act = ArgumentHelper.cache_block_seq_len(pt_group)
+        prefix_caching_act = ArgumentHelper.enable_prefix_caching(pt_group)
+        # turbomind args
+        tb_group = parser.add_argument_group('TurboMind engine arguments')
+        # common engine args
+        tb_group._group_actions.append(tp_act)
+        tb_group._group_actions.append(session_len_act)
+        tb_group._group_actions.append(max_batch_size_act)
+        tb_group._group_actions.append(cache_max_entry_act)
+        tb_group._group_actions.append(cache_block_seq_len_act)
+        tb_group._group_actions.append(prefix_caching_act)
+        ArgumentHelper.model_format(tb_group)
+        ArgumentHelper.quant_policy(tb_group)
+        ArgumentHelper.rope_scaling_factor(tb_group)
+
     @staticmethod
     def convert(args):
         """Convert LLMs to turbomind format."""
@@ -263,6 +346,59 @@ class CLI(object):
             kwargs['chat_template_config'] = chat_template_config
             run_chat(**kwargs)
 
+    @staticmethod
+    def batch(args):
+        """Run the requests of a JSONL file in the format of the OpenAI batch
+        api offline."""
+        from lmdeploy.archs import autoget_backend
+        from lmdeploy.serve.openai.api_server import run_batch
+        from lmdeploy.utils import get_max_batch_size
+
+        max_batch_size = args.max_batch_size if args.max_batch_size \
+            else get_max_batch_size(args.device)
+        backend = args.backend
+        if backend != 'pytorch':
+            # set auto backend mode
+            backend = autoget_backend(args.model_path)
+
+        if backend == 'pytorch':
+            from lmdeploy.messages import PytorchEngineConfig
+            backend_config = PytorchEngineConfig(
+                tp=args.tp,
+                max_batch_size=max_batch_size,
+                cache_max_entry_count=args.cache_max_entry_count,
+                block_size=args.cache_block_seq_len,
+                session_len=args.session_len,
+                adapters=get_lora_adapters(args.adapters),
+                enable_prefix_caching=args.enable_prefix_caching,
+                device_type=args.device)
+        else:
+            from lmdeploy.messages import TurbomindEngineConfig
+            backend_config = TurbomindEngineConfig(
+                tp=args.tp,
+                max_batch_size=max_batch_size,
+                session_len=args.session_len,
+                model_format=args.model_format,
+                quant_policy=args.quant_policy,
+                rope_scaling_factor=args.rope_scaling_factor,
+                cache_max_entry_count=args.cache_max_entry_count,
+                cache_block_seq_len=args.cache_block_seq_len,
+                enable_prefix_caching=args.enable_prefix_caching)
+        counts = run_batch(args.model_path,
+                           args.input,
+                           args.output,
+                           error_path=args.error_output,
+                           model_name=args.model_name,
+                           backend=backend,
+                           backend_config=backend_config,
+                           chat_template_config=get_chat_template(
+                               args.chat_template),
+                           max_concurrency=args.max_concurrency,
+                           window_size=args.window_size,
+                           log_level=args.log_level.upper())
+        print(f'total: {counts.total}, completed: {counts.completed}, '
+              f'failed: {counts.failed}')
+
     @staticmethod
     def add_parsers():
         """Add all parsers."""
@@ -270,3 +406,4 @@ class CLI(object):
         CLI.add_parser_list()
         CLI.add_parser_checkenv()
         CLI.add_parser_chat()
+        CLI.add_parser_batch()
@@ -130,6 +130,17 @@ class SubCliServe:
                             type=str,
                             default=['*'],
                             help='A list of allowed http headers for cors')
+        parser.add_argument('--batch-dir',
+                            type=str,
+                            default=None,
+                            help='The directory to save the files and the '
+                            'batches of the batch api. The batch api is '
+                            'disabled if it is not set')
+        parser.add_argument('--batch-max-concurrency',
+                            type=int,
+                            default=64,
+                            help='Max number of the requests in flight of a '
+                            'batch')
         # common args
         ArgumentHelper.backend(parser)
         ArgumentHelper.log_level(parser)
@@ -149,6 +160,18 @@ class SubCliServe:
 
         ArgumentHelper.adapters(pt_group)
         ArgumentHelper.device(pt_group)
+        ArgumentHelper.enable_chunked_prefill(pt_group)
+        ArgumentHelper.scheduling_policy(pt_group)
+        ArgumentHelper.eviction_type(pt_group)
+        ArgumentHelper.prefix_cache_snapshot(pt_group)
+        ArgumentHelper.enable_host_prefix_cache(pt_group)
+        ArgumentHelper.enable_overlap(pt_group)
+        ArgumentHelper.enable_engine_process(pt_group)
+        ArgumentHelper.guided_decoding_cache_dir(pt_group)
+        ArgumentHelper.guided_decoding_schemas(pt_group)
+        ArgumentHelper.speculative_method(pt_group)
+        ArgumentHelper.num_speculative_tokens(pt_group)
+        ArgumentHelper.speculative_draft_model(pt_group)
         # common engine args
         tp_act = ArgumentHelper.tp(pt_group)
         session_len_act = ArgumentHelper.session_len(pt_group)
@@ -177,6 +200,8 @@ class SubCliServe:
         # vlm args
         vision_group = parser.add_argument_group('Vision model arguments')
         ArgumentHelper.vision_max_batch_size(vision_group)
+        ArgumentHelper.vision_feature_cache_size(vision_group)
+        ArgumentHelper.vision_feature_cache_dir(vision_group)
 
     @staticmethod
     def add_parser_api_client():
@@ -265,6 +290,18 @@ class SubCliServe:
                 session_len=args.session_len,
                 adapters=adapters,
                 enable_prefix_caching=args.enable_prefix_caching,
+                enable_chunked_prefill=args.enable_chunked_prefill,
+                scheduling_policy=args.scheduling_policy,
+                eviction_type=args.eviction_type,
+                prefix_cache_snapshot=args.prefix_cache_snapshot,
+                enable_host_prefix_cache=args.enable_host_prefix_cache,
+                enable_overlap=args.enable_overlap,
+                enable_engine_process=args.enable_engine_process,
+                guided_decoding_cache_dir=args.guided_decoding_cache_dir,
+                guided_decoding_schemas=args.guided_decoding_schemas,
+                speculative_method=args.speculative_method,
+                num_speculative_tokens=args.num_speculative_tokens,
+                speculative_draft_model=args.speculative_draft_model,
                 device_type=args.device,
                 max_prefill_token_num=args.max_prefill_token_num)
         else:
@@ -283,7 +320,10 @@ class SubCliServe:
         chat_template_config = get_chat_template(args.chat_template)
 
         from lmdeploy.messages import VisionConfig
-        vision_config = VisionConfig(args.vision_max_batch_size)
+        vision_config = VisionConfig(
+            args.vision_max_batch_size,
+            feature_cache_size=args.vision_feature_cache_size,
+            feature_cache_dir=args.vision_feature_cache_dir)
         run_api_server(args.model_path,
                        model_name=args.model_name,
                        backend=backend,
@@ -298,7 +338,9 @@ class SubCliServe:
                        allow_headers=args.allow_headers,
                        log_level=args.log_level.upper(),
                        api_keys=args.api_keys,
-                       ssl=args.ssl)
+                       ssl=args.ssl,
+                       batch_dir=args.batch_dir,
+                       batch_max_concurrency=args.batch_max_concurrency)
 
     @staticmethod
     def api_client(args):
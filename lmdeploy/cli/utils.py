@@ -435,6 +435,142 @@ class ArgumentHelper:
                                    default=False,
                                    help='Enable cache and match prefix')
 
+    @staticmethod
+    def enable_chunked_prefill(parser):
+        """Add argument enable_chunked_prefill to parser."""
+
+        return parser.add_argument(
+            '--enable-chunked-prefill',
+            action='store_true',
+            default=False,
+            help='Split long prompts into chunks of max_prefill_token_num '
+            'and batch them with decoding requests')
+
+    @staticmethod
+    def scheduling_policy(parser):
+        """Add argument scheduling_policy to parser."""
+
+        return parser.add_argument(
+            '--scheduling-policy',
+            type=str,
+            default='fcfs',
+            choices=['fcfs', 'spf', 'edf'],
+            help='The policy to schedule and preempt requests. fcfs: first '
+            'come first serve, spf: shortest prompt first, edf: earliest '
+            'deadline first')
+
+    @staticmethod
+    def eviction_type(parser):
+        """Add argument eviction_type to parser."""
+
+        return parser.add_argument(
+            '--eviction-type',
+            type=str,
+            default='recompute',
+            choices=['recompute', 'swap'],
+            help='What to do with the kv cache of preempted requests. '
+            'recompute: drop it and prefill again, swap: move long ones to '
+            'the host memory')
+
+    @staticmethod
+    def prefix_cache_snapshot(parser):
+        """Add argument prefix_cache_snapshot to parser."""
+
+        return parser.add_argument(
+            '--prefix-cache-snapshot',
+            type=str,
+            default=None,
+            help='Directory to save the prefix cache at exit and to load it '
+            'on start. Only works with --enable-prefix-caching')
+
+    @staticmethod
+    def enable_host_prefix_cache(parser):
+        """Add argument enable_host_prefix_cache to parser."""
+
+        return parser.add_argument(
+            '--enable-host-prefix-cache',
+            action='store_true',
+            default=False,
+            help='Demote evicted prefix caches to host memory instead of '
+            'dropping them. Only works with --enable-prefix-caching')
+
+    @staticmethod
+    def enable_overlap(parser):
+        """Add argument enable_overlap to parser."""
+
+        return parser.add_argument(
+            '--enable-overlap',
+            action='store_true',
+            default=False,
+            help='Launch the next decoding step before the outputs of the '
+            'current step are fetched to hide the host overhead')
+
+    @staticmethod
+    def enable_engine_process(parser):
+        """Add argument enable_engine_process to parser."""
+
+        return parser.add_argument(
+            '--enable-engine-process',
+            action='store_true',
+            default=False,
+            help='Run the engine loop in its own process, so that the '
+            'scheduling does not compete with the server for the GIL')
+
+    @staticmethod
+    def guided_decoding_cache_dir(parser):
+        """Add argument guided_decoding_cache_dir to parser."""
+
+        return parser.add_argument(
+            '--guided-decoding-cache-dir',
+            type=str,
+            default=None,
+            help='Directory to cache the compiled guided decoding FSMs, '
+            'which could be shared by multiple servers. The cached files '
+            'are unpickled, only use a directory writable by trusted users')
+
+    @staticmethod
+    def guided_decoding_schemas(parser):
+        """Add argument guided_decoding_schemas to parser."""
+
+        return parser.add_argument(
+            '--guided-decoding-schemas',
+            type=str,
+            default=None,
+            help='Path to a json file of a list of response_format to be '
+            'compiled in background on start')
+
+    @staticmethod
+    def speculative_method(parser):
+        """Add argument speculative_method to parser."""
+
+        return parser.add_argument(
+            '--speculative-method',
+            type=str,
+            default=None,
+            choices=['ngram', 'draft_model'],
+            help='Method to propose draft tokens of speculative decoding. '
+            'Disabled if not set')
+
+    @staticmethod
+    def num_speculative_tokens(parser):
+        """Add argument num_speculative_tokens to parser."""
+
+        return parser.add_argument(
+            '--num-speculative-tokens',
+            type=int,
+            default=4,
+            help='Max draft tokens per step of speculative decoding')
+
+    @staticmethod
+    def speculative_draft_model(parser):
+        """Add argument speculative_draft_model to parser."""
+
+        return parser.add_argument(
+            '--speculative-draft-model',
+            type=str,
+            default=None,
+            help='Path of the draft model of speculative decoding')
+
     @staticmethod
     def num_tokens_per_iter(parser):
         return parser.add_argument(
@@ -465,3 +601,21 @@ class ArgumentHelper:
                                    type=int,
                                    default=1,
                                    help='the vision model batch size')
+
+    @staticmethod
+    def vision_feature_cache_size(parser):
+        return parser.add_argument(
+            '--vision-feature-cache-size',
+            type=int,
+            default=1024,
+            help='the max memory in MB of the cached vision features. 0 '
+            'means the memory tier is disabled')
+
+    @staticmethod
+    def vision_feature_cache_dir(parser):
+        return parser.add_argument(
+            '--vision-feature-cache-dir',
+            type=str,
+            default=None,
+            help='the directory of the disk tier of the vision feature cache.'
+            ' Default to None, which means the disk tier is disabled')
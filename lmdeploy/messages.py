@@ -20,7 +20,8 @@ class GenerationConfig:
 
     Args:
         n (int): Define how many chat completion choices to generate for each
-            input message. **Only 1** is supported now.
+            input message. Only the pytorch engine supports n > 1, the
+            choices share the prefill of the input.
         max_new_tokens (int): The maximum number of tokens that can be
             generated in the chat completion
         do_sample (bool):  Whether or not to use sampling, use greedy
@@ -57,6 +58,11 @@ class GenerationConfig:
             response. Examples: `{"type": "json_schema", "json_schema": {"name":"test","schema": {"properties": {"name": {"type": "string"}}, "required": ["name"], "type": "object"}}}`
             or `{"type": "regex_schema", "regex_schema": "call me [A-Za-z]{1,10}"}`
         logits_processors (List[Callable]): Custom logit processors.
+        priority (int): Scheduling priority of the request, request with
+            smaller value would be scheduled first. Only pytorch backend
+            support it. Default to 0.
+        deadline (float): Expected seconds since arrival to start generating,
+            used by the `edf` scheduling policy of pytorch backend.
     """  # noqa
 
     n: int = 1
@@ -78,6 +84,8 @@ class GenerationConfig:
     logprobs: int = None
     response_format: Optional[Dict] = None
     logits_processors: Optional[List[LogitsProcessor]] = None
+    priority: int = 0
+    deadline: Optional[float] = None
 
     def convert_stop_bad_words_to_ids(self, tokenizer: Tokenizer):
         """convert stop_words/bad_sords to ids and append the ids to
@@ -192,6 +200,43 @@ class PytorchEngineConfig:
         max_prefill_token_num (int): tokens per iteration.
         thread_safe (bool): thread safe engine instance.
         enable_prefix_caching (bool): Enable token match and sharing caches.
+        enable_host_prefix_cache (bool): Demote evicted prefix caches to
+            host memory instead of dropping them, requires
+            `enable_prefix_caching`.
+        enable_chunked_prefill (bool): Split long prompts into chunks of
+            `max_prefill_token_num` tokens and run them in the same forward
+            pass with the decoding sequences.
+        scheduling_policy (str): The order to schedule and preempt
+            requests, options ['fcfs', 'spf', 'edf'], which are first come
+            first serve, shortest prompt first and earliest deadline first.
+        eviction_type (str): What to do with the caches of preempted
+            requests, options ['recompute', 'swap']. `swap` moves caches of
+            long requests to host memory instead of recomputing them.
+        enable_overlap (bool): Launch the next decoding step on the device
+            before the outputs of the current step are fetched, which hides
+            the host overhead behind the device execution.
+        enable_engine_process (bool): Run the engine loop in its own
+            process, so the scheduling does not share the GIL with the
+            server. Requests and responses are batched over a unix socket.
+        prefix_cache_snapshot (str): Directory to save the prefix cache at
+            exit and to load it on start, so the engine would not lose the
+            prefix cache on restart. Requires `enable_prefix_caching` and
+            tp=1.
+        guided_decoding_cache_dir (str): Directory to cache the compiled
+            guided decoding FSMs, shared by the engines using the same
+            directory. Cached on the memory only if not set. The cached
+            files are unpickled, so the directory must be trusted.
+        guided_decoding_schemas (str): Path to a json file of a list of
+            `response_format` to be compiled in background on start.
+        speculative_method (str): Method to propose draft tokens of
+            speculative decoding, options ['ngram', 'draft_model']. `ngram`
+            looks up the continuation of the last tokens in the prompt and
+            the outputs, `draft_model` decodes with a small model sharing
+            the vocabulary. Disabled if not set.
+        num_speculative_tokens (int): Max draft tokens per step, should be
+            less than `prefill_interval`.
+        speculative_draft_model (str): Path of the draft model, required by
+            `draft_model`.
         device_type (str): The inference device type, options ['cuda']
         download_dir (str): Directory to download and load the weights,
             default to the default cache directory of huggingface.
@@ -211,6 +256,18 @@ class PytorchEngineConfig:
     max_prefill_token_num: int = 4096
     thread_safe: bool = False
     enable_prefix_caching: bool = False
+    enable_host_prefix_cache: bool = False
+    enable_chunked_prefill: bool = False
+    scheduling_policy: str = 'fcfs'
+    eviction_type: str = 'recompute'
+    prefix_cache_snapshot: str = None
+    enable_overlap: bool = False
+    enable_engine_process: bool = False
+    guided_decoding_cache_dir: str = None
+    guided_decoding_schemas: str = None
+    speculative_method: str = None
+    num_speculative_tokens: int = 4
+    speculative_draft_model: str = None
     device_type: str = 'cuda'
     eager_mode: bool = False
     custom_module_map: str = None
@@ -227,6 +284,17 @@ class PytorchEngineConfig:
         assert self.device_type in [
             'cuda', 'ascend'
         ], (f'invalid device_type: {self.device_type}')
+        assert self.scheduling_policy in [
+            'fcfs', 'spf', 'edf'
+        ], (f'invalid scheduling_policy: {self.scheduling_policy}')
+        assert self.eviction_type in [
+            'recompute', 'swap'
+        ], (f'invalid eviction_type: {self.eviction_type}')
+        assert self.speculative_method in [
+            None, 'ngram', 'draft_model'
+        ], (f'invalid speculative_method: {self.speculative_method}')
+        assert self.num_speculative_tokens >= 0, (
+            'invalid num_speculative_tokens')
 
 
 class ResponseType(enum.Enum):
@@ -239,6 +307,7 @@ class ResponseType(enum.Enum):
     SESSION_NOT_EXIST = enum.auto()
     HANDLER_NOT_EXIST = enum.auto()
     INPUT_LENGTH_ERROR = enum.auto()
+    INTERNAL_ENGINE_ERROR = enum.auto()
 
 
 @dataclass
@@ -284,11 +353,13 @@ class EngineOutput:
             may not equal to the length of token_ids
         logprobs (List[Dict[int, float]]): the top logprobs for each output
             position.
+        index (int): the index of the output in the `n` parallel samples.
     """
     status: ResponseType
     token_ids: List[int]
     num_token: int
     logprobs: List[Dict[int, float]] = None
+    index: int = 0
 
 
 @dataclass
@@ -302,6 +373,33 @@ class VisionConfig:
         thread_safe (bool): Specifies whether the engine instance is
             thread-safe. Please set it to True when using the pipeline
             in a multi-threaded environment.
+        feature_cache_size (int): the max memory in MB of the cached vision
+            features. The features are keyed by the content of the images,
+            so the repeated images skip the vision model. 0 means the
+            memory tier is disabled.
+        feature_cache_dir (str): the directory of the disk tier of the
+            feature cache. None means the disk tier is disabled.
+        feature_cache_disk_size (int): the max disk space in MB of the disk
+            tier of the feature cache.
+        draft_decode (bool): whether to decode the images at a reduced scale
+            for the vision models resizing images to a fixed size. It only
+            works for the formats supporting draft mode, such as JPEG. The
+            scaled decoding is not bit exact with a full decoding, so the
+            image features, and the outputs, may slightly change.
+        max_wait_time (float): the max seconds that an image waits for more
+            images to fill its batch.
+        max_inflight_batches (int): the max number of batches run by the
+            vision model at the same time. More than one batch lets the
+            preprocessing of a batch overlap the forward of another one, at
+            the cost of more gpu memory. The batches are run by concurrent
+            threads, so only set it larger than 1 if the `forward` of the
+            vision model is thread-safe.
     """
     max_batch_size: int = 1
     thread_safe: bool = False
+    feature_cache_size: int = 1024
+    feature_cache_dir: Optional[str] = None
+    feature_cache_disk_size: int = 10240
+    draft_decode: bool = False
+    max_wait_time: float = 0.005
+    max_inflight_batches: int = 1
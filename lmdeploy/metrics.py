@@ -0,0 +1,193 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Metrics in the prometheus text exposition format."""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import List, Sequence
+
+# buckets of the latencies in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25,
+                   0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, 20.0, 40.0, 80.0)
+# buckets of the batch sizes
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+def _format_value(value: float):
+    """format the value of a sample."""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    """Base of the metrics.
+
+    Args:
+        name (str): the name of the metric.
+        documentation (str): the help text of the metric.
+    """
+    type_name = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+
+    def _samples(self):
+        """samples of the metric."""
+        raise NotImplementedError('Not implemented.')
+
+    def render(self):
+        """render the metric in the text format."""
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}'
+        ]
+        for name, value in self._samples():
+            lines.append(f'{name} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Monotonic counter."""
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, value: float = 0):
+        super().__init__(name, documentation)
+        self.value = value
+
+    def inc(self, value: float = 1):
+        """increase the counter."""
+        self.value += value
+
+    def _samples(self):
+        """samples of the metric."""
+        return [(self.name, self.value)]
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+    type_name = 'gauge'
+
+    def __init__(self, name: str, documentation: str, value: float = 0):
+        super().__init__(name, documentation)
+        self.value = value
+
+    def set(self, value: float):
+        """set the gauge."""
+        self.value = value
+
+    def _samples(self):
+        """samples of the metric."""
+        return [(self.name, self.value)]
+
+
+class Histogram(_Metric):
+    """Histogram of the observed values.
+
+    Args:
+        name (str): the name of the metric.
+        documentation (str): the help text of the metric.
+        buckets (Sequence[float]): sorted upper bounds of the buckets.
+    """
+    type_name = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+        # the last one counts the values greater than all the bounds
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """observe a value."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    @contextmanager
+    def time(self):
+        """observe the time of the block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _samples(self):
+        """samples of the metric."""
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            samples.append(
+                (f'{self.name}_bucket{{le="{_format_value(bound)}"}}', total))
+        samples.append((f'{self.name}_bucket{{le="+Inf"}}', self.count))
+        samples.append((f'{self.name}_sum', self.sum))
+        samples.append((f'{self.name}_count', self.count))
+        return samples
+
+
+def render_metrics(metrics: List[_Metric]):
+    """render the metrics in the prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+class ServeMetrics:
+    """Latency breakdown of the requests measured by the server."""
+
+    def __init__(self):
+        self.detokenize_time = Histogram(
+            'lmdeploy_detokenize_time_seconds',
+            'Time to detokenize the outputs of a request.')
+        self.time_to_first_token = Histogram(
+            'lmdeploy_time_to_first_token_seconds',
+            'Time from the arrival of requests to their first tokens.')
+        self.time_per_output_token = Histogram(
+            'lmdeploy_time_per_output_token_seconds',
+            'Average time between the output tokens after the first one.')
+        self.e2e_latency = Histogram('lmdeploy_e2e_request_latency_seconds',
+                                     'End to end latency of the requests.')
+        self.num_prompt_tokens = Counter('lmdeploy_prompt_tokens_total',
+                                         'Number of the prompt tokens.')
+        self.num_generation_tokens = Counter(
+            'lmdeploy_generation_tokens_total',
+            'Number of the generated tokens.')
+        self.num_requests = Counter('lmdeploy_requests_total',
+                                    'Number of the finished requests.')
+
+    def on_finish(self, start: float, first_token: float,
+                  num_prompt_tokens: int, num_generation_tokens: List[int]):
+        """record a finished request.
+
+        Args:
+            start (float): perf_counter at the arrival of the request.
+            first_token (float): perf_counter at the first token, None if no
+                token is generated.
+            num_prompt_tokens (int): number of the prompt tokens.
+            num_generation_tokens (List[int]): number of the generated tokens
+                of each sample.
+        """
+        end = time.perf_counter()
+        self.e2e_latency.observe(end - start)
+        num_steps = max(num_generation_tokens)
+        if first_token is not None and num_steps > 1:
+            self.time_per_output_token.observe(
+                (end - first_token) / (num_steps - 1))
+        self.num_prompt_tokens.inc(num_prompt_tokens)
+        self.num_generation_tokens.inc(sum(num_generation_tokens))
+        self.num_requests.inc()
+
+    def collect(self):
+        """the metrics."""
+        return [
+            self.detokenize_time, self.time_to_first_token,
+            self.time_per_output_token, self.e2e_latency,
+            self.num_prompt_tokens, self.num_generation_tokens,
+            self.num_requests
+        ]
@@ -51,8 +51,22 @@ class SchedulerConfig:
     max_session_len: int
     max_request_output_len: int = 512
     eviction_type: str = 'recompute'
+    min_swap_tokens: int = 256
     prefill_interval: int = 16
     max_active_adapters: int = 64
+    enable_chunked_prefill: bool = False
+    scheduling_policy: str = 'fcfs'
+
+
+@dataclass
+class SpeculativeConfig:
+    """Config of speculative decoding."""
+
+    method: str = None
+    num_speculative_tokens: int = 4
+    draft_model: str = None
+    max_ngram_size: int = 3
+    min_ngram_size: int = 1
 
 
 @dataclass
@@ -67,6 +81,7 @@ class CacheConfig:
     cache_max_entry_count: float = 0.8
     max_prefill_token_num: int = 4096
     enable_prefix_caching: bool = False
+    enable_host_prefix_cache: bool = False
 
     def __post_init__(self):
         """post init."""
@@ -1,5 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 from .engine import Engine
 from .engine_instance import EngineInstance
+from .mp_engine import MPEngine
 
-__all__ = ['Engine', 'EngineInstance']
+__all__ = ['Engine', 'EngineInstance', 'MPEngine']
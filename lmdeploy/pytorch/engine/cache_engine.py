@@ -223,6 +223,14 @@ class CacheEngine:
         """
         self._swap(self.local_gpu_cache, self.local_cpu_cache, src_to_dst)
 
+    def copy(self, src_to_dst: Dict[int, int]) -> None:
+        """Copy cache blocks on Device.
+
+        Args:
+            src_to_dst (Dict[int, int]): Map between src and dst.
+        """
+        self._swap(self.local_gpu_cache, self.local_gpu_cache, src_to_dst)
+
     @classmethod
     def get_cache_block_size(cls,
                              block_size: int,
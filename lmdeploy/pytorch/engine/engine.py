@@ -1,7 +1,12 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import asyncio
+import atexit
 import copy
+import json
 import os
+import random
+import threading
+import time
 from dataclasses import dataclass
 from typing import Any, Dict, List
 
@@ -15,15 +20,23 @@ from lmdeploy.utils import (get_logger, get_max_batch_size, get_model,
 
 from ..adapter.adapter import AdapterManager, SchedulerAdapter
 from ..check_env import check_adapters, check_env, check_model
-from ..config import BackendConfig, CacheConfig, SchedulerConfig
+from ..config import (BackendConfig, CacheConfig, SchedulerConfig,
+                      SpeculativeConfig)
 from ..devices import DeviceContext, get_device_manager
 from ..messages import (InputEmbeddingRangeType, InputEmbeddingType,
                         MessageStatus, SchedulerSequence)
 from ..model_inputs import AdapterInfo, ModelInputs, VisionModelInputs
 from ..paging import Scheduler
-from .logits_process import FusedLogitsProcessor, SamplingInputs
+from .engine_metrics import EngineMetrics
+from .logits_process import (FusedLogitsProcessor, SamplingInputs,
+                             get_guided_states, precompile_guided_processors,
+                             update_guided_states)
 from .model_agent import AutoModelAgent, build_model_agent
+from .prefix_cache_snapshot import load_prefix_cache, save_prefix_cache
 from .request import Request, RequestManager, RequestType, Response
+from .spec_decoding import (SpecDecoder, SpecStepOutput, accept_draft_tokens,
+                            expand_sampling_inputs, get_verify_indices,
+                            make_verify_inputs)
 
 logger = get_logger('lmdeploy')
 
@@ -59,6 +72,7 @@ class InferOutput:
     meta: Any = None
     finish: bool = False
     logits: torch.Tensor = None
+    index: int = 0
 
 
 def _paging_adapters(adapters: dict, model_agent: AutoModelAgent,
@@ -139,7 +153,10 @@ class Engine:
         scheduler_config = SchedulerConfig(
             max_batches=engine_config.max_batch_size,
             max_session_len=engine_config.session_len,
-            prefill_interval=engine_config.prefill_interval)
+            prefill_interval=engine_config.prefill_interval,
+            enable_chunked_prefill=engine_config.enable_chunked_prefill,
+            scheduling_policy=engine_config.scheduling_policy,
+            eviction_type=engine_config.eviction_type)
 
         # block_size = 1 to enable unified paging
         adapters = engine_config.adapters
@@ -151,6 +168,7 @@ class Engine:
             cache_max_entry_count=engine_config.cache_max_entry_count,
             max_prefill_token_num=engine_config.max_prefill_token_num,
             enable_prefix_caching=engine_config.enable_prefix_caching,
+            enable_host_prefix_cache=engine_config.enable_host_prefix_cache,
         )
 
         if not os.path.exists(model_path):
@@ -177,6 +195,7 @@ class Engine:
         self.adapter_manager = self._build_adapter_manager(adapters)
         self.scheduler = Scheduler(scheduler_config, cache_config,
                                    self.adapter_manager)
+        self.metrics = EngineMetrics(self.scheduler)
 
         if adapters:
             _paging_adapters(adapters,
@@ -187,6 +206,11 @@ class Engine:
         self.cache_config = cache_config
         self.backend_config = backend_config
         self.stream = torch.cuda.Stream()
+        self.spec_decoder = self._build_spec_decoder(trust_remote_code)
+
+        self._prefix_cache_snapshot = self._get_prefix_cache_snapshot()
+        self._load_prefix_cache()
+        self._precompile_guided_decoding()
 
         self.req_manager = self._bind_request_manager()
 
@@ -237,6 +261,95 @@ class Engine:
         # buffers to create inputs
         self._seq_length_buf = torch.ones(max_batches, dtype=torch.long)
 
+    def _precompile_guided_decoding(self):
+        """compile the guided decoding schemas in background."""
+        path = self.engine_config.guided_decoding_schemas
+        if path is None:
+            return
+        with open(path, 'r') as f:
+            response_formats = json.load(f)
+        if isinstance(response_formats, Dict):
+            response_formats = [response_formats]
+        tokenizer = self.tokenizer.model.model
+        cache_dir = self.engine_config.guided_decoding_cache_dir
+        thread = threading.Thread(target=precompile_guided_processors,
+                                  args=(response_formats, tokenizer,
+                                        cache_dir),
+                                  daemon=True)
+        thread.start()
+
+    def _build_spec_decoder(self, trust_remote_code: bool):
+        """build speculative decoder."""
+        engine_config = self.engine_config
+        if engine_config.speculative_method is None:
+            return None
+        if self.cache_config.window_size > 0:
+            logger.warning('Speculative decoding is disabled for models with '
+                           'sliding window attention.')
+            return None
+        # verified tokens should fit in the preallocated blocks.
+        max_num_spec_tokens = self.scheduler_config.prefill_interval - 1
+        num_spec_tokens = engine_config.num_speculative_tokens
+        if num_spec_tokens > max_num_spec_tokens:
+            logger.warning(f'num_speculative_tokens={num_spec_tokens} is '
+                           f'clamped to {max_num_spec_tokens}.')
+            num_spec_tokens = max_num_spec_tokens
+        if num_spec_tokens <= 0:
+            return None
+        spec_config = SpeculativeConfig(
+            method=engine_config.speculative_method,
+            num_speculative_tokens=num_spec_tokens,
+            draft_model=engine_config.speculative_draft_model)
+        return SpecDecoder.build(
+            spec_config,
+            max_num_tokens=self.cache_config.max_prefill_token_num,
+            trust_remote_code=trust_remote_code)
+
+    def _get_prefix_cache_snapshot(self):
+        """get path of prefix cache snapshot."""
+        path = self.engine_config.prefix_cache_snapshot
+        if path is None:
+            return None
+        if not self.cache_config.enable_prefix_caching:
+            logger.warning('`prefix_cache_snapshot` is ignored since prefix '
+                           'caching is not enabled.')
+            return None
+        if self.tp > 1:
+            logger.warning('`prefix_cache_snapshot` does not support tp>1.')
+            return None
+        return path
+
+    def _load_prefix_cache(self):
+        """load prefix cache snapshot and save it at exit."""
+        path = self._prefix_cache_snapshot
+        if path is None:
+            return
+        try:
+            load_prefix_cache(path,
+                              self.scheduler,
+                              self.model_agent.cache_engine,
+                              model_path=self.model_path,
+                              adapters=self.engine_config.adapters)
+        except Exception as e:
+            logger.warning(f'Failed to load prefix cache from {path}: {e}')
+        atexit.register(self.close)
+
+    def close(self):
+        """close engine, the prefix cache would be saved if
+        `prefix_cache_snapshot` is set."""
+        path = self._prefix_cache_snapshot
+        if path is None:
+            return
+        self._prefix_cache_snapshot = None
+        try:
+            save_prefix_cache(path,
+                              self.scheduler,
+                              self.model_agent.cache_engine,
+                              model_path=self.model_path,
+                              adapters=self.engine_config.adapters)
+        except Exception as e:
+            logger.warning(f'Failed to save prefix cache to {path}: {e}')
+
     def _build_adapter_manager(self, adapters):
         if adapters is not None and len(adapters) > 0:
             linear_infos = self.model_agent.get_lora_target_info()
@@ -252,6 +365,7 @@ class Engine:
         req_manager.bind_func(RequestType.STOP_SESSION, self._on_stop_session)
         req_manager.bind_func(RequestType.END_SESSION, self._on_end_session)
         req_manager.bind_func(RequestType.ADD_MESSAGE, self._on_add_message)
+        req_manager.bind_func(RequestType.GET_METRICS, self._on_get_metrics)
         return req_manager
 
     def _start_loop(self):
@@ -308,6 +422,15 @@ class Engine:
             if resp:
                 self._response(resp_type, req.sender_id, req.req_id)
 
+    def _on_get_metrics(self, reqs: Request, **kwargs):
+        """on get metrics callback."""
+        metrics = self.metrics.collect()
+        for req in reqs:
+            self._response(ResponseType.SUCCESS,
+                           req.sender_id,
+                           req.req_id,
+                           data=metrics)
+
     def _on_add_message(self, reqs: Request, **kwargs):
         """on add message callback."""
 
@@ -357,11 +480,18 @@ class Engine:
                 __update_max_new_tokens(msg)
                 self.scheduler.add_sequence(msg)
             else:
-                msg = next(iter(sess.sequences.values()))
+                seqs = list(sess.sequences.values())
+                msg = seqs[0]
+                for fork in seqs[1:]:
+                    # parallel samples of the previous request.
+                    self.scheduler.remove_sequence(fork)
                 msg.update_token_ids(req.data['token_ids'],
                                      req.data.get('input_embeddings'))
                 msg.num_new_tokens = 0
+                msg.request_time = time.time()
                 msg.sampling_param = req.data['sampling_param']
+                # the state is built from the format of the new request.
+                msg.guided_state = None
                 msg.return_logits = req.data.get('return_logits', False)
                 msg.status = MessageStatus.WAITING
                 __update_bad_words(msg)
@@ -380,18 +510,29 @@ class Engine:
         return self.tp
 
     @logging_timer('CreateModelInputs', logger)
-    def create_model_inputs(self, messages: SeqList, adapters: AdapterList,
-                            is_prefill: bool):
+    def create_model_inputs(self,
+                            messages: SeqList,
+                            adapters: AdapterList,
+                            is_prefill: bool,
+                            chunk_sizes: Dict[int, int] = None):
         """create model inputs from messages.
 
         Args:
             messages (SeqList): The input messages.
             adapters (AdapterList): Adapters.
+            chunk_sizes (Dict[int, int]): Number of tokens to be prefilled
+                of the partially scheduled messages.
         """
         history_lengths = [msg.history_len for msg in messages]
         history_lengths = torch.tensor(history_lengths)
 
         token_ids = [msg.token_ids for msg in messages]
+        if chunk_sizes:
+            token_ids = [
+                tokens[:chunk_sizes[msg.seq_id]]
+                if msg.seq_id in chunk_sizes else tokens
+                for tokens, msg in zip(token_ids, messages)
+            ]
 
         if isinstance(token_ids[0], int):
             token_ids = [token_ids]
@@ -511,8 +652,7 @@ class Engine:
 
     @logging_timer('SamplingLogits', logger)
     def async_sampling_logits(self, logits: torch.Tensor,
-                              all_ids: torch.Tensor,
-                              guided_input_ids: torch.Tensor,
+                              all_ids: torch.Tensor, guided_states: List,
                               sampling_inputs: SamplingInputs,
                               inputs: ModelInputs, ignore_eos: torch.Tensor):
         """sampling logits."""
@@ -527,22 +667,47 @@ class Engine:
             return logits[last_idx, :]
 
         split_logits = __get_last_logits().cuda()
-        logits_processor = FusedLogitsProcessor(sampling_inputs, ignore_eos,
-                                                self.tokenizer.model.model)
-        logits = logits_processor(all_ids, guided_input_ids, split_logits)
+        logits_processor = FusedLogitsProcessor(sampling_inputs, ignore_eos)
+        logits = logits_processor(all_ids, guided_states, split_logits)
         next_token_ids = logits_processor.sampling(logits)
 
         return next_token_ids
 
+    def _fork_sequence(self, msg: SchedulerSequence):
+        """fork the parallel samples of a prefilled sequence."""
+        param = msg.sampling_param
+        seed = param.random_seed
+        if seed is None:
+            # samples in the same batch should not share the random numbers.
+            seed = random.getrandbits(32)
+        for index in range(1, param.n):
+            fork_param = copy.copy(param)
+            fork_param.n = 1
+            fork_param.random_seed = seed + index
+            self.scheduler.fork_sequence(msg, index, fork_param)
+        msg.sampling_param = copy.copy(param)
+        msg.sampling_param.n = 1
+
     @logging_timer('UpdateRunning', logger)
-    def update_running(self, running: SeqList, next_token_ids: torch.Tensor,
-                       stopped: torch.Tensor):
+    def update_running(self,
+                       running: SeqList,
+                       next_token_ids: torch.Tensor,
+                       stopped: torch.Tensor,
+                       chunk_sizes: Dict[int, int] = None):
         """update scheduler."""
         next_token_ids = next_token_ids.numpy()
         eos_token_id = self.model_config.eos_token_id
+        chunk_sizes = chunk_sizes or dict()
         for token, msg, stop in zip(next_token_ids, running, stopped):
             if msg.status != MessageStatus.RUNNING:
                 continue
+            if msg.seq_id in chunk_sizes:
+                # partially prefilled, wait for next chunk.
+                msg.set_step(msg.history_len + chunk_sizes[msg.seq_id])
+                msg.status = MessageStatus.WAITING
+                continue
+            if msg.num_new_tokens == 0 and msg.sampling_param.n > 1:
+                self._fork_sequence(msg)
             update_token = token
             stop = stop or token in eos_token_id
             if stop:
@@ -554,9 +719,12 @@ class Engine:
                 msg.status = MessageStatus.STOPPED
 
     @logging_timer('ModelForward', logger)
-    async def _async_model_forward(self, inputs: ModelInputs,
-                                   swap_in_map: Dict, swap_out_map: Dict,
-                                   return_logits: bool):
+    async def _async_model_forward(self,
+                                   inputs: ModelInputs,
+                                   swap_in_map: Dict,
+                                   swap_out_map: Dict,
+                                   return_logits: bool,
+                                   copy_map: Dict = None):
         """model forward."""
         max_prefill_token_num = self.cache_config.max_prefill_token_num
         swap_done = False
@@ -606,7 +774,10 @@ class Engine:
             else:
                 swap_done = True
                 return await self.model_agent.async_forward(
-                    inputs, swap_in_map=swap_in_map, swap_out_map=swap_out_map)
+                    inputs,
+                    swap_in_map=swap_in_map,
+                    swap_out_map=swap_out_map,
+                    copy_map=copy_map)
 
         async def __long_context_single_forward(inputs):
             """one large sequence."""
@@ -658,9 +829,13 @@ class Engine:
                 return seq_length.cumsum(0) - seq_length
 
         running = self._running
-        is_run = [seq.status == MessageStatus.RUNNING for seq in running]
+        chunk_sizes = self._chunk_sizes
+        is_run = [
+            seq.status == MessageStatus.RUNNING
+            and seq.seq_id not in chunk_sizes for seq in running
+        ]
         stopped = stopped.tolist()
-        self.update_running(running, next_token_ids, stopped)
+        self.update_running(running, next_token_ids, stopped, chunk_sizes)
 
         # generate output
         next_token_ids = next_token_ids.tolist()
@@ -674,26 +849,146 @@ class Engine:
             finish = msg.status == MessageStatus.STOPPED
             if not finish and len(token_ids) == 0:
                 continue
-            session_id = msg.session_id
             out = InferOutput(
-                session_id=session_id,
+                session_id=msg.session_id,
                 sender_id=msg.sender_id,
                 req_id=msg.req_id,
                 finish=finish,
                 token_ids=token_ids,
+                index=msg.index,
             )
-            outputs[session_id] = out
+            outputs[msg.seq_id] = out
 
             if msg.return_logits:
                 inputs = self._inputs
                 start = q_start_loc[idx]
                 seqlen = inputs.seq_length[idx]
-                outputs[session_id].logits = logits[start:start + seqlen]
+                out.logits = logits[start:start + seqlen]
+        return outputs
+
+    def _make_spec_infer_outputs(self, spec_output: SpecStepOutput):
+        """make infer output of a verification step."""
+        running = self._running
+        eos_token_id = self.model_config.eos_token_id
+        outputs: Dict[int, InferOutput] = dict()
+        for msg, draft, token_ids in zip(running, spec_output.draft_token_ids,
+                                         spec_output.token_ids):
+            if msg.status != MessageStatus.RUNNING:
+                continue
+            # each verified position has drawn a random number.
+            msg.random_offsets += len(draft)
+            stop_words = msg.sampling_param.stop_words
+            num_appendable = (msg.sampling_param.max_new_tokens -
+                              msg.num_new_tokens)
+            stop = self._is_stop_pending(msg)
+            appended = []
+            out_token_ids = []
+            if not stop:
+                token_ids = token_ids.tolist()
+                last_idx = len(token_ids) - 1
+                for idx, token in enumerate(token_ids):
+                    if token in eos_token_id:
+                        if token not in stop_words:
+                            out_token_ids.append(token)
+                        stop = True
+                        break
+                    appended.append(token)
+                    num_appendable -= 1
+                    if token not in stop_words:
+                        out_token_ids.append(token)
+                    if token in stop_words or num_appendable <= 0:
+                        # draft tokens have been cached by the verification,
+                        # the last token needs one more step.
+                        stop = idx < last_idx
+                        break
+
+            if len(appended) > 0:
+                msg.num_new_tokens += len(appended)
+                msg.update_token_ids(np.array(appended, dtype=np.int64))
+            if stop:
+                msg.update_token_ids(_EMPTY_TOKEN)
+                msg.status = MessageStatus.STOPPED
+            else:
+                # the last token has not been cached, caches of the rejected
+                # tokens would be overwritten.
+                msg.set_step(msg.num_all_ids - 1)
+
+            finish = msg.status == MessageStatus.STOPPED
+            if not finish and len(out_token_ids) == 0:
+                continue
+            outputs[msg.seq_id] = InferOutput(
+                session_id=msg.session_id,
+                sender_id=msg.sender_id,
+                req_id=msg.req_id,
+                finish=finish,
+                token_ids=out_token_ids,
+                index=msg.index,
+            )
         return outputs
 
+    @staticmethod
+    def _is_stop_pending(msg: SchedulerSequence):
+        """the sequence has generated its last token in previous step."""
+        param = msg.sampling_param
+        if param.max_new_tokens - msg.num_new_tokens <= 0:
+            return True
+        return (msg.num_new_tokens > 0 and msg.all_ids[-1] in param.stop_words)
+
+    def _get_num_draft_tokens(self, running: SeqList,
+                              num_ignore_eos: torch.Tensor):
+        """max draft tokens of the sequences."""
+        num_draft_tokens = []
+        for msg, ignore_eos in zip(running, num_ignore_eos.tolist()):
+            num_appendable = (msg.sampling_param.max_new_tokens -
+                              msg.num_new_tokens)
+            if ignore_eos > 0 or self._is_stop_pending(msg):
+                num_draft_tokens.append(0)
+            else:
+                num_draft_tokens.append(num_appendable - 1)
+        return num_draft_tokens
+
+    async def _async_spec_step_background(
+            self, running: SeqList, inputs: ModelInputs, swap_in_map: Dict,
+            swap_out_map: Dict, copy_map: Dict,
+            sampling_inputs: SamplingInputs, num_ignore_eos: torch.LongTensor,
+            output_que: asyncio.Queue):
+        """propose draft tokens and verify them in one forward."""
+        spec_decoder = self.spec_decoder
+        num_draft_tokens = self._get_num_draft_tokens(running, num_ignore_eos)
+        draft_token_ids = spec_decoder.propose(running, num_draft_tokens)
+        inputs = make_verify_inputs(running, inputs, draft_token_ids)
+        num_rows = torch.tensor([len(draft) + 1 for draft in draft_token_ids])
+
+        logger.debug('<SpecForwardTask>: '
+                     f'batch_size={inputs.seq_length.size(0)} '
+                     f'num_tokens={inputs.input_ids.size(-1)}')
+        output = await self._async_model_forward(inputs,
+                                                 swap_in_map=swap_in_map,
+                                                 swap_out_map=swap_out_map,
+                                                 return_logits=True,
+                                                 copy_map=copy_map)
+        logits = output['logits'][0]
+        indices = get_verify_indices(inputs, num_rows)
+        logits = logits[indices.to(logits.device)].cuda()
+
+        # sample all positions, draft tokens are accepted while they match
+        # the sampled tokens.
+        sampling_inputs = expand_sampling_inputs(sampling_inputs, num_rows)
+        sampling_inputs = sampling_inputs.to_device('cuda')
+        ignore_eos = (num_ignore_eos > 0).repeat_interleave(num_rows).cuda()
+        logits_processor = FusedLogitsProcessor(sampling_inputs, ignore_eos)
+        logits = logits_processor(None, None, logits)
+        next_token_ids = logits_processor.sampling(logits).cpu().numpy()
+
+        token_ids = accept_draft_tokens(draft_token_ids, next_token_ids)
+        spec_output = SpecStepOutput(draft_token_ids=draft_token_ids,
+                                     token_ids=token_ids)
+        spec_decoder.update_metrics(spec_output)
+        output_que.put_nowait((True, spec_output))
+
     async def _async_step_background(
             self, inputs: ModelInputs, swap_in_map: Dict, swap_out_map: Dict,
-            all_ids: torch.Tensor, guided_input_ids: torch.Tensor,
+            copy_map: Dict, all_ids: torch.Tensor, guided_states: List,
             sampling_inputs: SamplingInputs,
             num_appendable_ids: torch.LongTensor,
             num_ignore_eos: torch.LongTensor, loop_count: int,
@@ -702,16 +997,11 @@ class Engine:
 
         def __update_inputs(next_token_ids):
             """update inputs."""
-            nonlocal all_ids, guided_input_ids
+            nonlocal all_ids
             inputs.update(next_token_ids)
             if all_ids is not None:
                 all_ids = torch.cat(
                     [all_ids, next_token_ids[:, None].to(all_ids.device)], 1)
-            if guided_input_ids is not None:
-                guided_input_ids = torch.cat([
-                    guided_input_ids, next_token_ids[:, None].to(
-                        guided_input_ids.device)
-                ], 1)
             if sampling_inputs.random_offsets is not None:
                 sampling_inputs.random_offsets += 1
 
@@ -721,25 +1011,38 @@ class Engine:
         is_decoding = inputs.is_decoding
         if all_ids is not None:
             all_ids = all_ids.cuda()
-        if guided_input_ids is not None:
-            guided_input_ids = guided_input_ids.cuda()
         sampling_inputs = sampling_inputs.to_device('cuda')
         num_appendable_ids = num_appendable_ids.cuda()
         num_ignore_eos = num_ignore_eos.cuda()
 
-        for idx in range(loop_count):
-            # inference
-            output = await self._async_model_forward(
+        # launch the forward of the next step before waiting for the outputs
+        # of current step, so the device would not wait for the host.
+        overlap = (self.engine_config.enable_overlap and is_decoding
+                   and not return_logits and loop_count > 1)
+        if overlap:
+            next_output = self.model_agent.launch_forward(
                 inputs,
                 swap_in_map=swap_in_map,
                 swap_out_map=swap_out_map,
-                return_logits=return_logits)
+                copy_map=copy_map)
+
+        for idx in range(loop_count):
+            # inference
+            if overlap:
+                output = next_output
+            else:
+                output = await self._async_model_forward(
+                    inputs,
+                    swap_in_map=swap_in_map,
+                    swap_out_map=swap_out_map,
+                    return_logits=return_logits,
+                    copy_map=copy_map)
             logits = output['logits']
             logits = logits[0]  # [bs, seq, prob] -> [seq, prob]
 
             # sampling
             next_token_ids = self.async_sampling_logits(
-                logits, all_ids, guided_input_ids, sampling_inputs, inputs,
+                logits, all_ids, guided_states, sampling_inputs, inputs,
                 num_ignore_eos > 0)
             num_ignore_eos = num_ignore_eos - 1
 
@@ -748,19 +1051,41 @@ class Engine:
                 next_token_ids, sampling_inputs.stop_words, num_appendable_ids)
 
             # send output
-            stopped = stopped.cpu()
+            if overlap:
+                next_token_ids_cpu = next_token_ids.to('cpu',
+                                                       non_blocking=True)
+                stopped = stopped.to('cpu', non_blocking=True)
+                out_event = torch.cuda.Event()
+                out_event.record()
+                launched = idx < loop_count - 1
+                if launched:
+                    __update_inputs(next_token_ids)
+                    next_output = self.model_agent.launch_forward(
+                        inputs, swap_in_map=dict(), swap_out_map=dict())
+                await asyncio.get_event_loop().run_in_executor(
+                    None, out_event.synchronize)
+            else:
+                next_token_ids_cpu = next_token_ids.cpu()
+                stopped = stopped.cpu()
+            update_guided_states(guided_states, next_token_ids_cpu)
             finish = stopped.all().item() or (idx == loop_count - 1)
             finish = finish or _check_finish(self.scheduler, idx)
-            output = (next_token_ids.cpu(), logits, stopped)
+            output = (next_token_ids_cpu, logits, stopped)
             output_que.put_nowait((finish, output))
 
             if finish:
+                if overlap and launched:
+                    # blocks of the stopped sequences might be reused.
+                    sync_stream = torch.cuda.current_stream().synchronize
+                    await asyncio.get_event_loop().run_in_executor(
+                        None, sync_stream)
                 break
 
             # update for next loop
-            if is_decoding:
+            if is_decoding and not overlap:
                 swap_in_map = dict()
                 swap_out_map = dict()
+                copy_map = dict()
                 __update_inputs(next_token_ids)
 
     @torch.inference_mode()
@@ -786,23 +1111,14 @@ class Engine:
                 output[idx, -h_len:] = h_ids
             return output
 
-        def __gather_guided_input_ids(seqs: SeqList,
-                                      sampling_inputs: SamplingInputs):
-            """gather input ids for guided decode."""
+        def __get_guided_states(seqs: SeqList,
+                                sampling_inputs: SamplingInputs):
+            """get FSM states for guided decode."""
             if not any(sampling_inputs.response_formats or ()):
                 return None
-            batch = len(seqs)
-            max_len = max(seq.num_new_tokens for seq in seqs)
-            pad_id = self.model_config.bos_token_id
-            pad_id = 0 if pad_id is None else pad_id
-            output = torch.full((batch, max_len), pad_id, dtype=torch.int64)
-            for idx, seq in enumerate(seqs):
-                h_len = seq.num_new_tokens
-                if h_len == 0:
-                    continue
-                h_ids = torch.from_numpy(seq.all_ids[-seq.num_new_tokens:])
-                output[idx, -h_len:] = h_ids
-            return output
+            return get_guided_states(
+                seqs, self.tokenizer.model.model,
+                self.engine_config.guided_decoding_cache_dir)
 
         def __get_num_appendable_ids(seqs: SeqList):
             """get num appendable ids."""
@@ -832,30 +1148,49 @@ class Engine:
                     is_prefill=is_prefill, prealloc_size=prefill_interval)
                 running: SeqList = schedule_output.running
                 adapters = schedule_output.adapters
+                chunk_sizes = schedule_output.chunk_sizes
                 loop_count = 1 if is_prefill else (prefill_interval - 1)
                 if len(running) == 0:
                     raise NoRunningSeqs()
+                self.metrics.on_schedule(running, is_prefill)
 
                 # create inputs
                 inputs = self.create_model_inputs(running, adapters,
-                                                  is_prefill)
+                                                  is_prefill, chunk_sizes)
                 sampling_inputs = SamplingInputs.from_sampling_params(running)
                 all_ids = __gather_all_ids(running, sampling_inputs)
-                guided_input_ids = __gather_guided_input_ids(
-                    running, sampling_inputs)
+                guided_states = __get_guided_states(running, sampling_inputs)
                 num_appendable_ids = __get_num_appendable_ids(running)
                 num_ignore_eos = __get_num_ignore_eos(running)
                 return_logits = __need_logits(running)
 
                 self._running = running
                 self._inputs = inputs
+                self._chunk_sizes = chunk_sizes
+
+                if (self.spec_decoder is not None
+                        and self.spec_decoder.is_supported(
+                            inputs, sampling_inputs, guided_states,
+                            return_logits)):
+                    await self._async_spec_step_background(
+                        running=running,
+                        inputs=inputs,
+                        swap_in_map=schedule_output.swap_in_map,
+                        swap_out_map=schedule_output.swap_out_map,
+                        copy_map=schedule_output.copy_map,
+                        sampling_inputs=sampling_inputs,
+                        num_ignore_eos=num_ignore_eos,
+                        output_que=out_que,
+                    )
+                    continue
 
                 await self._async_step_background(
                     inputs=inputs,
                     swap_in_map=schedule_output.swap_in_map,
                     swap_out_map=schedule_output.swap_out_map,
+                    copy_map=schedule_output.copy_map,
                     all_ids=all_ids,
-                    guided_input_ids=guided_input_ids,
+                    guided_states=guided_states,
                     sampling_inputs=sampling_inputs,
                     num_appendable_ids=num_appendable_ids,
                     num_ignore_eos=num_ignore_eos,
@@ -889,13 +1224,20 @@ class Engine:
                            sender_id=out.sender_id,
                            req_id=out.req_id,
                            data=dict(token_ids=out.token_ids,
-                                     logits=out.logits))
+                                     logits=out.logits,
+                                     index=out.index))
 
         def __send_resps(step_outputs: Dict[int, InferOutput]):
             """send response callback."""
             for out in step_outputs.values():
                 __send_resp(out)
 
+        def __remove_finished_forks():
+            """forks are not kept for the next request of the session."""
+            for seq in self.scheduler.hanging:
+                if seq.index > 0:
+                    self.scheduler.remove_sequence(seq)
+
         async def __step(prefill: bool):
             """step decoding."""
             in_que.put_nowait(prefill)
@@ -907,10 +1249,14 @@ class Engine:
                 try:
                     if isinstance(out, Exception):
                         raise out
-                    next_token_ids, logits, stopped = out
-                    step_outputs = self._make_infer_outputs(
-                        next_token_ids, logits, stopped)
+                    if isinstance(out, SpecStepOutput):
+                        step_outputs = self._make_spec_infer_outputs(out)
+                    else:
+                        next_token_ids, logits, stopped = out
+                        step_outputs = self._make_infer_outputs(
+                            next_token_ids, logits, stopped)
                     __send_resps(step_outputs)
+                    __remove_finished_forks()
                 except NoRunningSeqs:
                     break
                 except Exception as e:
@@ -923,7 +1269,7 @@ class Engine:
                 self.req_manager.step()
 
             if not self.scheduler.has_unfinished():
-                await asyncio.sleep(0.01)
+                await self.req_manager.wait_requests()
                 continue
 
             # prefill
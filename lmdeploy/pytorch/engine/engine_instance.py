@@ -54,6 +54,15 @@ async def async_cancel(req_sender: RequestSender, session_id: int):
                                f'Error: {resp.type}.'))
 
 
+async def async_get_metrics(req_sender: RequestSender):
+    """Get the metrics of the engine."""
+    resp = await req_sender.async_send(RequestType.GET_METRICS, None)
+    if not _check_resp_success(resp,
+                               f'Failed to get metrics. Error: {resp.type}.'):
+        return []
+    return resp.data
+
+
 def try_add_session(req_sender: RequestSender, session_id: int):
     """Add new session.
 
@@ -170,19 +179,26 @@ class EngineInstance:
         req_id = await self.req_sender.async_send_async(
             RequestType.ADD_MESSAGE, msg)
 
-        token_ids = []
+        # outputs of the parallel samples are interleaved.
+        all_token_ids = [[] for _ in range(sampling_param.n)]
+        num_unfinished = sampling_param.n
         while True:
             resp = await self.req_sender.async_recv(req_id)
 
             if resp.req_id != req_id:
                 continue
-            if resp.type == ResponseType.SUCCESS:
+            if resp.type in (ResponseType.SUCCESS, ResponseType.FINISH):
+                index = resp.data.get('index', 0)
+                token_ids = all_token_ids[index]
                 token_ids += resp.data['token_ids']
-                yield EngineOutput(resp.type, token_ids, len(token_ids))
-            elif resp.type == ResponseType.FINISH:
-                token_ids += resp.data['token_ids']
-                yield EngineOutput(resp.type, token_ids, len(token_ids))
-                break
+                yield EngineOutput(resp.type,
+                                   token_ids,
+                                   len(token_ids),
+                                   index=index)
+                if resp.type == ResponseType.FINISH:
+                    num_unfinished -= 1
+                    if num_unfinished == 0:
+                        break
             else:
                 yield EngineOutput(resp.type, [], 0)
                 break
@@ -288,19 +304,26 @@ class EngineInstance:
         )
         req_id = self.req_sender.send_async(RequestType.ADD_MESSAGE, msg)
 
-        token_ids = []
+        # outputs of the parallel samples are interleaved.
+        all_token_ids = [[] for _ in range(sampling_param.n)]
+        num_unfinished = sampling_param.n
         while True:
             resp = self.req_sender.recv(req_id)
 
             if resp.req_id != req_id:
                 continue
-            if resp.type == ResponseType.SUCCESS:
-                token_ids += resp.data['token_ids']
-                yield EngineOutput(resp.type, token_ids, len(token_ids))
-            elif resp.type == ResponseType.FINISH:
+            if resp.type in (ResponseType.SUCCESS, ResponseType.FINISH):
+                index = resp.data.get('index', 0)
+                token_ids = all_token_ids[index]
                 token_ids += resp.data['token_ids']
-                yield EngineOutput(resp.type, token_ids, len(token_ids))
-                break
+                yield EngineOutput(resp.type,
+                                   token_ids,
+                                   len(token_ids),
+                                   index=index)
+                if resp.type == ResponseType.FINISH:
+                    num_unfinished -= 1
+                    if num_unfinished == 0:
+                        break
             else:
                 yield EngineOutput(resp.type, [], 0)
                 break
@@ -476,6 +499,10 @@ class EngineInstance:
         """Stop current streaming inference."""
         return cancel(self.req_sender, session_id)
 
+    async def async_get_metrics(self):
+        """Get the metrics of the engine."""
+        return await async_get_metrics(self.req_sender)
+
     def decode(self,
                input_ids,
                input_embeddings: List[InputEmbeddingType] = None,
@@ -0,0 +1,75 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import copy
+import time
+from typing import List
+
+from lmdeploy.metrics import BATCH_SIZE_BUCKETS, Counter, Gauge, Histogram
+
+from ..messages import SchedulerSequence
+from ..paging import Scheduler
+
+SeqList = List[SchedulerSequence]
+
+
+class EngineMetrics:
+    """Metrics of the engine loop.
+
+    Only the host side states of the scheduler are read, recording the
+    metrics never syncs the device.
+
+    Args:
+        scheduler (Scheduler): the scheduler of the engine.
+    """
+
+    def __init__(self, scheduler: Scheduler):
+        self.scheduler = scheduler
+        self.queue_time = Histogram(
+            'lmdeploy_queue_time_seconds',
+            'Time from the arrival of requests to their first schedule.')
+        self.prefill_batch_size = Histogram(
+            'lmdeploy_prefill_batch_size',
+            'Number of sequences in the prefill steps.', BATCH_SIZE_BUCKETS)
+        self.decode_batch_size = Histogram(
+            'lmdeploy_decode_batch_size',
+            'Number of sequences in the decoding steps.', BATCH_SIZE_BUCKETS)
+
+    def on_schedule(self, running: SeqList, is_prefill: bool):
+        """record the scheduled sequences."""
+        if not is_prefill:
+            self.decode_batch_size.observe(len(running))
+            return
+        self.prefill_batch_size.observe(len(running))
+        now = time.time()
+        for seq in running:
+            # preempted and chunked sequences are scheduled again.
+            if seq.request_time > 0:
+                self.queue_time.observe(now - seq.request_time)
+                seq.request_time = 0.0
+
+    def collect(self):
+        """snapshot of the metrics."""
+        scheduler = self.scheduler
+        block_trie = scheduler.block_trie
+        return copy.deepcopy([
+            self.queue_time, self.prefill_batch_size, self.decode_batch_size
+        ]) + [
+            Gauge('lmdeploy_num_running', 'Number of running sequences.',
+                  len(scheduler.running)),
+            Gauge('lmdeploy_num_waiting', 'Number of waiting sequences.',
+                  len(scheduler.waiting)),
+            Gauge('lmdeploy_kv_cache_usage',
+                  'Ratio of the used gpu blocks of the kv cache.',
+                  scheduler.block_manager.get_gpu_usage()),
+            Counter('lmdeploy_prefix_cache_query_tokens_total',
+                    'Prompt tokens looked up in the prefix cache.',
+                    block_trie.num_query_tokens),
+            Counter('lmdeploy_prefix_cache_hit_tokens_total',
+                    'Prompt tokens found in the prefix cache.',
+                    block_trie.num_hit_tokens),
+            Gauge('lmdeploy_prefix_cache_hit_rate',
+                  'Ratio of the prompt tokens found in the prefix cache.',
+                  block_trie.hit_rate),
+            Counter('lmdeploy_preemptions_total',
+                    'Running sequences preempted for others.',
+                    scheduler.eviction_helper.num_preemptions),
+        ]
@@ -9,45 +9,66 @@
 #     http://www.apache.org/licenses/LICENSE-2.0
 
 import copy
-import math
+import hashlib
+import json
+import os
+import os.path as osp
+import pickle
+import tempfile
+import threading
 # Unless required by applicable law or agreed to in writing, software
 # distributed under the License is distributed on an "AS IS" BASIS,
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from collections import defaultdict
 from functools import lru_cache
-from typing import DefaultDict, Dict, List, Union
+from typing import Dict, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from outlines.fsm.guide import CFGGuide, Generate, RegexGuide, Write
 from outlines.fsm.json_schema import build_regex_from_schema
 from pydantic import BaseModel
 from transformers import PreTrainedTokenizerBase
 
+from lmdeploy.utils import get_logger
+
+logger = get_logger('lmdeploy')
+
+
+def _round_up(x: int, n: int):
+    """round up."""
+    return (x + n - 1) // n * n
+
 
 class BaseLogitsProcessor:
 
-    def init_state(self):
-        """Initialize the FSM states."""
-        self.fsm_state: DefaultDict[int, int] = defaultdict(int)
+    def __init__(self, fsm):
+        self.fsm = fsm
+        self._mask_cache: Dict[Tuple[int, int], torch.Tensor] = dict()
 
-    def __call__(self, input_ids: List[int],
-                 scores: torch.Tensor) -> torch.Tensor:
-        """Use the FSM to bias the logits before sampling the next token."""
+    def __getstate__(self):
+        """masks are not pickled."""
+        state = self.__dict__.copy()
+        state['_mask_cache'] = dict()
+        return state
 
-        seq_id = hash(tuple(input_ids))
+    def get_next_state(self, state: int, token_id: int) -> int:
+        """Get the FSM state after the token is generated."""
+        return self.fsm.get_next_state(state=state, token_id=token_id)
 
-        if len(input_ids) == 0:
-            self.init_state()
-        else:
-            last_token = input_ids[-1]
-            last_seq_id = hash(tuple(input_ids[:-1]))
-            self.fsm_state[seq_id] = self.fsm.get_next_state(
-                state=self.fsm_state[last_seq_id], token_id=last_token)
+    def get_allowed_mask(self, state: int, vocab_size: int) -> torch.Tensor:
+        """Get the allowed tokens of the state as a packed bitmask.
 
-        instruction = self.fsm.get_next_instruction(self.fsm_state[seq_id])
+        Bit `i % 8` of byte `i // 8` is set if token `i` is allowed. Masks are
+        cached per state, so each state is only expanded once.
+        """
+        key = (state, vocab_size)
+        mask = self._mask_cache.get(key)
+        if mask is not None:
+            return mask
 
+        instruction = self.fsm.get_next_instruction(state)
         if type(instruction) == Generate:
             allowed_tokens = instruction.tokens
         elif type(instruction) == Write:
@@ -57,13 +78,18 @@ class BaseLogitsProcessor:
             raise TypeError(
                 f'Unsupported instruction type {type(instruction)}')
 
-        mask = torch.full((scores.shape[-1], ),
-                          -math.inf,
-                          device=scores.device)
-        mask[allowed_tokens] = 0
-        scores.add_(mask)
-
-        return scores
+        allowed = np.zeros(_round_up(vocab_size, 8), dtype=bool)
+        if allowed_tokens is None:
+            allowed[:vocab_size] = True
+        else:
+            if isinstance(allowed_tokens, torch.Tensor):
+                allowed_tokens = allowed_tokens.cpu().numpy()
+            allowed_tokens = np.asarray(allowed_tokens, dtype=np.int64)
+            allowed_tokens = allowed_tokens[allowed_tokens < vocab_size]
+            allowed[allowed_tokens] = True
+        mask = torch.from_numpy(np.packbits(allowed, bitorder='little'))
+        self._mask_cache[key] = mask
+        return mask
 
     def adapt_tokenizer(self, tokenizer):
         """Adapt tokenizer to use to compile the FSM.
@@ -92,7 +118,7 @@ class RegexLogitsProcessor(BaseLogitsProcessor):
         """
         tokenizer = self.adapt_tokenizer(copy.deepcopy(tokenizer))
         fsm = RegexGuide(regex_string, tokenizer)
-        self.fsm = fsm
+        super().__init__(fsm)
 
 
 class JSONLogitsProcessor(RegexLogitsProcessor):
@@ -123,7 +149,7 @@ class CFGLogitsProcessor(BaseLogitsProcessor):
         """
         tokenizer = self.adapt_tokenizer(tokenizer)
         fsm = CFGGuide(cfg, tokenizer)
-        self.fsm = fsm
+        super().__init__(fsm)
 
 
 # copied from https://github.com/vllm-project/vllm/blob/a7f65c2be93f491771aca31106f790bf381c0bad/vllm/model_executor/guided_decoding/outlines_decoding.py#L31  # noqa
@@ -149,22 +175,145 @@ pair   : UNESCAPED_STRING ":" value
 %ignore WS
 """
 
+# bump it if the pickled processors are not compatible.
+_CACHE_VERSION = 1
+_lock_guard = threading.Lock()
+_compile_locks: Dict[str, threading.Lock] = dict()
+
+
+def _get_compile_lock(key: str):
+    """get the lock to compile the processor of the key."""
+    with _lock_guard:
+        lock = _compile_locks.get(key)
+        if lock is None:
+            lock = threading.Lock()
+            _compile_locks[key] = lock
+    return lock
+
+
+@lru_cache(maxsize=4)
+def _get_tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase):
+    """fingerprint of the vocabulary the FSM is compiled with."""
+    import outlines
+    vocab = sorted(tokenizer.get_vocab().items())
+    content = json.dumps(
+        dict(version=_CACHE_VERSION,
+             outlines=getattr(outlines, '__version__', None),
+             tokenizer=type(tokenizer).__name__,
+             eos_token_id=tokenizer.eos_token_id,
+             vocab=vocab))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def _get_cache_path(cache_dir: str, guide: str,
+                    tokenizer: PreTrainedTokenizerBase, type: str):
+    """content addressed path of the compiled processor."""
+    content = json.dumps([type, guide, _get_tokenizer_fingerprint(tokenizer)])
+    key = hashlib.sha256(content.encode()).hexdigest()
+    return osp.join(cache_dir, key[:2], f'{key}.pkl')
+
+
+def _load_processor(path: str):
+    """load compiled processor, return None if not available.
+
+    The processor is unpickled, which could run arbitrary code, so the cache
+    directory must only be writable by trusted users.
+    """
+    if not osp.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception as e:
+        logger.warning(f'Failed to load guided decoding cache {path}: {e}')
+        return None
+
+
+def _save_processor(path: str, processor: BaseLogitsProcessor):
+    """save compiled processor, processes sharing the directory would see
+    either nothing or the complete file."""
+    try:
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=osp.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(processor, f)
+            os.replace(tmp_path, path)
+        finally:
+            if osp.exists(tmp_path):
+                os.remove(tmp_path)
+    except Exception as e:
+        logger.warning(f'Failed to save guided decoding cache {path}: {e}')
+
+
+def _compile_guided_logits_processor(guide: str,
+                                     tokenizer: PreTrainedTokenizerBase,
+                                     type: str):
+    """compile the processor."""
+    if type == 'json_object':
+        return CFGLogitsProcessor(guide, tokenizer)
+    elif type == 'json_schema':
+        return JSONLogitsProcessor(guide, tokenizer)
+    elif type == 'regex_schema':
+        return RegexLogitsProcessor(guide, tokenizer)
+    else:
+        return None
+
 
 @lru_cache(maxsize=32)
 def _get_guided_logits_processor(guide: str,
                                  tokenizer: PreTrainedTokenizerBase,
-                                 type: str):
+                                 type: str,
+                                 cache_dir: Optional[str] = None):
     try:
-        if type == 'json_object':
-            return CFGLogitsProcessor(guide, tokenizer)
-        elif type == 'json_schema':
-            return JSONLogitsProcessor(guide, tokenizer)
-        elif type == 'regex_schema':
-            return RegexLogitsProcessor(guide, tokenizer)
-        else:
-            return None
+        # the parser of cfg guides is not cached on disk.
+        if cache_dir is None or type == 'json_object':
+            return _compile_guided_logits_processor(guide, tokenizer, type)
+        path = _get_cache_path(cache_dir, guide, tokenizer, type)
+        with _get_compile_lock(path):
+            processor = _load_processor(path)
+            if processor is None:
+                processor = _compile_guided_logits_processor(
+                    guide, tokenizer, type)
+                if processor is not None:
+                    _save_processor(path, processor)
+        return processor
     except Exception as e:
-        from lmdeploy.utils import get_logger
-        logger = get_logger('lmdeploy')
         logger.error(e)
         return None
+
+
+class GuidedState:
+    """FSM state of a guided sequence.
+
+    The state is advanced incrementally with the generated tokens instead of
+    being rediscovered from the whole output every step.
+    """
+
+    def __init__(self, processor: BaseLogitsProcessor):
+        self.processor = processor
+        self.fsm_state = 0
+        self.num_tokens = 0
+
+    def reset(self):
+        """reset to the initial state."""
+        self.fsm_state = 0
+        self.num_tokens = 0
+
+    def advance(self, token_id: int):
+        """advance with a generated token."""
+        self.fsm_state = self.processor.get_next_state(self.fsm_state,
+                                                       token_id)
+        self.num_tokens += 1
+
+    def sync(self, token_ids: np.ndarray):
+        """catch up with the generated tokens of the sequence."""
+        if self.num_tokens > len(token_ids):
+            # tokens advanced have been dropped, replay from the start.
+            self.reset()
+        for token_id in token_ids[self.num_tokens:].tolist():
+            self.advance(token_id)
+
+    def get_allowed_mask(self, vocab_size: int):
+        """packed allowed mask of current state."""
+        return self.processor.get_allowed_mask(self.fsm_state, vocab_size)
@@ -1,13 +1,12 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import json
 from dataclasses import asdict, dataclass
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Tuple
 
 import torch
 from transformers.generation.logits_process import LogitsWarper
 
 from lmdeploy.messages import LogitsProcessor
-from lmdeploy.tokenizer import Tokenizer
 
 from ..messages import SchedulerSequence
 
@@ -88,40 +87,127 @@ def _multinomial_sampling(scores: torch.Tensor,
     return multinomial_sampling(scores, seeds, offsets, indices)
 
 
-def _guided_sampling(response_formats: Tuple[Dict], scores: torch.Tensor,
-                     guided_input_ids: Optional[torch.Tensor],
-                     tokenizer: object):
-    if guided_input_ids is None:
-        return scores
-    for i in range(len(response_formats)):
-        _format = response_formats[i]
-        if isinstance(_format, Dict) and _format.get('type', 'text') != 'text':
-            if _format['type'] == 'json_schema':
-                schema = _format['json_schema']
-                if isinstance(schema, Dict):
-                    for key in ['json_schema', 'schema']:
-                        if key in schema:
-                            schema = json.dumps(schema[key])
-                elif schema is None:
-                    from .guided_process import JSON_GRAMMAR
-                    schema = JSON_GRAMMAR
-                elif isinstance(schema, str):
-                    raise ValueError(
-                        f'Cannot parse schema {schema}. The schema must be '
-                        'either a dictionary or a string that contains the'
-                        ' JSON Schema specification')
-            elif _format['type'] == 'regex_schema':
-                schema = _format.get('regex_schema', '')
-            else:
-                raise ValueError(f"unsupported format type: {_format['type']}")
-            from .guided_process import _get_guided_logits_processor
-            processor = _get_guided_logits_processor(schema, tokenizer,
-                                                     _format['type'])
-            if processor:
-                scores[i] = processor(guided_input_ids[i].tolist(), scores[i])
+def _process_guided_masks_(scores: torch.Tensor,
+                           masks: torch.Tensor,
+                           rows: torch.LongTensor,
+                           filter_value: float = -float('inf')):
+    """process packed allowed token masks of guided rows."""
+    vocab_size = scores.size(1)
+    bits = 1 << torch.arange(8, dtype=torch.uint8, device=masks.device)
+    allowed = (masks[:, :, None] & bits) != 0
+    allowed = allowed.flatten(1)[:, :vocab_size]
+    scores[rows] = scores[rows].masked_fill(~allowed, filter_value)
     return scores
 
 
+def _get_guided_processor(response_format: Dict,
+                          tokenizer: object,
+                          cache_dir: str = None):
+    """get compiled guided logits processor of the response format."""
+    if not isinstance(response_format, Dict):
+        return None
+    if response_format.get('type', 'text') == 'text':
+        return None
+    if response_format['type'] == 'json_schema':
+        schema = response_format['json_schema']
+        if isinstance(schema, Dict):
+            for key in ['json_schema', 'schema']:
+                if key in schema:
+                    schema = json.dumps(schema[key])
+        elif schema is None:
+            from .guided_process import JSON_GRAMMAR
+            schema = JSON_GRAMMAR
+        elif isinstance(schema, str):
+            raise ValueError(
+                f'Cannot parse schema {schema}. The schema must be '
+                'either a dictionary or a string that contains the'
+                ' JSON Schema specification')
+    elif response_format['type'] == 'regex_schema':
+        schema = response_format.get('regex_schema', '')
+    else:
+        raise ValueError(f"unsupported format type: {response_format['type']}")
+    from .guided_process import _get_guided_logits_processor
+    return _get_guided_logits_processor(schema, tokenizer,
+                                        response_format['type'], cache_dir)
+
+
+def get_guided_states(seqs: List[SchedulerSequence],
+                      tokenizer: object,
+                      cache_dir: str = None):
+    """get FSM states of guided sequences, None for unguided ones.
+
+    States are kept on the sequences and synced with the generated tokens.
+    """
+    guided_states = [None] * len(seqs)
+    for idx, seq in enumerate(seqs):
+        guided_state = seq.guided_state
+        if guided_state is None:
+            processor = _get_guided_processor(
+                seq.sampling_param.response_format, tokenizer, cache_dir)
+            if processor is None:
+                continue
+            from .guided_process import GuidedState
+            guided_state = GuidedState(processor)
+            seq.guided_state = guided_state
+        num_new_tokens = seq.num_new_tokens
+        new_token_ids = seq.all_ids[seq.num_all_ids - num_new_tokens:]
+        guided_state.sync(new_token_ids)
+        guided_states[idx] = guided_state
+    if not any(guided_states):
+        return None
+    return guided_states
+
+
+def precompile_guided_processors(response_formats: List[Dict],
+                                 tokenizer: object,
+                                 cache_dir: str = None):
+    """compile guided logits processors ahead of the requests."""
+    from lmdeploy.utils import get_logger
+    logger = get_logger('lmdeploy')
+    num_compiled = 0
+    for response_format in response_formats:
+        try:
+            processor = _get_guided_processor(response_format, tokenizer,
+                                              cache_dir)
+        except Exception as e:
+            logger.error(f'Failed to precompile {response_format}: {e}')
+            continue
+        if processor is not None:
+            num_compiled += 1
+    logger.info(f'Precompiled {num_compiled}/{len(response_formats)} '
+                'guided decoding schemas.')
+
+
+def update_guided_states(guided_states: List, next_token_ids: torch.Tensor):
+    """advance FSM states with the sampled tokens."""
+    if guided_states is None:
+        return
+    next_token_ids = next_token_ids.tolist()
+    for guided_state, token_id in zip(guided_states, next_token_ids):
+        if guided_state is not None:
+            guided_state.advance(token_id)
+
+
+def _guided_sampling(guided_states: List, scores: torch.Tensor):
+    """mask the tokens that are not allowed by the FSM states."""
+    if guided_states is None:
+        return scores
+    vocab_size = scores.size(1)
+    rows = []
+    masks = []
+    for idx, guided_state in enumerate(guided_states):
+        if guided_state is None:
+            continue
+        rows.append(idx)
+        masks.append(guided_state.get_allowed_mask(vocab_size))
+    if len(rows) == 0:
+        return scores
+    device = scores.device
+    masks = torch.stack(masks).to(device, non_blocking=True)
+    rows = torch.tensor(rows, device=device)
+    return _process_guided_masks_(scores, masks, rows)
+
+
 @dataclass
 class SamplingInputs:
     temperature: torch.Tensor = None
@@ -281,21 +367,17 @@ def _apply_custom_logits_processors(batched_logits_processors, all_ids,
 class FusedLogitsProcessor(LogitsWarper):
     """Custom logits processor."""
 
-    def __init__(self,
-                 sampling_inputs: SamplingInputs,
-                 ignore_eos: torch.Tensor,
-                 tokenizer: Optional[Tokenizer] = None):
+    def __init__(self, sampling_inputs: SamplingInputs,
+                 ignore_eos: torch.Tensor):
         self.sampling_inputs: SamplingInputs = sampling_inputs
         self.ignore_eos = ignore_eos
-        self.tokenizer = tokenizer
 
-    def __call__(self, all_ids: torch.LongTensor,
-                 guided_input_ids: torch.LongTensor,
+    def __call__(self, all_ids: torch.LongTensor, guided_states: List,
                  scores: torch.FloatTensor) -> torch.FloatTensor:
         r"""
         Args:
             all_ids (torch.LongTensor): All the token ids.
-            guided_input_ids (torch.LongTensor): Guided prompt ids.
+            guided_states (List): FSM states of guided sequences.
             scores (torch.FloatTensor):
                 Prediction scores of a language modeling head.
                 These can be logits for each vocabulary when not using
@@ -333,8 +415,7 @@ class FusedLogitsProcessor(LogitsWarper):
             stop_words = torch.where(self.ignore_eos[:, None], stop_words, -1)
             scores = _process_bad_words_(scores, stop_words)
 
-        scores = _guided_sampling(sampling_inputs.response_formats, scores,
-                                  guided_input_ids, self.tokenizer)
+        scores = _guided_sampling(guided_states, scores)
         return scores
 
     def sampling(self, logits: torch.Tensor):
@@ -108,8 +108,10 @@ def _update_cache_config(model_config: ModelConfig,
     logger.debug('block num: {}'.format(cache_config.num_gpu_blocks))
 
 
-def cache_swapping(cache_engine: CacheEngine, swap_in_map: dict,
-                   swap_out_map: dict):
+def cache_swapping(cache_engine: CacheEngine,
+                   swap_in_map: dict,
+                   swap_out_map: dict,
+                   copy_map: dict = None):
     """perform cache swapping."""
     issued_cache_op = False
     if len(swap_in_map) > 0:
@@ -118,6 +120,10 @@ def cache_swapping(cache_engine: CacheEngine, swap_in_map: dict,
     if len(swap_out_map) > 0:
         cache_engine.swap_out(swap_out_map)
         issued_cache_op = True
+    # copy after swapping out, the blocks swapped out might be reused.
+    if copy_map:
+        cache_engine.copy(copy_map)
+        issued_cache_op = True
 
     if issued_cache_op:
         cache_events = cache_engine.events
@@ -193,25 +199,51 @@ class AutoModelAgent:
         """paging adapter."""
         raise NotImplementedError('Not implemented.')
 
-    async def async_forward(self, inputs: ModelInputs, swap_in_map: SwapMap,
-                            swap_out_map: SwapMap):
+    async def async_forward(self,
+                            inputs: ModelInputs,
+                            swap_in_map: SwapMap,
+                            swap_out_map: SwapMap,
+                            copy_map: SwapMap = None):
         """model forward.
 
         Args:
             inputs (Dict): The input data comes from _make_inputs.
             swap_in_map (SwapMap): Cache maps to swap in.
             swap_out_map (SwapMap): Cache maps to swap out.
+            copy_map (SwapMap): Cache blocks to copy on device.
         """
         raise NotImplementedError('Not implemented.')
 
-    def forward(self, inputs: ModelInputs, swap_in_map: SwapMap,
-                swap_out_map: SwapMap):
+    def forward(self,
+                inputs: ModelInputs,
+                swap_in_map: SwapMap,
+                swap_out_map: SwapMap,
+                copy_map: SwapMap = None):
         """model forward.
 
         Args:
             inputs (Dict): The input data comes from _make_inputs.
             swap_in_map (SwapMap): Cache maps to swap in.
             swap_out_map (SwapMap): Cache maps to swap out.
+            copy_map (SwapMap): Cache blocks to copy on device.
+        """
+        raise NotImplementedError('Not implemented.')
+
+    def launch_forward(self,
+                       inputs: ModelInputs,
+                       swap_in_map: SwapMap,
+                       swap_out_map: SwapMap,
+                       copy_map: SwapMap = None):
+        """launch model forward without waiting for the device.
+
+        Work on the current stream after this call would wait for the
+        outputs.
+
+        Args:
+            inputs (Dict): The input data comes from _make_inputs.
+            swap_in_map (SwapMap): Cache maps to swap in.
+            swap_out_map (SwapMap): Cache maps to swap out.
+            copy_map (SwapMap): Cache blocks to copy on device.
         """
         raise NotImplementedError('Not implemented.')
 
@@ -291,11 +323,15 @@ class BaseModelAgent(AutoModelAgent):
         for weight_map in weight_maps:
             weight_map.cache_adapter(cpu_caches)
 
-    def _forward_impl(self, inputs: ModelInputs, swap_in_map: SwapMap,
-                      swap_out_map: SwapMap):
+    def _forward_impl(self,
+                      inputs: ModelInputs,
+                      swap_in_map: SwapMap,
+                      swap_out_map: SwapMap,
+                      copy_map: SwapMap = None):
         cache_swapping(self.cache_engine,
                        swap_in_map=swap_in_map,
-                       swap_out_map=swap_out_map)
+                       swap_out_map=swap_out_map,
+                       copy_map=copy_map)
         output = model_forward(
             self.patched_model,
             inputs,
@@ -305,37 +341,73 @@ class BaseModelAgent(AutoModelAgent):
         )
         return output
 
-    def forward(self, inputs: ModelInputs, swap_in_map: SwapMap,
-                swap_out_map: SwapMap):
+    def forward(self,
+                inputs: ModelInputs,
+                swap_in_map: SwapMap,
+                swap_out_map: SwapMap,
+                copy_map: SwapMap = None):
         """model forward.
 
         Args:
             inputs (Dict): The input data comes from _make_inputs.
             swap_in_map (SwapMap): Cache maps to swap in.
             swap_out_map (SwapMap): Cache maps to swap out.
+            copy_map (SwapMap): Cache blocks to copy on device.
         """
         output = self._forward_impl(inputs,
                                     swap_in_map=swap_in_map,
-                                    swap_out_map=swap_out_map)
+                                    swap_out_map=swap_out_map,
+                                    copy_map=copy_map)
         self.stream.synchronize()
         return output
 
-    async def async_forward(self, inputs: ModelInputs, swap_in_map: SwapMap,
-                            swap_out_map: SwapMap):
+    async def async_forward(self,
+                            inputs: ModelInputs,
+                            swap_in_map: SwapMap,
+                            swap_out_map: SwapMap,
+                            copy_map: SwapMap = None):
         """model forward.
 
         Args:
             inputs (Dict): The input data comes from _make_inputs.
             swap_in_map (SwapMap): Cache maps to swap in.
             swap_out_map (SwapMap): Cache maps to swap out.
+            copy_map (SwapMap): Cache blocks to copy on device.
         """
         output = self._forward_impl(inputs,
                                     swap_in_map=swap_in_map,
-                                    swap_out_map=swap_out_map)
+                                    swap_out_map=swap_out_map,
+                                    copy_map=copy_map)
         await asyncio.get_event_loop().run_in_executor(None,
                                                        self.stream.synchronize)
         return output
 
+    def launch_forward(self,
+                       inputs: ModelInputs,
+                       swap_in_map: SwapMap,
+                       swap_out_map: SwapMap,
+                       copy_map: SwapMap = None):
+        """launch model forward without waiting for the device.
+
+        Work on the current stream after this call would wait for the
+        outputs.
+
+        Args:
+            inputs (Dict): The input data comes from _make_inputs.
+            swap_in_map (SwapMap): Cache maps to swap in.
+            swap_out_map (SwapMap): Cache maps to swap out.
+            copy_map (SwapMap): Cache blocks to copy on device.
+        """
+        current_stream = torch.cuda.current_stream()
+        # inputs might be updated on current stream
+        self.stream.wait_stream(current_stream)
+        output = self._forward_impl(inputs,
+                                    swap_in_map=swap_in_map,
+                                    swap_out_map=swap_out_map,
+                                    copy_map=copy_map)
+        current_stream.wait_stream(self.stream)
+        return output
+
 
 @torch.inference_mode()
 def _tp_build_model(
@@ -422,7 +494,7 @@ def _broadcast_inputs(rank: int, inputs: Any, stream: torch.cuda.Stream):
     """get input tensor parallel."""
     # broadcast meta info
     if rank != 0:
-        inputs = [None, None, None, None]
+        inputs = [None, None, None, None, None]
 
     with torch.cuda.stream(stream):
         dist.broadcast_object_list(inputs)
@@ -496,15 +568,16 @@ def _tp_model_loop(
         _tp_paging_adapters(rank, cache_engine=cache_engine, weight_maps=None)
 
     while True:
-        inputs, swap_in_map, swap_out_map, exit_flag = _broadcast_inputs(
-            rank, None, stream)
+        (inputs, swap_in_map, swap_out_map, copy_map,
+         exit_flag) = _broadcast_inputs(rank, None, stream)
 
         if exit_flag:
             break
 
         cache_swapping(cache_engine,
                        swap_in_map=swap_in_map,
-                       swap_out_map=swap_out_map)
+                       swap_out_map=swap_out_map,
+                       copy_map=copy_map)
 
         model_forward(
             patched_model,
@@ -734,17 +807,22 @@ class TPModelAgent(AutoModelAgent):
         logger.info('paging adapters.')
         _tp_paging_adapters(rank, self.cache_engine, weight_maps)
 
-    def _forward_impl(self, inputs: ModelInputs, swap_in_map: SwapMap,
-                      swap_out_map: SwapMap):
+    def _forward_impl(self,
+                      inputs: ModelInputs,
+                      swap_in_map: SwapMap,
+                      swap_out_map: SwapMap,
+                      copy_map: SwapMap = None):
         """forward impl."""
         _check_context_alive(self.mp_context)
         rank = 0
         exit_flag = False
-        _broadcast_inputs(rank, [inputs, swap_in_map, swap_out_map, exit_flag],
-                          self.stream)
+        _broadcast_inputs(
+            rank, [inputs, swap_in_map, swap_out_map, copy_map, exit_flag],
+            self.stream)
         cache_swapping(self.cache_engine,
                        swap_in_map=swap_in_map,
-                       swap_out_map=swap_out_map)
+                       swap_out_map=swap_out_map,
+                       copy_map=copy_map)
         output = model_forward(
             self.patched_model,
             inputs,
@@ -754,37 +832,73 @@ class TPModelAgent(AutoModelAgent):
         )
         return output
 
-    def forward(self, inputs: ModelInputs, swap_in_map: SwapMap,
-                swap_out_map: SwapMap):
+    def forward(self,
+                inputs: ModelInputs,
+                swap_in_map: SwapMap,
+                swap_out_map: SwapMap,
+                copy_map: SwapMap = None):
         """model forward.
 
         Args:
             inputs (Dict): The input data comes from _make_inputs.
             swap_in_map (SwapMap): Cache maps to swap in.
             swap_out_map (SwapMap): Cache maps to swap out.
+            copy_map (SwapMap): Cache blocks to copy on device.
         """
         output = self._forward_impl(inputs,
                                     swap_in_map=swap_in_map,
-                                    swap_out_map=swap_out_map)
+                                    swap_out_map=swap_out_map,
+                                    copy_map=copy_map)
         self.stream.synchronize()
         return output
 
-    async def async_forward(self, inputs: ModelInputs, swap_in_map: SwapMap,
-                            swap_out_map: SwapMap):
+    async def async_forward(self,
+                            inputs: ModelInputs,
+                            swap_in_map: SwapMap,
+                            swap_out_map: SwapMap,
+                            copy_map: SwapMap = None):
         """model forward.
 
         Args:
             inputs (Dict): The input data comes from _make_inputs.
             swap_in_map (SwapMap): Cache maps to swap in.
             swap_out_map (SwapMap): Cache maps to swap out.
+            copy_map (SwapMap): Cache blocks to copy on device.
         """
         output = self._forward_impl(inputs,
                                     swap_in_map=swap_in_map,
-                                    swap_out_map=swap_out_map)
+                                    swap_out_map=swap_out_map,
+                                    copy_map=copy_map)
         await asyncio.get_event_loop().run_in_executor(None,
                                                        self.stream.synchronize)
         return output
 
+    def launch_forward(self,
+                       inputs: ModelInputs,
+                       swap_in_map: SwapMap,
+                       swap_out_map: SwapMap,
+                       copy_map: SwapMap = None):
+        """launch model forward without waiting for the device.
+
+        Work on the current stream after this call would wait for the
+        outputs.
+
+        Args:
+            inputs (Dict): The input data comes from _make_inputs.
+            swap_in_map (SwapMap): Cache maps to swap in.
+            swap_out_map (SwapMap): Cache maps to swap out.
+            copy_map (SwapMap): Cache blocks to copy on device.
+        """
+        current_stream = torch.cuda.current_stream()
+        # inputs might be updated on current stream
+        self.stream.wait_stream(current_stream)
+        output = self._forward_impl(inputs,
+                                    swap_in_map=swap_in_map,
+                                    swap_out_map=swap_out_map,
+                                    copy_map=copy_map)
+        current_stream.wait_stream(self.stream)
+        return output
+
 
 def _exit_by_sending_exit_flag(rank: int, agent: TPModelAgent):
     """[Note] Exit By Sending Exit Flag: the registration to `atexit` of this
@@ -809,7 +923,7 @@ def _exit_by_sending_exit_flag(rank: int, agent: TPModelAgent):
     # send exit_flag to all subprocess relying on all subprocess are alive
     # and wait at _broadcast_inputs
     exit_flag = True
-    _broadcast_inputs(rank, [None, None, None, exit_flag], agent.stream)
+    _broadcast_inputs(rank, [None, None, None, None, exit_flag], agent.stream)
     agent.stream.synchronize()
 
     del agent.patched_model
@@ -0,0 +1,321 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import asyncio
+import atexit
+import copy
+import multiprocessing as mp
+import os
+import pickle
+import shutil
+import signal
+import struct
+import tempfile
+from typing import Any, Dict, List
+
+import torch
+
+from lmdeploy.messages import PytorchEngineConfig, ResponseType
+from lmdeploy.utils import get_logger
+
+from ..config import ModelConfig
+from .request import Request, RequestManager, Response
+
+logger = get_logger('lmdeploy')
+
+# length of the payload of a frame
+_HEADER = struct.Struct('!Q')
+
+
+async def _read_frame(reader: asyncio.StreamReader):
+    """read a frame."""
+    header = await reader.readexactly(_HEADER.size)
+    size, = _HEADER.unpack(header)
+    return await reader.readexactly(size)
+
+
+def _write_frame(writer: asyncio.StreamWriter, payload: bytes):
+    """write a frame."""
+    writer.write(_HEADER.pack(len(payload)))
+    writer.write(payload)
+
+
+def _dumps(obj: Any):
+    """serialize the object of a frame."""
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _to_cpu(data: Any):
+    """move the tensors in the response data to cpu."""
+    if isinstance(data, torch.Tensor):
+        return data.cpu()
+    if isinstance(data, Dict):
+        return dict((k, _to_cpu(v)) for k, v in data.items())
+    return data
+
+
+class _RemoteSender:
+    """Stand-in of a sender of the frontend process in the engine process."""
+
+    def __init__(self, sender_id: int, server: 'EngineServer'):
+        self.sender_id = sender_id
+        self.server = server
+
+    def response_callback(self, resp: Response):
+        """response callback."""
+        resp.sender_id = self.sender_id
+        self.server.send_response(resp)
+
+
+class EngineServer:
+    """Serve the engine to the frontend process over a unix socket.
+
+    The requests of the frontend senders are fed to the request manager of
+    the engine, the responses of a loop iteration are sent back in one frame.
+
+    Args:
+        engine (Engine): the engine.
+        address (str): path of the unix socket.
+    """
+
+    def __init__(self, engine, address: str):
+        self.engine = engine
+        self.address = address
+        self.req_manager: RequestManager = engine.req_manager
+        self._sender_ids: Dict[int, int] = dict()
+        self._writer: asyncio.StreamWriter = None
+        self._pending_resps: List[Response] = []
+        self._stop_event: asyncio.Event = None
+
+    def _get_sender_id(self, remote_id: int):
+        """get the local sender id of the frontend sender."""
+        sender_id = self._sender_ids.get(remote_id)
+        if sender_id is None:
+            manager = self.req_manager
+            with manager._mutex:
+                sender_id = manager._next_sender_id
+                manager._next_sender_id += 1
+                manager.senders[sender_id] = _RemoteSender(remote_id, self)
+            self._sender_ids[remote_id] = sender_id
+        return sender_id
+
+    def _flush_responses(self):
+        """send the pending responses in one frame."""
+        resps = self._pending_resps
+        self._pending_resps = []
+        if self._writer is None or self._writer.is_closing():
+            return
+        for resp in resps:
+            resp.data = _to_cpu(resp.data)
+        _write_frame(self._writer, _dumps(resps))
+
+    def send_response(self, resp: Response):
+        """send response to the frontend."""
+        if len(self._pending_resps) == 0:
+            asyncio.get_event_loop().call_soon(self._flush_responses)
+        self._pending_resps.append(resp)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter):
+        """receive requests from the frontend."""
+        if self._writer is not None:
+            logger.error('Engine process only serves one frontend.')
+            writer.close()
+            return
+        self._writer = writer
+        try:
+            while True:
+                reqs: List[Request] = pickle.loads(await _read_frame(reader))
+                for req in reqs:
+                    req.sender_id = self._get_sender_id(req.sender_id)
+                self.req_manager.put_requests(reqs)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info('Frontend disconnected, stop engine process.')
+        finally:
+            writer.close()
+            self._stop_event.set()
+
+    async def serve(self, conn):
+        """serve until the frontend disconnects."""
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, self._stop_event.set)
+        self.req_manager.create_loop_task()
+        server = await asyncio.start_unix_server(self._handle_connection,
+                                                 path=self.address)
+        engine = self.engine
+        conn.send(
+            (engine.engine_config, engine.cache_config, engine.model_path))
+        conn.close()
+        async with server:
+            await self._stop_event.wait()
+
+
+def _engine_main(model_path: str, engine_config: PytorchEngineConfig,
+                 trust_remote_code: bool, address: str, conn):
+    """entry of the engine process."""
+    from .engine import Engine
+    try:
+        engine = Engine(model_path=model_path,
+                        engine_config=engine_config,
+                        trust_remote_code=trust_remote_code)
+    except Exception as e:
+        conn.send(e)
+        raise
+    asyncio.run(EngineServer(engine, address).serve(conn))
+
+
+class MPEngine:
+    """The pytorch engine running in its own process.
+
+    The scheduling loop does not share the GIL with the caller, such as the
+    api server. Requests are sent to the engine process in batched frames
+    over a unix socket, and the responses of an engine step come back in one
+    frame. It has the same interface as `Engine` to create instances.
+
+    Args:
+        model_path (str): The hugging face model path.
+        engine_config (PytorchEngineConfig): The config of the Engine.
+        trust_remote_code (bool): Trust remote code.
+    """
+
+    def __init__(self,
+                 model_path: str,
+                 engine_config: PytorchEngineConfig = None,
+                 trust_remote_code: bool = True) -> None:
+        if engine_config is None:
+            engine_config = PytorchEngineConfig()
+        thread_safe = engine_config.thread_safe
+        worker_config = copy.deepcopy(engine_config)
+        worker_config.enable_engine_process = False
+        worker_config.thread_safe = False
+
+        self._socket_dir = tempfile.mkdtemp(prefix='lmdeploy_engine_')
+        self._address = os.path.join(self._socket_dir, 'engine.sock')
+        ctx = mp.get_context('spawn')
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        self._proc = ctx.Process(target=_engine_main,
+                                 args=(model_path, worker_config,
+                                       trust_remote_code, self._address,
+                                       child_conn),
+                                 name='lmdeploy_engine')
+        self._proc.start()
+        child_conn.close()
+        atexit.register(self.close)
+        try:
+            msg = parent_conn.recv()
+        except EOFError:
+            self.close()
+            raise RuntimeError('Engine process exited during initialization.')
+        finally:
+            parent_conn.close()
+        if isinstance(msg, Exception):
+            self.close()
+            raise msg
+
+        engine_config, cache_config, model_path = msg
+        engine_config.thread_safe = thread_safe
+        engine_config.enable_engine_process = True
+        self.engine_config = engine_config
+        self.cache_config = cache_config
+        self.model_path = model_path
+        self.model_config = ModelConfig.from_pretrained(
+            model_path, trust_remote_code=trust_remote_code)
+
+        self.req_manager = RequestManager(thread_safe)
+        self.req_manager.start_loop(self._ipc_loop)
+        self.engine_instance = self.create_instance()
+
+    @classmethod
+    def from_pretrained(cls,
+                        pretrained_model_name_or_path: str,
+                        engine_config: PytorchEngineConfig = None,
+                        trust_remote_code: bool = True,
+                        **kwargs):
+        """build the engine in its own process, refer to
+        `Engine.from_pretrained`."""
+        if len(kwargs) > 0:
+            logger.debug(f'Get unexpected kwargs: {kwargs}')
+        return cls(model_path=pretrained_model_name_or_path,
+                   engine_config=engine_config,
+                   trust_remote_code=trust_remote_code)
+
+    @property
+    def tokenizer(self):
+        """create tokenizer."""
+        from lmdeploy.tokenizer import Tokenizer
+        if not hasattr(self, '_tokenizer'):
+            self._tokenizer = Tokenizer(self.model_path)
+        return self._tokenizer
+
+    def _dumps_requests(self, reqs: List[Request]):
+        """serialize requests, the requests can not be pickled, such as those
+        with local logits processors, are failed."""
+        try:
+            return _dumps(reqs)
+        except Exception:
+            pass
+        valid_reqs = []
+        for req in reqs:
+            try:
+                _dumps(req)
+            except Exception as e:
+                self.req_manager.response(
+                    Response(ResponseType.INTERNAL_ENGINE_ERROR,
+                             sender_id=req.sender_id,
+                             req_id=req.req_id,
+                             err_msg=f'Failed to send request: {e}'))
+                continue
+            valid_reqs.append(req)
+        return _dumps(valid_reqs)
+
+    async def _ipc_loop(self):
+        """transport requests and responses between the request manager and
+        the engine process."""
+        reader, writer = await asyncio.open_unix_connection(self._address)
+        manager = self.req_manager
+
+        async def __send_loop():
+            """send requests."""
+            requests = manager.requests
+            while True:
+                elems = [await requests.get()]
+                for _ in range(requests.qsize()):
+                    elems.append(requests.get_nowait())
+                reqs: List[Request] = []
+                for elem in elems:
+                    if isinstance(elem, Request):
+                        elem = [elem]
+                    reqs += elem
+                _write_frame(writer, self._dumps_requests(reqs))
+                await writer.drain()
+
+        send_task = asyncio.get_event_loop().create_task(__send_loop())
+        try:
+            while True:
+                resps: List[Response] = pickle.loads(await _read_frame(reader))
+                for resp in resps:
+                    manager.response(resp)
+        finally:
+            send_task.cancel()
+            writer.close()
+
+    def create_instance(self, cuda_stream_id=0):
+        """Create a pytorch engine instance.
+
+        Args:
+            cuda_stream_id(int): identity of a cuda stream
+        Returns:
+            EngineInstance: an instance of pytorch engine
+        """
+        from .engine_instance import EngineInstance
+        return EngineInstance(self)
+
+    def close(self):
+        """stop the engine process."""
+        proc = getattr(self, '_proc', None)
+        if proc is not None and proc.is_alive():
+            proc.terminate()
+            proc.join(timeout=30)
+            if proc.is_alive():
+                proc.kill()
+        shutil.rmtree(self._socket_dir, ignore_errors=True)
@@ -0,0 +1,201 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import hashlib
+import json
+import os
+import os.path as osp
+import shutil
+from typing import Dict
+
+import numpy as np
+import torch
+
+from lmdeploy.utils import get_logger
+
+from ..paging import Scheduler
+from .cache_engine import CacheEngine
+
+logger = get_logger('lmdeploy')
+
+SNAPSHOT_VERSION = 2
+_META_FILE = 'meta.json'
+_TRIE_FILE = 'trie.npz'
+_CACHE_FILE = 'caches.npy'
+_COPY_BATCH = 256
+
+
+def _get_fingerprint(model_path: str, adapters: Dict[str, str] = None):
+    """fingerprint of the model weights the caches are computed with."""
+    config_path = osp.join(model_path, 'config.json')
+    config_hash = None
+    if osp.exists(config_path):
+        with open(config_path, 'rb') as f:
+            config_hash = hashlib.sha256(f.read()).hexdigest()
+    adapters = adapters or dict()
+    adapters = dict((name, osp.abspath(adapter_path))
+                    for name, adapter_path in sorted(adapters.items()))
+    return dict(model_path=osp.abspath(model_path),
+                config_hash=config_hash,
+                adapters=adapters)
+
+
+def _get_meta(cache_engine: CacheEngine,
+              model_path: str,
+              adapters: Dict[str, str] = None):
+    """meta used to check if snapshot matches the engine."""
+    return dict(
+        version=SNAPSHOT_VERSION,
+        model=_get_fingerprint(model_path, adapters),
+        block_size=cache_engine.block_size,
+        num_layers=cache_engine.num_layers,
+        dtype=str(cache_engine.kv_cache_dtype),
+        key_shape=list(cache_engine.get_key_block_shape(local=True)),
+        value_shape=list(cache_engine.get_value_block_shape(local=True)),
+    )
+
+
+def _layer_bytes(cache_engine: CacheEngine):
+    """bytes of key and value block of one layer."""
+    key_cache, value_cache = cache_engine.gpu_cache[0]
+    key_bytes = key_cache[0].numel() * key_cache.element_size()
+    value_bytes = value_cache[0].numel() * value_cache.element_size()
+    return key_bytes, value_bytes
+
+
+def _as_bytes(blocks: torch.Tensor):
+    """view blocks as uint8 rows."""
+    return blocks.flatten(1).view(torch.uint8)
+
+
+@torch.inference_mode()
+def save_prefix_cache(path: str,
+                      scheduler: Scheduler,
+                      cache_engine: CacheEngine,
+                      model_path: str,
+                      adapters: Dict[str, str] = None):
+    """save prefix cache trie and caches of the nodes.
+
+    The snapshot is written into a temporary directory which then replaces
+    ``path``, so an interrupted saving never leaves mismatched files.
+    """
+    block_trie = scheduler.block_trie
+    if not block_trie.enable:
+        return
+    snapshot = block_trie.get_snapshot()
+    logical_blocks = snapshot.pop('blocks')
+    num_blocks = len(logical_blocks)
+    if num_blocks == 0:
+        logger.info('Prefix cache is empty, skip saving.')
+        return
+
+    # nodes on host are not included in snapshot.
+    allocator = scheduler.block_manager.allocator
+    phy_blocks = allocator.get_physical_blocks(logical_blocks)
+
+    path = osp.abspath(path)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    meta = _get_meta(cache_engine, model_path, adapters)
+    meta['adapter_names'] = snapshot.pop('adapter_names')
+    meta['num_blocks'] = num_blocks
+
+    key_bytes, value_bytes = _layer_bytes(cache_engine)
+    layer_bytes = key_bytes + value_bytes
+    caches = np.lib.format.open_memmap(
+        osp.join(tmp_path, _CACHE_FILE),
+        mode='w+',
+        dtype=np.uint8,
+        shape=(num_blocks, cache_engine.num_layers * layer_bytes))
+
+    torch.cuda.synchronize()
+    phy_blocks = torch.from_numpy(phy_blocks)
+    for start in range(0, num_blocks, _COPY_BATCH):
+        end = min(start + _COPY_BATCH, num_blocks)
+        indices = phy_blocks[start:end].cuda()
+        for layer_id, (key_cache,
+                       value_cache) in enumerate(cache_engine.gpu_cache):
+            offset = layer_id * layer_bytes
+            keys = _as_bytes(key_cache[indices]).cpu().numpy()
+            values = _as_bytes(value_cache[indices]).cpu().numpy()
+            caches[start:end, offset:offset + key_bytes] = keys
+            caches[start:end, offset + key_bytes:offset + layer_bytes] = values
+    caches.flush()
+    del caches
+
+    np.savez(osp.join(tmp_path, _TRIE_FILE), **snapshot)
+    with open(osp.join(tmp_path, _META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+    # directories can not replace a non-empty one, move the old one aside.
+    old_path = path + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if osp.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    logger.info(f'Save {num_blocks} prefix cache blocks to {path}.')
+
+
+@torch.inference_mode()
+def load_prefix_cache(path: str,
+                      scheduler: Scheduler,
+                      cache_engine: CacheEngine,
+                      model_path: str,
+                      adapters: Dict[str, str] = None):
+    """load prefix cache trie and caches of the nodes.
+
+    Snapshots saved with another model, config or adapters are not loaded.
+    """
+    block_trie = scheduler.block_trie
+    if not block_trie.enable:
+        return
+    meta_path = osp.join(path, _META_FILE)
+    if not osp.exists(meta_path):
+        logger.info(f'Prefix cache snapshot not found in {path}.')
+        return
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    adapter_names = meta.pop('adapter_names')
+    num_blocks = meta.pop('num_blocks')
+    if meta != _get_meta(cache_engine, model_path, adapters):
+        logger.warning(f'Prefix cache snapshot in {path} does not match '
+                       'the engine, skip loading.')
+        return
+
+    snapshot = dict(np.load(osp.join(path, _TRIE_FILE)))
+    snapshot['adapter_names'] = adapter_names
+
+    # parents come first, truncated nodes are always leaves.
+    allocator = scheduler.block_manager.allocator
+    num_free = scheduler.block_manager.get_num_free_gpu_blocks()
+    num_blocks = min(num_blocks, num_free)
+    if num_blocks == 0:
+        return
+    for key in ['hash_keys', 'parents', 'num_matched']:
+        snapshot[key] = snapshot[key][:num_blocks]
+    logical_blocks = allocator.allocate(num_blocks, 'gpu')
+    phy_blocks = torch.from_numpy(
+        allocator.get_physical_blocks(logical_blocks))
+
+    key_bytes, value_bytes = _layer_bytes(cache_engine)
+    layer_bytes = key_bytes + value_bytes
+    caches = np.load(osp.join(path, _CACHE_FILE), mmap_mode='r')
+    for start in range(0, num_blocks, _COPY_BATCH):
+        end = min(start + _COPY_BATCH, num_blocks)
+        indices = phy_blocks[start:end].cuda()
+        block_caches = torch.from_numpy(np.ascontiguousarray(
+            caches[start:end])).cuda()
+        for layer_id, (key_cache,
+                       value_cache) in enumerate(cache_engine.gpu_cache):
+            offset = layer_id * layer_bytes
+            keys = block_caches[:, offset:offset + key_bytes]
+            values = block_caches[:, offset + key_bytes:offset + layer_bytes]
+            keys = keys.contiguous().view(key_cache.dtype)
+            values = values.contiguous().view(value_cache.dtype)
+            key_cache[indices] = keys.view(-1, *key_cache.shape[1:])
+            value_cache[indices] = values.view(-1, *value_cache.shape[1:])
+    torch.cuda.synchronize()
+    del caches
+
+    block_trie.load_snapshot(snapshot, logical_blocks)
+    logger.info(f'Load {num_blocks} prefix cache blocks from {path}.')
@@ -40,6 +40,7 @@ class RequestType(enum.Enum):
     END_SESSION = enum.auto()
     STOP_ENGINE = enum.auto()
     RESUME_ENGINE = enum.auto()
+    GET_METRICS = enum.auto()
 
 
 @dataclass
@@ -150,34 +151,30 @@ class RequestSender:
 
     def _resp_get(self):
         """resp_que.get."""
-        timeout = 1.0
-        que = self.resp_thread_que
-        not_empty = que.not_empty
-        with not_empty:
-            while not que._qsize():
-                not_empty.wait(timeout)
-        return que.get_nowait()
+        return self.resp_thread_que.get()
 
     async def _async_resp_get(self):
         """get resp.
 
         Different behavior in threadsafe mode.
         """
-        timeout = 1
 
         async def __no_threadsafe_get():
-            while True:
-                try:
-                    return await asyncio.wait_for(self.resp_que.get(), timeout)
-                except asyncio.TimeoutError:
-                    if not self.manager.is_loop_alive():
-                        logger.debug('Engine loop is not alive.')
-                        exit(1)
-                    continue
-                except Exception as e:
-                    logger.exception(
-                        f'sender[{self.sender_id}] get response failed: {e}')
-                    raise e
+            que = self.resp_que
+            if que.empty() and not self.manager.is_loop_alive():
+                logger.debug('Engine loop is not alive.')
+                exit(1)
+            try:
+                resp = await que.get()
+            except Exception as e:
+                logger.exception(
+                    f'sender[{self.sender_id}] get response failed: {e}')
+                raise e
+            # the engine loop finished while waiting
+            if resp is None:
+                logger.debug('Engine loop is not alive.')
+                exit(1)
+            return resp
 
         if self.is_thread_safe():
             ret = self._resp_get()
@@ -189,6 +186,7 @@ class RequestSender:
     def _req_put(self, reqs: Any):
         """req put."""
         self.req_thread_que.put(reqs)
+        self.manager.notify_thread_requests()
 
     async def _async_req_put(self, reqs: Any):
         """async rq_que put.
@@ -199,7 +197,7 @@ class RequestSender:
             self._req_put(reqs)
             await asyncio.sleep(0)
         else:
-            await self.req_que.put(reqs)
+            self.manager.put_requests(reqs)
 
     def _prefetch_resps(self):
         """prefetch from resp que.
@@ -213,6 +211,8 @@ class RequestSender:
         num_resps = resp_que.qsize()
         for _ in range(num_resps):
             resp: Response = resp_que.get_nowait()
+            if resp is None:
+                continue
             req_id = resp.req_id
             self._push_resp(req_id, resp)
 
@@ -311,7 +311,7 @@ class RequestSender:
         while True:
             resp: Response = await self._async_resp_get()
             if resp.req_id != req_id:
-                self._push_resp(req_id, resp)
+                self._push_resp(resp.req_id, resp)
             else:
                 return resp
 
@@ -332,7 +332,7 @@ class RequestSender:
         while True:
             resp: Response = self._resp_get()
             if resp.req_id != req_id:
-                self._push_resp(req_id, resp)
+                self._push_resp(resp.req_id, resp)
             else:
                 return resp
 
@@ -360,9 +360,11 @@ class RequestManager:
         self.request_priority: List[RequestType] = [
             RequestType.STOP_ENGINE, RequestType.STOP_SESSION,
             RequestType.END_SESSION, RequestType.ADD_SESSION,
-            RequestType.ADD_MESSAGE
+            RequestType.ADD_MESSAGE, RequestType.GET_METRICS
         ]
         self.requests: asyncio.Queue = None
+        # set when requests are put, so the idle loop need not poll
+        self._requests_event: asyncio.Event = None
         self._loop_task: asyncio.Future = None
         self._loop_coro: Callable = None
         self._thread_safe = thread_safe
@@ -371,6 +373,8 @@ class RequestManager:
         self._loop_thread: Thread = None
 
         self.thread_requests: Queue = None
+        self._thread_requests_event: asyncio.Event = None
+        self._thread_event_loop: asyncio.AbstractEventLoop = None
         # every sender has it's own responses, this responses is
         # only used in thread safe mode.
         self.responses: asyncio.Queue = None
@@ -386,10 +390,19 @@ class RequestManager:
         loop_unshielded = event_loop.create_task(self._loop_coro(),
                                                  name='EngineMainLoop')
         loop_unshielded.add_done_callback(_raise_exception_on_finish)
+        loop_unshielded.add_done_callback(self._on_loop_finish)
         self._loop_task = asyncio.shield(loop_unshielded)
         self.requests = asyncio.Queue()
+        self._requests_event = asyncio.Event()
         return self._loop_task
 
+    def _on_loop_finish(self, task: asyncio.Task):
+        """wake up the senders waiting for responses."""
+        for sender in list(self.senders.values()):
+            resp_que = getattr(sender, '_resp_que', None)
+            if resp_que is not None:
+                resp_que.put_nowait(None)
+
     @property
     def event_loop(self):
         """get event loop."""
@@ -417,27 +430,19 @@ class RequestManager:
                 reqs += tmp_reqs
             return reqs
 
-        async def __async_get_req(event_loop):
-            """async get request."""
-            que = self.thread_requests
-            not_empty = que.not_empty
-            with not_empty:
-                while not que._qsize():
-                    await event_loop.run_in_executor(None, not_empty.wait, 1.0)
-            reqs = que.get_nowait()
-            if isinstance(reqs, Request):
-                reqs = [reqs]
-            return reqs
-
         async def __req_loop():
             """req loop."""
-            event_loop = asyncio.get_event_loop()
+            event = self._thread_requests_event
             while True:
                 # get reqs
                 reqs = __get_thread_reqs()
                 if len(reqs) == 0:
-                    reqs = await __async_get_req(event_loop)
-                self.requests.put_nowait(reqs)
+                    event.clear()
+                    # requests might be put before the event is cleared
+                    if self.thread_requests.qsize() == 0:
+                        await event.wait()
+                    continue
+                self.put_requests(reqs)
 
         def __put_thread_resps(resps: List[Response]):
             """put thread resps."""
@@ -466,6 +471,8 @@ class RequestManager:
             logger.debug('start thread run forever.')
             asyncio.set_event_loop(event_loop)
             self.responses = asyncio.Queue()
+            self._thread_requests_event = asyncio.Event()
+            self._thread_event_loop = event_loop
             self.create_loop_task()
             req_loop = event_loop.create_task(__req_loop(),
                                               name='RunForeverReqLoop')
@@ -521,6 +528,26 @@ class RequestManager:
             return False
         return not self.requests.empty()
 
+    def put_requests(self, reqs: Any):
+        """put requests, should be called in the event loop of the loop
+        task."""
+        self.requests.put_nowait(reqs)
+        self._requests_event.set()
+
+    async def wait_requests(self):
+        """wait until there are unprocessed requests."""
+        event = self._requests_event
+        while not self.has_requests():
+            event.clear()
+            await event.wait()
+
+    def notify_thread_requests(self):
+        """wake up the request loop in threadsafe mode."""
+        event = self._thread_requests_event
+        if event is None or event.is_set():
+            return
+        self._thread_event_loop.call_soon_threadsafe(event.set)
+
     def get_all_requests(self) -> Dict[RequestType, Request]:
         """get all requests in current queue."""
         num_reqs = self.requests.qsize()
@@ -0,0 +1,340 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from typing import List
+
+import numpy as np
+import torch
+
+from lmdeploy.utils import get_logger
+
+from ..config import SpeculativeConfig
+from ..messages import SchedulerSequence
+from ..model_inputs import ModelInputs
+from .logits_process import SamplingInputs
+
+logger = get_logger('lmdeploy')
+
+SeqList = List[SchedulerSequence]
+
+_EMPTY_TOKEN = np.empty((0, ), dtype=np.int64)
+
+
+class BaseDrafter:
+    """Propose draft tokens to be verified by the target model."""
+
+    def propose(self, seqs: SeqList, num_tokens: List[int]):
+        """propose at most `num_tokens[i]` tokens for each sequence."""
+        return [
+            self.propose_one(seq, num) if num > 0 else _EMPTY_TOKEN
+            for seq, num in zip(seqs, num_tokens)
+        ]
+
+    def propose_one(self, seq: SchedulerSequence, num_tokens: int):
+        """propose tokens of one sequence."""
+        raise NotImplementedError('Not implemented.')
+
+
+class NGramDrafter(BaseDrafter):
+    """Prompt lookup drafter.
+
+    The last n tokens of the sequence are matched against its history, the
+    tokens following the first match are proposed. It costs nothing to run
+    and works well when the outputs copy the prompts, such as code editing
+    and retrieval augmented generation.
+    """
+
+    def __init__(self, max_ngram_size: int = 3, min_ngram_size: int = 1):
+        assert max_ngram_size >= min_ngram_size > 0
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+
+    def propose_one(self, seq: SchedulerSequence, num_tokens: int):
+        """propose tokens of one sequence."""
+        return self.lookup(seq.all_ids, num_tokens)
+
+    def lookup(self, token_ids: np.ndarray, num_tokens: int):
+        """lookup the continuation of the suffix in the token ids."""
+        num_ids = len(token_ids)
+        for ngram_size in range(self.max_ngram_size, self.min_ngram_size - 1,
+                                -1):
+            if num_ids <= ngram_size:
+                continue
+            suffix = token_ids[num_ids - ngram_size:]
+            # start of windows that end before the suffix
+            starts = np.flatnonzero(token_ids[:num_ids -
+                                              ngram_size] == suffix[0])
+            for offset in range(1, ngram_size):
+                if len(starts) == 0:
+                    break
+                starts = starts[token_ids[starts + offset] == suffix[offset]]
+            if len(starts) > 0:
+                start = starts[0] + ngram_size
+                return token_ids[start:start + num_tokens]
+        return _EMPTY_TOKEN
+
+
+@dataclass
+class _DraftState:
+    """caches of a sequence in the draft model."""
+    past_key_values: object
+    token_ids: np.ndarray
+
+
+class DraftModelDrafter(BaseDrafter):
+    """Greedy decoding with a small draft model sharing the vocabulary of the
+    target model.
+
+    The draft model keeps its own caches of the sequences, the caches of the
+    rejected tokens are cropped before the next proposal.
+    """
+
+    def __init__(self,
+                 model_path: str,
+                 trust_remote_code: bool = True,
+                 max_cached_seqs: int = 256):
+        from transformers import AutoModelForCausalLM
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype='auto',
+            trust_remote_code=trust_remote_code).cuda().eval()
+        self.max_cached_seqs = max_cached_seqs
+        self._states: OrderedDict[int, _DraftState] = OrderedDict()
+
+    def _get_state(self, seq_id: int):
+        """get the caches of the sequence, least recently used caches are
+        dropped."""
+        from transformers import DynamicCache
+        state = self._states.pop(seq_id, None)
+        if state is None:
+            state = _DraftState(DynamicCache(), _EMPTY_TOKEN)
+        self._states[seq_id] = state
+        while len(self._states) > self.max_cached_seqs:
+            self._states.popitem(last=False)
+        return state
+
+    @torch.inference_mode()
+    def propose_one(self, seq: SchedulerSequence, num_tokens: int):
+        """propose tokens of one sequence."""
+        token_ids = seq.all_ids
+        state = self._get_state(seq.seq_id)
+
+        # rollback the caches to the common prefix, the last token is always
+        # fed to get the logits.
+        cached_ids = state.token_ids
+        num_cached = min(len(cached_ids), len(token_ids) - 1)
+        matched = cached_ids[:num_cached] == token_ids[:num_cached]
+        if not matched.all():
+            num_cached = int(np.argmin(matched))
+        state.past_key_values.crop(num_cached)
+
+        input_ids = torch.from_numpy(token_ids[num_cached:]).cuda()[None]
+        outputs = []
+        for _ in range(num_tokens):
+            logits = self.model(input_ids=input_ids,
+                                past_key_values=state.past_key_values,
+                                use_cache=True).logits
+            next_token_id = logits[0, -1].argmax()
+            outputs.append(next_token_id)
+            input_ids = next_token_id.view(1, 1)
+        draft_ids = torch.stack(outputs).cpu().numpy()
+        # the last draft token has not been fed.
+        state.token_ids = np.concatenate([token_ids, draft_ids[:-1]])
+        return draft_ids
+
+
+@dataclass
+class SpecDecodingMetrics:
+    """Metrics of speculative decoding."""
+    num_steps: int = 0
+    num_draft_tokens: int = 0
+    num_accepted_tokens: int = 0
+    num_emitted_tokens: int = 0
+
+    @property
+    def acceptance_rate(self):
+        """ratio of the accepted draft tokens."""
+        if self.num_draft_tokens == 0:
+            return 0.0
+        return self.num_accepted_tokens / self.num_draft_tokens
+
+    @property
+    def mean_emitted_tokens(self):
+        """mean emitted tokens per sequence per step."""
+        if self.num_steps == 0:
+            return 0.0
+        return self.num_emitted_tokens / self.num_steps
+
+
+@dataclass
+class SpecStepOutput:
+    """Output of a verification step."""
+    draft_token_ids: List[np.ndarray]
+    token_ids: List[np.ndarray]
+
+
+def make_verify_inputs(seqs: SeqList, inputs: ModelInputs,
+                       draft_token_ids: List[np.ndarray]):
+    """make inputs to verify the draft tokens of the decoding sequences in one
+    forward."""
+    token_ids = [
+        np.concatenate([seq.token_ids, draft])
+        for seq, draft in zip(seqs, draft_token_ids)
+    ]
+    seq_length = torch.tensor([len(ids) for ids in token_ids])
+    input_ids = torch.from_numpy(np.concatenate(token_ids))[None]
+    return ModelInputs(
+        input_ids=input_ids,
+        seq_length=seq_length,
+        history_lengths=inputs.history_lengths,
+        block_offsets=inputs.block_offsets,
+        is_decoding=False,
+        num_ignored_history=inputs.num_ignored_history,
+        local_adapter_ids=inputs.local_adapter_ids,
+        adapter_info=inputs.adapter_info,
+    )
+
+
+def get_verify_indices(inputs: ModelInputs, num_rows: torch.Tensor):
+    """indices of the tokens whose logits are used in verification."""
+    ends = inputs.seq_length.cumsum(0)
+    offsets = torch.arange(num_rows.sum().item())
+    starts = (num_rows.cumsum(0) - num_rows).repeat_interleave(num_rows)
+    return (ends - num_rows).repeat_interleave(num_rows) + offsets - starts
+
+
+def expand_sampling_inputs(sampling_inputs: SamplingInputs,
+                           num_rows: torch.Tensor):
+    """repeat the sampling inputs of each sequence for its verified tokens."""
+    total = num_rows.sum().item()
+    starts = (num_rows.cumsum(0) - num_rows).repeat_interleave(num_rows)
+    positions = torch.arange(total) - starts
+
+    out_dict = dict()
+    for field in fields(sampling_inputs):
+        key = field.name
+        value = getattr(sampling_inputs, key)
+        if isinstance(value, torch.Tensor) and value.dim() > 0:
+            value = value.repeat_interleave(num_rows, 0)
+        elif key in ('response_formats', 'logits_processors'):
+            if value is not None:
+                value = type(value)(v for v, num in zip(value, num_rows)
+                                    for _ in range(num))
+        out_dict[key] = value
+    out = SamplingInputs(**out_dict)
+    if out.random_offsets is not None:
+        # each position should draw a different random number.
+        out.random_offsets = out.random_offsets + positions
+    return out
+
+
+def accept_draft_tokens(draft_token_ids: List[np.ndarray],
+                        next_token_ids: np.ndarray):
+    """Accept the longest prefix of the drafts that matches the sampled
+    tokens, plus the sampled token after it.
+
+    Every sampled token follows the distribution of the target model given
+    the tokens before it, so the accepted tokens are distributed exactly as
+    if they were generated one by one.
+    """
+    outputs = []
+    start = 0
+    for draft in draft_token_ids:
+        num_rows = len(draft) + 1
+        sampled = next_token_ids[start:start + num_rows]
+        matched = sampled[:-1] == draft
+        num_accepted = len(draft)
+        if not matched.all():
+            num_accepted = int(np.argmin(matched))
+        outputs.append(sampled[:num_accepted + 1])
+        start += num_rows
+    return outputs
+
+
+class SpecDecoder:
+    """Speculative decoding.
+
+    Args:
+        config (SpeculativeConfig): the config.
+        drafter (BaseDrafter): the drafter to propose tokens.
+        max_num_tokens (int): max tokens of a verification forward.
+    """
+
+    def __init__(self,
+                 config: SpeculativeConfig,
+                 drafter: BaseDrafter,
+                 max_num_tokens: int,
+                 log_interval: float = 10.0):
+        self.config = config
+        self.drafter = drafter
+        self.max_num_tokens = max_num_tokens
+        self.log_interval = log_interval
+        self.metrics = SpecDecodingMetrics()
+        self._last_log_time = time.perf_counter()
+
+    @classmethod
+    def build(cls,
+              config: SpeculativeConfig,
+              max_num_tokens: int,
+              trust_remote_code: bool = True):
+        """build speculative decoder."""
+        if config.method == 'ngram':
+            drafter = NGramDrafter(config.max_ngram_size,
+                                   config.min_ngram_size)
+        elif config.method == 'draft_model':
+            assert config.draft_model is not None, (
+                '`draft_model` is required by method `draft_model`.')
+            drafter = DraftModelDrafter(config.draft_model,
+                                        trust_remote_code=trust_remote_code)
+        else:
+            raise ValueError(
+                f'Unsupported speculative method: {config.method}')
+        return cls(config, drafter, max_num_tokens)
+
+    @property
+    def num_speculative_tokens(self):
+        """max draft tokens per step."""
+        return self.config.num_speculative_tokens
+
+    def is_supported(self, inputs: ModelInputs,
+                     sampling_inputs: SamplingInputs, guided_states: List,
+                     return_logits: bool):
+        """Sampling options that depend on the previous tokens of the step
+        are not supported in verification."""
+        if not inputs.is_decoding or inputs.vision_inputs is not None:
+            return False
+        if return_logits or guided_states is not None:
+            return False
+        if sampling_inputs.repetition_penalty is not None:
+            return False
+        if any(sampling_inputs.logits_processors or ()):
+            return False
+        batch_size = inputs.seq_length.size(0)
+        return (batch_size *
+                (self.num_speculative_tokens + 1) <= self.max_num_tokens)
+
+    def propose(self, seqs: SeqList, num_tokens: List[int]):
+        """propose draft tokens."""
+        num_tokens = [
+            min(num, self.num_speculative_tokens) for num in num_tokens
+        ]
+        return self.drafter.propose(seqs, num_tokens)
+
+    def update_metrics(self, output: SpecStepOutput):
+        """update metrics."""
+        metrics = self.metrics
+        for draft, token_ids in zip(output.draft_token_ids, output.token_ids):
+            metrics.num_steps += 1
+            metrics.num_draft_tokens += len(draft)
+            metrics.num_accepted_tokens += len(token_ids) - 1
+            metrics.num_emitted_tokens += len(token_ids)
+
+        now = time.perf_counter()
+        if now - self._last_log_time >= self.log_interval:
+            self._last_log_time = now
+            logger.info('Speculative decoding: '
+                        f'acceptance rate={metrics.acceptance_rate:.2%}, '
+                        f'tokens per step={metrics.mean_emitted_tokens:.2f}, '
+                        f'draft tokens={metrics.num_draft_tokens}, '
+                        f'accepted tokens={metrics.num_accepted_tokens}')
@@ -49,6 +49,9 @@ class SamplingParam:
     min_new_tokens: int = 0
     response_format: Optional[str] = None
     logits_processors: Optional[List[LogitsProcessor]] = None
+    priority: int = 0
+    deadline: Optional[float] = None
+    n: int = 1
 
     @classmethod
     def from_gen_config(self, gen_config: GenerationConfig):
@@ -68,6 +71,8 @@ class SamplingParam:
         repetition_penalty = gen_config.repetition_penalty
         max_new_tokens = gen_config.max_new_tokens
         response_format = gen_config.response_format
+        priority = gen_config.priority
+        deadline = gen_config.deadline
 
         if top_p < 0 or top_p > 1.0:
             logger.warning('`top_p` has to be a float > 0 and < 1'
@@ -97,6 +102,10 @@ class SamplingParam:
                            'a int >=0 and <= `max_new_tokens`,'
                            f' but is {min_new_tokens}')
             min_new_tokens = 0
+        if deadline is not None and deadline <= 0:
+            logger.warning('`deadline` has to be a strictly'
+                           f' positive value, but is {deadline}')
+            deadline = None
         return SamplingParam(top_p=top_p,
                              top_k=top_k,
                              min_p=min_p,
@@ -109,7 +118,10 @@ class SamplingParam:
                              response_format=response_format,
                              max_new_tokens=max_new_tokens,
                              min_new_tokens=min_new_tokens,
-                             logits_processors=gen_config.logits_processors)
+                             logits_processors=gen_config.logits_processors,
+                             priority=priority,
+                             deadline=deadline,
+                             n=gen_config.n)
 
 
 class MessageStatus(enum.Enum):
@@ -225,6 +237,7 @@ class SchedulerSession:
             sampling_param=sampling_param,
             adapter_name=adapter_name,
             arrive_time=time.time(),
+            request_time=time.time(),
             history_embeddings=HistoryEmbeddings(input_embeddings),
             return_logits=return_logits)
         self.sequences[seq.seq_id] = seq
@@ -232,6 +245,29 @@ class SchedulerSession:
             self.seq_manager.add_sequence(seq)
         return seq
 
+    def fork_sequence(self, seq: 'SchedulerSequence', index: int,
+                      sampling_param: SamplingParam) -> 'SchedulerSequence':
+        """Fork a sequence with the same tokens, the caches are not shared
+        until the block manager forks them."""
+        new_seq = SchedulerSequence(
+            seq_id=_new_msg_id(),
+            session=self,
+            history_cache=HistoryTokenIds(seq.all_ids.copy()),
+            num_new_tokens=seq.num_new_tokens,
+            sampling_param=sampling_param,
+            sender_id=seq.sender_id,
+            req_id=seq.req_id,
+            adapter_name=seq.adapter_name,
+            arrive_time=seq.arrive_time,
+            history_embeddings=seq.history_embeddings.clone(),
+            return_logits=seq.return_logits,
+            random_offsets=seq.random_offsets,
+            index=index)
+        self.sequences[new_seq.seq_id] = new_seq
+        if self.seq_manager is not None:
+            self.seq_manager.add_sequence(new_seq)
+        return new_seq
+
     def remove_sequence(self, seq: 'SchedulerSequence'):
         """remove sequence."""
         assert seq.seq_id in self.sequences
@@ -371,11 +407,15 @@ class SchedulerSequence:
     req_id: int = -1
     adapter_name: str = None
     arrive_time: float = 0.0
+    # arrival of the request, cleared once the request is scheduled
+    request_time: float = 0.0
     meta: Any = None
     return_logits: bool = False
     random_offsets: int = 0
     _status: MessageStatus = field(default=MessageStatus.WAITING, init=False)
     num_ignored_history: int = 0
+    guided_state: Any = None
+    index: int = 0
 
     def __post_init__(self):
         """post init."""
@@ -1,13 +1,19 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import time
-from typing import Dict, Union
+from typing import Callable, Dict, List, Union
 
 import numpy as np
 
 from ...adapter.adapter import AdapterManager, SchedulerAdapter
+from ...block import LogicalTokenBlocks
 from ...messages import SchedulerSequence
 
 
+def _div_up(x, n):
+    """perform div up."""
+    return (x + n - 1) // n
+
+
 class LogicalMemory:
     """Logical memory blocks."""
 
@@ -111,6 +117,12 @@ class LogicalAllocator:
         self._free_blocks = np.arange(num_blocks)
         self._free_count = num_blocks
 
+        self._release_callbacks: List[Callable[[np.ndarray], None]] = []
+
+    def add_release_callback(self, callback: Callable[[np.ndarray], None]):
+        """add callback on blocks whose ref count drops to 1."""
+        self._release_callbacks.append(callback)
+
     def get_phy_allocator(self, device: str):
         """get allocator."""
         if device == 'gpu':
@@ -145,6 +157,11 @@ class LogicalAllocator:
         self.add_ref_count(blocks, -1)
         self.update_access_time(blocks)
         ref_count = self.get_ref_count(blocks)
+        if len(self._release_callbacks) > 0:
+            released_blocks = blocks[ref_count == 1]
+            if len(released_blocks) > 0:
+                for callback in self._release_callbacks:
+                    callback(released_blocks)
         freed_blocks = blocks[ref_count == 0]
         num_freed_blocks = len(freed_blocks)
         if num_freed_blocks <= 0:
@@ -309,10 +326,59 @@ class BaseBlockManager:
         else:
             raise TypeError(f'Unsupported allocate type: {type(data)}')
 
+    def fork(self, src: SchedulerSequence, dst: SchedulerSequence):
+        """Share the blocks of src with dst."""
+        num_blocks = _div_up(dst.num_all_ids, dst.block_size)
+        blocks = src.logical_blocks[:num_blocks]
+        logical_blocks = LogicalTokenBlocks()
+        logical_blocks.append(blocks)
+        logical_blocks.last_shared_node = src.logical_blocks.last_shared_node
+        dst.logical_blocks = logical_blocks
+        self.allocator.add_ref_count(blocks, 1)
+
+    def _get_shared_write_blocks(self, msg: SchedulerSequence):
+        """indices of the shared blocks that new tokens would be written to."""
+        start = msg.history_len // msg.block_size
+        end = min(_div_up(msg.num_all_ids, msg.block_size),
+                  len(msg.logical_blocks))
+        if start >= end:
+            return np.empty((0, ), dtype=np.int64)
+        ref_count = self.allocator.get_ref_count(msg.logical_blocks[start:end])
+        return np.flatnonzero(ref_count > 1) + start
+
+    def num_copy_blocks(self, msg: SchedulerSequence):
+        """get num blocks to be copied before writing."""
+        return len(self._get_shared_write_blocks(msg))
+
+    def copy_on_write(self, msg: SchedulerSequence):
+        """Give the sequence its own copies of the shared blocks it would
+        write to.
+
+        Returns:
+            Dict[int, int]: Map between the src and dst physical blocks.
+        """
+        indices = self._get_shared_write_blocks(msg)
+        if len(indices) == 0:
+            return dict()
+        logical_blocks = msg.logical_blocks
+        src_blocks = logical_blocks[indices].copy()
+        dst_blocks = self.allocator.allocate(len(indices), 'gpu')
+        logical_blocks[indices] = dst_blocks
+        src_phy = self.allocator.get_physical_blocks(src_blocks)
+        dst_phy = self.allocator.get_physical_blocks(dst_blocks)
+        self.allocator.free(src_blocks)
+        return dict(zip(src_phy.tolist(), dst_phy.tolist()))
+
     def get_num_free_gpu_blocks(self) -> int:
         """Get number of free gpu blocks."""
         return self.allocator.get_phy_allocator('gpu').get_num_free_blocks()
 
+    def get_gpu_usage(self) -> float:
+        """Get the ratio of the used gpu blocks."""
+        if self.num_gpu_blocks == 0:
+            return 0.0
+        return 1.0 - self.get_num_free_gpu_blocks() / self.num_gpu_blocks
+
     def get_num_free_cpu_blocks(self) -> int:
         """Get number of free cpu blocks."""
         return self.allocator.get_phy_allocator('cpu').get_num_free_blocks()
@@ -1,6 +1,7 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import heapq
-from typing import Dict, Set
+import zlib
+from typing import Dict, List, Set, Tuple
 
 import numpy as np
 
@@ -9,19 +10,83 @@ from lmdeploy.pytorch.messages import SchedulerSequence
 from ..config import CacheConfig
 from .block_manager import BaseBlockManager
 
+_HASH_MUL = 0x9E3779B97F4A7C15
+_HASH_MUL_INV = pow(_HASH_MUL, -1, 1 << 64)
+_TOKEN_MUL = 0xC2B2AE3D27D4EB4F
+
+
+def _power_table(base: int, size: int):
+    """base**[0, size) modulo 2**64."""
+    table = np.full((size, ), base, dtype=np.uint64)
+    table[0] = 1
+    return np.cumprod(table, dtype=np.uint64)
+
+
+def _mix(x: np.ndarray):
+    """splitmix64 finalizer, breaks the linearity of the polynomial hash."""
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class BlockHasher:
+    """chained block hasher.
+
+    The key of the i-th block is `key[i] = key[i-1] * P + h(block[i])`
+    modulo 2**64, so a key identifies the whole prefix it ends. Keys of
+    successive blocks are computed in one vectorized pass:
+    `key[k] = P**k * (key[0] + cumsum(h(block[j]) * P**-j))`.
+    """
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._token_pows = _power_table(_TOKEN_MUL, block_size)
+        self._pows = _power_table(_HASH_MUL, 1)
+        self._inv_pows = _power_table(_HASH_MUL_INV, 1)
+
+    def _reserve(self, size: int):
+        """reserve power tables."""
+        if len(self._pows) >= size:
+            return
+        size = max(size, len(self._pows) * 2)
+        self._pows = _power_table(_HASH_MUL, size)
+        self._inv_pows = _power_table(_HASH_MUL_INV, size)
+
+    def hash_blocks(self, tokens: np.ndarray):
+        """hash of each full block, tokens are not chained."""
+        block_size = self.block_size
+        tokens = tokens.astype(np.uint64).reshape(-1, block_size)
+        return _mix(_mix(tokens) @ self._token_pows)
+
+    def __call__(self, parent_key: int, tokens: np.ndarray):
+        """chained keys of the full blocks in tokens."""
+        num_blocks = len(tokens) // self.block_size
+        if num_blocks == 0:
+            return []
+        tokens = tokens[:num_blocks * self.block_size]
+        self._reserve(num_blocks + 1)
+        with np.errstate(over='ignore'):
+            block_hash = self.hash_blocks(tokens)
+            block_hash *= self._inv_pows[1:num_blocks + 1]
+            keys = np.cumsum(block_hash, dtype=np.uint64)
+            keys += np.uint64(parent_key)
+            keys *= self._pows[1:num_blocks + 1]
+        return keys.tolist()
+
 
 class Node:
     """node of block trie."""
 
-    def __init__(self,
-                 hash_key: int,
-                 block: int,
-                 tokens: np.ndarray,
-                 num_matched: int = 0):
+    __slots__ = ('hash_key', 'block', 'num_matched', 'on_host', 'children',
+                 '_parent')
+
+    def __init__(self, hash_key: int, block: int, num_matched: int = 0):
         self.hash_key = hash_key
         self.block = block
-        self.tokens = tokens
         self.num_matched = num_matched
+        self.on_host = False
         self.children: Dict[int, 'Node'] = dict()
         self._parent: 'Node' = None
 
@@ -38,6 +103,10 @@ class Node:
             val.children[self.hash_key] = self
         self._parent = val
 
+    def is_device_leaf(self):
+        """node without children on device."""
+        return all(child.on_host for child in self.children.values())
+
     def __lt__(self, other):
         return True
 
@@ -45,8 +114,69 @@ class Node:
         return True
 
 
+class LRUIndex:
+    """least recently used nodes, ordered by access time.
+
+    Entries in the heap are invalid if the stamp mismatch, they are dropped
+    lazily.
+    """
+
+    def __init__(self):
+        self._stamps: Dict[Node, int] = dict()
+        self._heap: List[Tuple[int, int, Node]] = []
+        self._stamp = 0
+
+    def __len__(self):
+        return len(self._stamps)
+
+    def __contains__(self, node: Node):
+        return node in self._stamps
+
+    def add(self, node: Node, access_time: int):
+        """add node."""
+        self._stamp += 1
+        self._stamps[node] = self._stamp
+        heapq.heappush(self._heap, (access_time, self._stamp, node))
+
+        # drop invalid entries
+        if len(self._heap) > 2 * len(self._stamps) + 64:
+            self._heap = [
+                entry for entry in self._heap
+                if self._stamps.get(entry[2]) == entry[1]
+            ]
+            heapq.heapify(self._heap)
+
+    def discard(self, node: Node):
+        """remove node."""
+        self._stamps.pop(node, None)
+
+    def pop(self):
+        """pop least recently used node."""
+        heap = self._heap
+        stamps = self._stamps
+        while len(heap) > 0:
+            _, stamp, node = heapq.heappop(heap)
+            if stamps.get(node) == stamp:
+                stamps.pop(node)
+                return node
+        return None
+
+
 class BlockTrie:
-    """block trie for prefix caching."""
+    """block trie for prefix caching.
+
+    Nodes are indexed by the chained key of the prefix they end, so matching
+    a prefix is a binary search over the keys of the sequence.
+
+    Nodes only referenced by the trie (ref-cnt == 1) without children on
+    device are evictable. They are kept in a LRU index which is updated when
+    the ref count of a node changes, so eviction does not have to scan all
+    leaves.
+
+    With host prefix cache, evicted nodes are demoted to host blocks instead
+    of being dropped, and promoted back when they are matched. Descendants of
+    a node on host are always on host.
+    """
 
     def __init__(self, cache_config: CacheConfig,
                  block_manager: BaseBlockManager):
@@ -55,57 +185,222 @@ class BlockTrie:
         self.allocator = self.block_manager.allocator
         self.block_size = cache_config.block_size
         self.enable = self.cache_config.enable_prefix_caching
+        self.enable_host = (self.enable
+                            and cache_config.enable_host_prefix_cache
+                            and cache_config.num_cpu_blocks > 0)
+        self.hasher = BlockHasher(self.block_size)
 
         # caches with different adapter should not be shared.
         self._roots: Dict[str, Node] = dict()
+        self._nodes: Dict[int, Node] = dict()
+        self._block_nodes: Dict[int, Node] = dict()
         self.leaves: Set[Node] = set()
 
+        self._device_lru = LRUIndex()
+        self._host_lru = LRUIndex()
+
+        # prompt tokens looked up and found in the cache
+        self.num_query_tokens = 0
+        self.num_hit_tokens = 0
+        if self.enable:
+            self.allocator.add_release_callback(self._on_release)
+
     def get_root(self, adapter_name: str):
         """get root by adapter name."""
         if adapter_name not in self._roots:
-            self._roots[adapter_name] = Node(-1, -1, None)
+            # roots of different adapters start different key chains.
+            root_key = zlib.crc32(str(adapter_name).encode())
+            self._roots[adapter_name] = Node(root_key, -1)
         return self._roots[adapter_name]
 
-    def match(self, seq: SchedulerSequence):
-        """match sequence and cache."""
+    def get_node(self, hash_key: int):
+        """get node by hash key."""
+        return self._nodes.get(hash_key, None)
+
+    @property
+    def num_evictable(self):
+        """number of evictable device blocks."""
+        return len(self._device_lru)
+
+    @property
+    def num_host_blocks(self):
+        """number of blocks on host."""
+        return len(self._host_lru)
+
+    @property
+    def hit_rate(self):
+        """ratio of the prompt tokens found in the cache."""
+        if self.num_query_tokens == 0:
+            return 0.0
+        return self.num_hit_tokens / self.num_query_tokens
+
+    def _get_access_time(self, node: Node):
+        """get access time of node."""
+        return int(self.allocator.get_access_time(node.block))
+
+    def _add_node(self, node: Node, parent: Node):
+        """add node to trie."""
+        self._device_lru.discard(parent)
+        if len(parent.children) == 0 and parent.parent is not None:
+            self.leaves.discard(parent)
+        node.parent = parent
+        self._nodes[node.hash_key] = node
+        self._block_nodes[node.block] = node
+
+    def _remove_node(self, node: Node, free_blocks: List[int]):
+        """remove node and descendants from trie."""
+        for child in list(node.children.values()):
+            self._remove_node(child, free_blocks)
+        self._device_lru.discard(node)
+        self._host_lru.discard(node)
+        self.leaves.discard(node)
+        parent = node.parent
+        node.parent = None
+        self._nodes.pop(node.hash_key, None)
+        self._block_nodes.pop(node.block, None)
+        free_blocks.append(node.block)
+
+        if parent.parent is None:
+            # ignore root
+            return
+        if len(parent.children) == 0:
+            self.leaves.add(parent)
+            if parent.on_host:
+                self._host_lru.add(parent, self._get_access_time(parent))
+        self._try_add_device_evictable(parent)
+
+    def _try_add_device_evictable(self, node: Node):
+        """add node to device lru if it is evictable."""
+        if node.on_host or node in self._device_lru:
+            return
+        if not node.is_device_leaf():
+            return
+        if self.allocator.get_ref_count(node.block) != 1:
+            return
+        self._device_lru.add(node, self._get_access_time(node))
+
+    def _on_release(self, blocks: np.ndarray):
+        """blocks are only referenced by the trie."""
+        block_nodes = self._block_nodes
+        nodes = [block_nodes.get(block) for block in blocks.tolist()]
+        nodes = [
+            node for node in nodes
+            if node is not None and not node.on_host and node.is_device_leaf()
+        ]
+        if len(nodes) == 0:
+            return
+        access_times = self.allocator.get_access_time(
+            np.array([node.block for node in nodes]))
+        for node, access_time in zip(nodes, access_times.tolist()):
+            self._device_lru.add(node, access_time)
+
+    def _move_block(self, node: Node, device: str):
+        """move physical block of the node, return (src, dst)."""
+        allocator = self.allocator
+        src_device = 'cpu' if device == 'gpu' else 'gpu'
+        src_allocator = allocator.get_phy_allocator(src_device)
+        dst_allocator = allocator.get_phy_allocator(device)
+        block = np.array([node.block])
+        src_phy = allocator.get_physical_blocks(block)
+        dst_phy = dst_allocator.allocate(1)
+        src_allocator.free(src_phy)
+        allocator.update_phy_map(block, dst_phy)
+        node.on_host = device == 'cpu'
+        return int(src_phy[0]), int(dst_phy[0])
+
+    def _promote(self, node: Node, swap_in_map: Dict[int, int]):
+        """move node from host to device."""
+        self._host_lru.discard(node)
+        src, dst = self._move_block(node, 'gpu')
+        swap_in_map[src - self.allocator.cpu_mem_offset()] = dst
+
+    def _demote(self, node: Node, swap_out_map: Dict[int, int]):
+        """move node from device to host, return False if host is full."""
+        cpu_allocator = self.allocator.get_phy_allocator('cpu')
+        if cpu_allocator.get_num_free_blocks() == 0:
+            # ancestors are demoted after descendants and are more valuable.
+            # If the evicted host block was demoted in the same step, the
+            # later copy in swap_out_map overwrites it.
+            if self.evict_host(1) == 0:
+                return False
+        src, dst = self._move_block(node, 'cpu')
+        swap_out_map[src] = dst - self.allocator.cpu_mem_offset()
+        # evicting host leaves might make the node evictable again.
+        self._device_lru.discard(node)
+        if len(node.children) == 0:
+            self._host_lru.add(node, self._get_access_time(node))
+        return True
+
+    def match(self,
+              seq: SchedulerSequence,
+              swap_in_map: Dict[int, int] = None):
+        """match sequence and cache.
+
+        Args:
+            seq (SchedulerSequence): sequence to match.
+            swap_in_map (Dict[int, int]): nodes on host would be swapped in
+                if given, else the matching stops at them.
+        """
         if not self.enable:
             return
 
         block_size = self.block_size
-        matched_blocks = []
 
         logical_blocks = seq.logical_blocks
         curr: Node = getattr(logical_blocks, 'last_shared_node', None)
-        if curr is None:
+        is_first_match = curr is None
+        if is_first_match:
             curr = self.get_root(seq.adapter_name)
         num_matched = curr.num_matched
 
-        def __match_success(node: Node):
-            nonlocal curr, num_matched
-            matched_blocks.append(node.block)
+        # matched blocks can only be appended right after the shared blocks,
+        # sequence that has allocated its own blocks (partially prefilled)
+        # should not be matched again.
+        if len(logical_blocks) != num_matched // block_size:
+            return
+        if is_first_match:
+            self.num_query_tokens += seq.num_all_ids - 1
+
+        # at least one token should be left to prefill.
+        tokens = seq.history_cache[num_matched:seq.num_all_ids - 1]
+        keys = self.hasher(curr.hash_key, tokens)
+
+        # every prefix of a cached prefix is cached, find the longest one.
+        nodes = self._nodes
+        lo, hi = 0, len(keys)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if keys[mid - 1] in nodes:
+                lo = mid
+            else:
+                hi = mid - 1
+
+        gpu_allocator = self.allocator.get_phy_allocator('gpu')
+        matched_nodes: List[Node] = []
+        for key in keys[:lo]:
+            node = nodes[key]
+            if node.parent is not curr:
+                # hash collision
+                break
+            if node.on_host:
+                if swap_in_map is None:
+                    break
+                if gpu_allocator.get_num_free_blocks() == 0:
+                    break
+                self._promote(node, swap_in_map)
+            matched_nodes.append(node)
             curr = node
             num_matched += block_size
 
-        while num_matched + block_size < seq.num_all_ids:
-            curr_tokens = seq.history_cache[num_matched:num_matched +
-                                            block_size]
-
-            key = hash(tuple(curr_tokens))
-            if key not in curr.children:
-                break
-
-            child = curr.children[key]
-            if not np.array_equal(curr_tokens, child.tokens):
-                break
-
-            __match_success(child)
-
-        if len(matched_blocks) > 0:
-            matched_blocks = np.array(matched_blocks)
+        if len(matched_nodes) > 0:
+            for node in matched_nodes:
+                self._device_lru.discard(node)
+            matched_blocks = np.array([node.block for node in matched_nodes])
             self.allocator.update_access_time(matched_blocks)
             self.allocator.add_ref_count(matched_blocks, 1)
             seq.logical_blocks.append(matched_blocks)
             seq.set_step(num_matched)
+            self.num_hit_tokens += len(matched_nodes) * block_size
 
         seq.logical_blocks.last_shared_node = curr
 
@@ -127,33 +422,39 @@ class BlockTrie:
         if num_matched + block_size > num_all_ids:
             return
 
-        if len(node.children) == 0 and node.parent is not None:
-            self.leaves.remove(node)
+        tokens = seq.history_cache[num_matched:num_all_ids]
+        keys = self.hasher(node.hash_key, tokens)
 
         block_id = num_matched // block_size
         blocks = []
         free_blocks = []
-        while num_matched + block_size <= num_all_ids:
-            curr_tokens = seq.history_cache[num_matched:num_matched +
-                                            block_size]
-
+        for hash_key in keys:
             block = logical_blocks[block_id]
 
-            hash_key = hash(tuple(curr_tokens))
             parent = node
-            if hash_key in parent.children:
-                child = parent.children[hash_key]
-                if not np.array_equal(curr_tokens, child.tokens):
+            child = self._nodes.get(hash_key, None)
+            if child is not None:
+                if child.parent is not parent:
+                    # hash collision
                     break
                 node = child
-                free_blocks.append(block)
-                logical_blocks[block_id] = node.block
+                self._device_lru.discard(node)
+                if node.on_host:
+                    # take over the block of the sequence.
+                    self._host_lru.discard(node)
+                    free_blocks.append(node.block)
+                    self._block_nodes.pop(node.block)
+                    node.block = block
+                    node.on_host = False
+                    self._block_nodes[block] = node
+                else:
+                    free_blocks.append(block)
+                    logical_blocks[block_id] = node.block
             else:
                 node = Node(hash_key=hash_key,
                             block=block,
-                            tokens=curr_tokens,
                             num_matched=num_matched + block_size)
-                node.parent = parent
+                self._add_node(node, parent)
             blocks.append(node.block)
             num_matched += block_size
             block_id += 1
@@ -167,50 +468,139 @@ class BlockTrie:
         if len(free_blocks) > 0:
             self.allocator.free(np.array(free_blocks))
 
-    def evict(self, max_num_blocks: int):
-        """evict."""
+    def get_snapshot(self):
+        """get nodes to be saved, parents always come before children.
+
+        Leaves in use are skipped since the cache of the last block might
+        not have been filled yet. Nodes on host are skipped.
+        """
+        adapter_names = list(self._roots.keys())
+        node_ids: Dict[Node, int] = dict()
+        nodes = []
+        parents = []
+        for root_id, adapter_name in enumerate(adapter_names):
+            root = self._roots[adapter_name]
+            node_ids[root] = -1 - root_id
+            queue = list(root.children.values())
+            while len(queue) > 0:
+                node = queue.pop(0)
+                if node.on_host:
+                    continue
+                if len(node.children) == 0:
+                    ref_cnt = self.allocator.get_ref_count(node.block)
+                    if ref_cnt > 1:
+                        continue
+                node_ids[node] = len(nodes)
+                nodes.append(node)
+                parents.append(node_ids[node.parent])
+                queue += list(node.children.values())
+
+        return dict(
+            adapter_names=adapter_names,
+            hash_keys=np.array([node.hash_key for node in nodes],
+                               dtype=np.uint64),
+            parents=np.array(parents, dtype=np.int64),
+            num_matched=np.array([node.num_matched for node in nodes],
+                                 dtype=np.int64),
+            blocks=np.array([node.block for node in nodes], dtype=np.int64),
+        )
+
+    def load_snapshot(self, snapshot: Dict, blocks: np.ndarray):
+        """load nodes from snapshot.
+
+        Args:
+            snapshot (Dict): snapshot from `get_snapshot`, nodes might be
+                truncated but parents should always be kept.
+            blocks (np.ndarray): allocated blocks of the nodes, owned by the
+                trie.
+        """
         if not self.enable:
-            return 0
+            return
+        roots = [self.get_root(name) for name in snapshot['adapter_names']]
+        hash_keys = snapshot['hash_keys'].tolist()
+        parents = snapshot['parents'].tolist()
+        num_matched = snapshot['num_matched'].tolist()
+        nodes = []
+        free_blocks = []
+        for idx, block in enumerate(blocks.tolist()):
+            parent_id = parents[idx]
+            if parent_id >= 0:
+                parent = nodes[parent_id]
+            else:
+                parent = roots[-1 - parent_id]
+            if parent is None or hash_keys[idx] in self._nodes:
+                # parent dropped or conflict with existing node
+                nodes.append(None)
+                free_blocks.append(block)
+                continue
+            node = Node(hash_key=hash_keys[idx],
+                        block=block,
+                        num_matched=num_matched[idx])
+            self._add_node(node, parent)
+            nodes.append(node)
 
-        def __remove_leaf(leaves, evicted_blocks):
-            _, leaf = heapq.heappop(leaves)
-            evicted_blocks.append(leaf.block)
-            parent = leaf.parent
-            leaf.parent = None
-            self.leaves.remove(leaf)
-            return parent
+        if len(free_blocks) > 0:
+            self.allocator.free(np.array(free_blocks))
 
-        def __add_leaf(leaves, parent):
-            self.leaves.add(parent)
-            if self.allocator.get_ref_count(parent.block) == 1:
-                access_time = self.allocator.get_access_time(parent.block)
-                heapq.heappush(leaves, (access_time, parent))
-
-        evicted_blocks = []
-        leaves = list(self.leaves)
-
-        # filter ref-cnt == 1 (trie own one block ref)
-        leave_blocks = np.array(list(leaf.block for leaf in leaves))
-        ref_cnt = self.allocator.get_ref_count(leave_blocks)
-        indices = (ref_cnt == 1).nonzero()[0]
-        if len(indices) == 0:
+        new_leaves = [
+            node for node in nodes
+            if node is not None and len(node.children) == 0
+        ]
+        self.leaves.update(new_leaves)
+        if len(new_leaves) > 0:
+            self._on_release(np.array([node.block for node in new_leaves]))
+
+    def evict(self, max_num_blocks: int, swap_out_map: Dict[int, int] = None):
+        """evict device blocks.
+
+        Args:
+            max_num_blocks (int): max number of blocks to evict.
+            swap_out_map (Dict[int, int]): evicted nodes would be demoted to
+                host if given and host prefix cache is enabled.
+
+        Returns:
+            int: number of freed device blocks.
+        """
+        if not self.enable:
             return 0
 
-        # make heap
-        leaves = list(leaves[i] for i in indices)
-        access_times = self.allocator.get_access_time(leave_blocks)
-        access_times = list(access_times[i] for i in indices)
-        leaves = list(zip(access_times, leaves))
-        heapq.heapify(leaves)
-
-        while len(leaves) > 0 and len(evicted_blocks) < max_num_blocks:
-            parent = __remove_leaf(leaves, evicted_blocks)
-            if parent.parent is None:
-                # ignore root
+        demote = self.enable_host and swap_out_map is not None
+        num_evicted = 0
+        free_blocks = []
+        while num_evicted < max_num_blocks:
+            node = self._device_lru.pop()
+            if node is None:
+                break
+            num_evicted += 1
+            if demote and self._demote(node, swap_out_map):
+                parent = node.parent
+                if parent.parent is not None:
+                    self._try_add_device_evictable(parent)
                 continue
-            if len(parent.children) == 0:
-                __add_leaf(leaves, parent)
+            self._remove_node(node, free_blocks)
 
-        self.allocator.free(np.array(evicted_blocks))
+        if len(free_blocks) > 0:
+            self.allocator.free(np.array(free_blocks))
+
+        return num_evicted
+
+    def evict_host(self, max_num_blocks: int):
+        """evict host blocks.
+
+        Returns:
+            int: number of freed host blocks.
+        """
+        if not self.enable_host:
+            return 0
+
+        free_blocks = []
+        while len(free_blocks) < max_num_blocks:
+            node = self._host_lru.pop()
+            if node is None:
+                break
+            self._remove_node(node, free_blocks)
+
+        if len(free_blocks) > 0:
+            self.allocator.free(np.array(free_blocks))
 
-        return len(evicted_blocks)
+        return len(free_blocks)
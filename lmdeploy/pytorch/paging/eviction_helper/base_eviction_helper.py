@@ -1,5 +1,5 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import List
+from typing import Dict, List
 
 from ...messages import SchedulerSequence
 from ..scheduler import Scheduler
@@ -14,13 +14,30 @@ class BaseEvictionHelper:
         self.scheduler = scheduler
         self.block_manager = scheduler.block_manager
         self.block_trie = scheduler.block_trie
+        # running sequences evicted to make room for others
+        self.num_preemptions = 0
 
     def need_swap_in(self, seq: SchedulerSequence):
         """sequence need swap in."""
+        return False
+
+    def swap_in(self, seq: SchedulerSequence, swap_in_map: Dict[int, int]):
+        """swap in sequence."""
         raise NotImplementedError('Not implemented.')
 
-    def evict_for_seq(self, seq: SchedulerSequence,
+    def evict_for_seq(self,
+                      seq: SchedulerSequence,
                       evictable_seqs: List[SchedulerSequence],
-                      prealloc_size: int):
-        """evict seqs."""
+                      prealloc_size: int,
+                      swap_out_map: Dict[int, int] = None):
+        """evict seqs.
+
+        Args:
+            seq (SchedulerSequence): The sequence to allocate blocks for.
+            evictable_seqs (List[SchedulerSequence]): Candidates in eviction
+                order.
+            prealloc_size (int): Number of tokens to preallocate.
+            swap_out_map (Dict[int, int]): Output swap out map, swapping
+                out is not allowed if it is None.
+        """
         raise NotImplementedError('Not implemented.')
@@ -1,21 +1,24 @@
 # Copyright (c) OpenMMLab. All rights reserved.
-from typing import List
+from typing import Dict, List
 
-from ...messages import SchedulerSequence
+from ...messages import MessageStatus, SchedulerSequence
 from .base_eviction_helper import BaseEvictionHelper
 
 
 class RecomputeEvictionHelper(BaseEvictionHelper):
     """recompute eviction."""
 
-    def evict_for_seq(self, seq: SchedulerSequence,
+    def evict_for_seq(self,
+                      seq: SchedulerSequence,
                       evictable_seqs: List[SchedulerSequence],
-                      prealloc_size: int):
+                      prealloc_size: int,
+                      swap_out_map: Dict[int, int] = None):
         """evict seqs."""
         block_manager = self.block_manager
         block_trie = self.block_trie
         num_required_blocks = block_manager.num_required_blocks(
             seq, prealloc_size)
+        num_required_blocks += block_manager.num_copy_blocks(seq)
 
         if block_manager.get_num_free_gpu_blocks() >= num_required_blocks:
             return True
@@ -25,13 +28,18 @@ class RecomputeEvictionHelper(BaseEvictionHelper):
             evict_seq = evictable_seqs.pop(0)
 
             block_manager.free(evict_seq)
+            evict_seq.set_step(0)
+            if evict_seq.status == MessageStatus.RUNNING:
+                # preempted running sequence has to be prefilled again.
+                evict_seq.status = MessageStatus.WAITING
+                self.num_preemptions += 1
             num_req = (num_required_blocks -
                        block_manager.get_num_free_gpu_blocks())
             if num_req <= 0:
                 success = True
                 break
 
-            block_trie.evict(num_req)
+            block_trie.evict(num_req, swap_out_map)
             num_req = (num_required_blocks -
                        block_manager.get_num_free_gpu_blocks())
             if num_req <= 0:
@@ -41,7 +49,7 @@ class RecomputeEvictionHelper(BaseEvictionHelper):
         # for empty evictable_seqs case
         num_req = num_required_blocks - block_manager.get_num_free_gpu_blocks()
         if num_req > 0:
-            block_trie.evict(num_req)
+            block_trie.evict(num_req, swap_out_map)
             if num_required_blocks <= block_manager.get_num_free_gpu_blocks():
                 success = True
 
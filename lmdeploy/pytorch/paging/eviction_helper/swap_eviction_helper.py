@@ -0,0 +1,118 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from typing import Dict, List
+
+from ...messages import MessageStatus, SchedulerSequence
+from ..scheduler import Scheduler
+from .base_eviction_helper import BaseEvictionHelper
+
+
+class SwapEvictionHelper(BaseEvictionHelper):
+    """swap eviction.
+
+    Evicted sequences are swapped out to the host cache if it is cheaper than
+    recomputing them, swapped sequences would be swapped in before the next
+    prefill.
+    """
+
+    def __init__(self, scheduler: Scheduler):
+        super().__init__(scheduler)
+        self.min_swap_tokens = scheduler.scheduler_config.min_swap_tokens
+
+    def need_swap_in(self, seq: SchedulerSequence):
+        """sequence need swap in."""
+        return self.block_manager.on_device(seq, 'cpu')
+
+    def _use_swap(self, seq: SchedulerSequence):
+        """cost model of the eviction.
+
+        Moving caches to host and back costs linear time of the cached
+        tokens, recompute costs at least linear time with a much larger
+        factor (and quadratic attention), so long histories are swapped and
+        short ones are recomputed.
+        """
+        return seq.history_len >= self.min_swap_tokens
+
+    def _recompute(self, seq: SchedulerSequence):
+        """free blocks and recompute the sequence later."""
+        self.block_manager.free(seq)
+        seq.set_step(0)
+
+    def swap_in(self, seq: SchedulerSequence, swap_in_map: Dict[int, int]):
+        """swap in sequence, fallback to recompute if failed."""
+        success, tmp_map = self.block_manager.try_swap_in(seq)
+        if success:
+            swap_in_map.update(tmp_map)
+        else:
+            self._recompute(seq)
+        return success
+
+    def evict_for_seq(self,
+                      seq: SchedulerSequence,
+                      evictable_seqs: List[SchedulerSequence],
+                      prealloc_size: int,
+                      swap_out_map: Dict[int, int] = None):
+        """evict seqs."""
+        block_manager = self.block_manager
+        block_trie = self.block_trie
+        num_required_blocks = block_manager.num_required_blocks(
+            seq, prealloc_size)
+        num_required_blocks += block_manager.num_copy_blocks(seq)
+
+        # blocks freed by swapping out should not be reused by the swapping in
+        # in the same step, recompute all evicted sequences instead.
+        allow_swap = swap_out_map is not None
+        if self.need_swap_in(seq):
+            num_required_blocks += seq.num_blocks
+            allow_swap = False
+        trie_swap_out_map = swap_out_map if allow_swap else None
+
+        def __num_req():
+            return (num_required_blocks -
+                    block_manager.get_num_free_gpu_blocks())
+
+        if __num_req() <= 0:
+            return True
+
+        def __evict(evict_seq: SchedulerSequence):
+            """evict one sequence."""
+            if evict_seq.num_blocks == 0:
+                return
+            if self.need_swap_in(evict_seq):
+                # already swapped out
+                return
+            if allow_swap and self._use_swap(evict_seq):
+                # sequences take precedence over the host prefix cache.
+                num_free_cpu = block_manager.get_num_free_cpu_blocks()
+                if num_free_cpu < evict_seq.num_blocks:
+                    block_trie.evict_host(evict_seq.num_blocks - num_free_cpu)
+                success, tmp_map = block_manager.try_swap_out(evict_seq)
+                if success:
+                    swap_out_map.update(tmp_map)
+                    return
+            self._recompute(evict_seq)
+
+        success = False
+        while len(evictable_seqs) > 0:
+            evict_seq = evictable_seqs.pop(0)
+            __evict(evict_seq)
+            if evict_seq.status == MessageStatus.RUNNING:
+                evict_seq.status = MessageStatus.WAITING
+                self.num_preemptions += 1
+            num_req = __num_req()
+            if num_req <= 0:
+                success = True
+                break
+
+            block_trie.evict(num_req, trie_swap_out_map)
+            if __num_req() <= 0:
+                success = True
+                break
+
+        # for empty evictable_seqs case
+        num_req = __num_req()
+        if num_req > 0:
+            block_trie.evict(num_req, trie_swap_out_map)
+            if __num_req() <= 0:
+                success = True
+
+        return success
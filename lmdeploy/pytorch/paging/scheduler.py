@@ -1,17 +1,18 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 # modify from: https://github.com/vllm-project/vllm
 from collections import OrderedDict
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Set, Union
 
 from lmdeploy.utils import get_logger, logging_timer
 
 from ..adapter.adapter import AdapterManager, SchedulerAdapter
 from ..config import CacheConfig, SchedulerConfig
-from ..messages import (MessageStatus, SchedulerSequence, SchedulerSession,
-                        SequenceManager)
+from ..messages import (MessageStatus, SamplingParam, SchedulerSequence,
+                        SchedulerSession, SequenceManager)
 from .block_manager import build_block_manager
 from .block_trie import BlockTrie
+from .scheduling_policy import build_scheduling_policy
 
 logger = get_logger('lmdeploy')
 
@@ -28,6 +29,7 @@ class SchedulerOutput:
     swap_out_map: Dict[int, int]
     copy_map: Dict[int, int]
     adapters: AdapterList
+    chunk_sizes: Dict[int, int] = field(default_factory=dict)
 
 
 class Scheduler:
@@ -57,9 +59,15 @@ class Scheduler:
 
         self.eviction_helper = self.build_eviction_helper(
             self.scheduler_config.eviction_type)
+        self.scheduling_policy = build_scheduling_policy(
+            self.scheduler_config.scheduling_policy)
 
         self.seq_manager = SequenceManager()
 
+        # cache ops of steps without running sequences.
+        self._pending_swap_in: Dict[int, int] = dict()
+        self._pending_swap_out: Dict[int, int] = dict()
+
     @property
     def waiting(self):
         """get waiting sequence."""
@@ -86,6 +94,9 @@ class Scheduler:
         if eviction_type == 'recompute':
             from .eviction_helper import RecomputeEvictionHelper
             return RecomputeEvictionHelper(self)
+        elif eviction_type == 'swap':
+            from .eviction_helper import SwapEvictionHelper
+            return SwapEvictionHelper(self)
         else:
             raise TypeError(f'Unknown eviction type: {eviction_type}')
 
@@ -138,39 +149,89 @@ class Scheduler:
         return adapter.build_weight_map()
 
     @logging_timer('SchedulePrefilling', logger)
-    def _schedule_prefill(self):
-        """Schedule for prefilling."""
+    def _schedule_prefill(self,
+                          max_prefill_token_num: int = None,
+                          swap_in_map: Dict[int, int] = None,
+                          swap_out_map: Dict[int, int] = None,
+                          enable_chunked_prefill: bool = None):
+        """Schedule for prefilling.
+
+        Args:
+            max_prefill_token_num (int): The token budget of the step,
+                default to `cache_config.max_prefill_token_num`.
+            swap_in_map (Dict[int, int]): Blocks that have been swapped in
+                in the same step.
+            swap_out_map (Dict[int, int]): Blocks that have been swapped out
+                in the same step.
+            enable_chunked_prefill (bool): Split long prompts into chunks,
+                default to `scheduler_config.enable_chunked_prefill`.
+        """
 
         current_running = self.running
+        if max_prefill_token_num is None:
+            max_prefill_token_num = self.cache_config.max_prefill_token_num
+        if enable_chunked_prefill is None:
+            enable_chunked_prefill = (
+                self.scheduler_config.enable_chunked_prefill)
+        block_size = self.cache_config.block_size
         max_batches = self.scheduler_config.max_batches - len(current_running)
         eviction_helper = self.eviction_helper
-        swap_out_map: Dict[int, int] = dict()
-        swap_in_map: Dict[int, int] = dict()
+        policy = self.scheduling_policy
+        if swap_in_map is None:
+            swap_in_map = dict()
+        if swap_out_map is None:
+            swap_out_map = dict()
         copy_map: Dict[int, int] = dict()
+        chunk_sizes: Dict[int, int] = dict()
         running: SeqList = []
         required_adapters = set(seq.adapter_name for seq in current_running)
         max_adapters = self.scheduler_config.max_active_adapters - len(
             required_adapters)
         token_count = 0
+        num_slots = 0
 
-        def _to_running(seq: SchedulerSequence):
+        def _num_slots(seq: SchedulerSequence):
+            """parallel samples would be forked after the prefill."""
+            if seq.num_new_tokens == 0:
+                return seq.sampling_param.n
+            return 1
+
+        def _to_running(seq: SchedulerSequence, num_tokens: int):
             """to running."""
             seq.status = MessageStatus.RUNNING
             running.append(seq)
-            nonlocal token_count
-            token_count += seq.num_token_ids
-
-        def __evict_for_seq(seq: SchedulerSequence, waiting):
+            nonlocal token_count, num_slots
+            token_count += num_tokens
+            num_slots += _num_slots(seq)
+
+        def _get_chunk_size(seq: SchedulerSequence):
+            """get number of prompt tokens that fit in the budget."""
+            if not enable_chunked_prefill:
+                return 0
+            # vlm inputs and logits outputs can not be split.
+            if seq.num_images > 0 or seq.return_logits:
+                return 0
+            # align chunk end to block boundary.
+            chunk_end = seq.history_len + max_prefill_token_num - token_count
+            chunk_end = chunk_end // block_size * block_size
+            chunk_size = max(0, chunk_end - seq.history_len)
+            # at least one token is left for the last chunk.
+            return min(chunk_size, seq.num_token_ids - 1)
+
+        def __evict_for_seq(seq: SchedulerSequence, waiting,
+                            prealloc_size: int):
             """evict until can append."""
             from itertools import chain
-            hanging = reversed(self.hanging)
+            hanging = policy.sort_evictable(self.hanging)
+            # waiting has been sorted by policy
             waiting = reversed(waiting)
             evictable = list(chain(hanging, waiting))
-            return eviction_helper.evict_for_seq(seq, evictable, 0)
+            return eviction_helper.evict_for_seq(seq, evictable, prealloc_size,
+                                                 swap_out_map)
 
         def _reorder_waiting():
             """reorder waiting."""
-            return sorted(self.waiting, key=lambda seq: seq.arrive_time)
+            return policy.sort(self.waiting)
 
         def _active_adapter(adapter_name):
             """active adapter of a seq."""
@@ -194,14 +255,14 @@ class Scheduler:
 
         num_waiting = self.seq_manager.num_sequences(MessageStatus.WAITING)
         if (len(running) >= max_batches or num_waiting == 0):
-            return running, swap_in_map, swap_out_map, copy_map
+            return running, swap_in_map, swap_out_map, copy_map, chunk_sizes
 
         waiting = _reorder_waiting()
-        while len(waiting) > 0 and len(running) < max_batches:
+        while len(waiting) > 0 and num_slots < max_batches:
             seq = waiting.pop(0)
 
-            if (len(running) > 0 and token_count + seq.num_token_ids >
-                    self.cache_config.max_prefill_token_num):
+            # the forks of the sequence must fit in the free slots.
+            if num_slots + _num_slots(seq) > max_batches:
                 break
 
             # limit number of adapters
@@ -209,15 +270,51 @@ class Scheduler:
                 if seq.adapter_name not in required_adapters:
                     break
 
-            self.block_trie.match(seq)
+            # blocks swapped out in this step might be reused by swapping in.
+            if len(swap_out_map) == 0:
+                self.block_trie.match(seq, swap_in_map)
+            else:
+                self.block_trie.match(seq)
+
+            # the budget is counted on the tokens left after matching.
+            num_tokens = seq.num_token_ids
+            chunk_size = 0
+            if token_count + num_tokens > max_prefill_token_num:
+                chunk_size = _get_chunk_size(seq)
+                if chunk_size > 0:
+                    num_tokens = chunk_size
+                elif len(running) > 0:
+                    break
+                elif enable_chunked_prefill and len(current_running) > 0:
+                    # do not mix a long prompt into decoding batch.
+                    break
+
+            need_swap_in = eviction_helper.need_swap_in(seq)
+            if need_swap_in and len(swap_out_map) > 0:
+                # blocks swapped out in this step might be reused.
+                break
+
+            # a partial prefill only needs the blocks up to the end of the
+            # chunk, the negative prealloc size excludes the rest of prompt.
+            prealloc_size = 0
+            if chunk_size > 0:
+                prealloc_size = min(0, chunk_size - seq.num_token_ids)
 
-            if not __evict_for_seq(seq, waiting):
+            if not __evict_for_seq(seq, waiting, prealloc_size):
                 break
 
+            if need_swap_in:
+                eviction_helper.swap_in(seq, swap_in_map)
+
             # allocate session memory
-            self.block_manager.allocate(seq)
+            self.block_manager.allocate(seq, prealloc_size)
             _active_adapter(seq.adapter_name)
-            _to_running(seq)
+            _to_running(seq, num_tokens)
+
+            # the budget is used up by a partial prefill
+            if chunk_size > 0:
+                chunk_sizes[seq.seq_id] = chunk_size
+                break
 
         deactive_adapters = self.actived_adapters.difference(required_adapters)
         for adapter_name in deactive_adapters:
@@ -225,31 +322,95 @@ class Scheduler:
 
         self.actived_adapters = required_adapters
 
-        return running, swap_in_map, swap_out_map, copy_map
+        return running, swap_in_map, swap_out_map, copy_map, chunk_sizes
+
+    def _is_unsplittable_waiting(self):
+        """The most urgent waiting sequence can not be split into chunks and
+        does not fit in the budget left by the decoding sequences."""
+        if not self.has_running() or not self.has_waiting():
+            return False
+        seq = self.scheduling_policy.sort(self.waiting)[0]
+        # vlm inputs and logits outputs can not be split.
+        if seq.num_images == 0 and not seq.return_logits:
+            return False
+        max_prefill_token_num = (self.cache_config.max_prefill_token_num -
+                                 len(self.running))
+        return seq.num_token_ids > max_prefill_token_num
+
+    def _schedule_chunked_prefill(self,
+                                  prealloc_size: int = 0,
+                                  swap_in_map: Dict[int, int] = None,
+                                  swap_out_map: Dict[int, int] = None):
+        """Schedule running decoding sequences together with (chunks of)
+        waiting sequences in one step."""
+        decoding: SeqList = []
+        copy_map: Dict[int, int] = dict()
+        if self._is_unsplittable_waiting():
+            # prefill it without decoding, or it would starve.
+            output = self._schedule_prefill(swap_in_map=swap_in_map,
+                                            swap_out_map=swap_out_map,
+                                            enable_chunked_prefill=False)
+            running, swap_in_map, swap_out_map, copy_map, _ = output
+            if len(running) > 0:
+                return output
+
+        if self.has_running():
+            output = self._schedule_decoding(prealloc_size, swap_in_map,
+                                             swap_out_map)
+            decoding, swap_in_map, swap_out_map, copy_map = output
+
+        # each decoding sequence takes one token of the budget.
+        max_prefill_token_num = (self.cache_config.max_prefill_token_num -
+                                 len(decoding))
+        output = self._schedule_prefill(max_prefill_token_num, swap_in_map,
+                                        swap_out_map)
+        running, swap_in_map, swap_out_map, tmp_copy, chunk_sizes = output
+        copy_map.update(tmp_copy)
+        return (decoding + running, swap_in_map, swap_out_map, copy_map,
+                chunk_sizes)
 
     @logging_timer('ScheduleDecoding', logger)
-    def _schedule_decoding(self, prealloc_size: int = 0):
+    def _schedule_decoding(self,
+                           prealloc_size: int = 0,
+                           swap_in_map: Dict[int, int] = None,
+                           swap_out_map: Dict[int, int] = None):
         """schedule decoding."""
 
         running = self.running
         assert len(running) != 0
 
         eviction_helper = self.eviction_helper
-        swap_out_map: Dict[int, int] = dict()
-        swap_in_map: Dict[int, int] = dict()
+        policy = self.scheduling_policy
+        if swap_in_map is None:
+            swap_in_map = dict()
+        if swap_out_map is None:
+            swap_out_map = dict()
         copy_map: Dict[int, int] = dict()
 
-        def __evict_for_seq(seq: SchedulerSequence):
+        def __evict_for_seq(seq: SchedulerSequence, lower: SeqList):
             """evict until can append."""
             from itertools import chain
-            hanging = reversed(self.hanging)
-            waiting = reversed(self.waiting)
-            evictable = list(chain(hanging, waiting))
-            return eviction_helper.evict_for_seq(seq, evictable, prealloc_size)
-
-        # 1. running
-        for seq in running:
+            hanging = policy.sort_evictable(self.hanging)
+            waiting = policy.sort_evictable(self.waiting)
+            # only running sequences with strictly lower priority can be
+            # preempted, sequences of the same priority are not.
+            priority = seq.sampling_param.priority
+            lower = reversed([
+                other for other in lower
+                if other.status == MessageStatus.RUNNING
+                and other.sampling_param.priority > priority
+            ])
+            evictable = list(chain(hanging, waiting, lower))
+            return eviction_helper.evict_for_seq(seq, evictable, prealloc_size,
+                                                 swap_out_map)
+
+        # 1. running, urgent sequences allocate first.
+        running = policy.sort(running)
+        for idx, seq in enumerate(running):
             # token + n
+            if seq.status != MessageStatus.RUNNING:
+                # preempted
+                continue
 
             if len(seq.logical_blocks) > self.block_manager.num_gpu_blocks:
                 # Reach max gpu cache size.
@@ -261,10 +422,11 @@ class Scheduler:
                 seq.set_step(0)
                 continue
 
-            if not __evict_for_seq(seq):
+            if not __evict_for_seq(seq, running[idx + 1:]):
                 self._set_message_status(seq, MessageStatus.WAITING)
                 continue
 
+            copy_map.update(self.block_manager.copy_on_write(seq))
             self.block_manager.allocate(seq, prealloc_size)
             self.block_trie.allocate(seq)
 
@@ -278,11 +440,33 @@ class Scheduler:
 
     def schedule(self, is_prefill: bool, prealloc_size: int = 0):
         """Schedule inputs for next steps."""
+        chunk_sizes: Dict[int, int] = dict()
+        swap_in_map = self._pending_swap_in
+        swap_out_map = self._pending_swap_out
         if is_prefill:
-            output = self._schedule_prefill()
+            if self.scheduler_config.enable_chunked_prefill:
+                output = self._schedule_chunked_prefill(
+                    prealloc_size, swap_in_map, swap_out_map)
+            else:
+                output = self._schedule_prefill(swap_in_map=swap_in_map,
+                                                swap_out_map=swap_out_map)
+            running, swap_in_map, swap_out_map, copy_map, chunk_sizes = output
+        else:
+            output = self._schedule_decoding(prealloc_size, swap_in_map,
+                                             swap_out_map)
+            running, swap_in_map, swap_out_map, copy_map = output
+
+        if len(running) == 0:
+            # the engine skips steps without running sequences, the cache
+            # ops have been applied to the block tables and must be performed
+            # in the next step.
+            self._pending_swap_in = swap_in_map
+            self._pending_swap_out = swap_out_map
+            swap_in_map = dict()
+            swap_out_map = dict()
         else:
-            output = self._schedule_decoding(prealloc_size)
-        running, swap_in_map, swap_out_map, copy_map = output
+            self._pending_swap_in = dict()
+            self._pending_swap_out = dict()
 
         adapters = self._get_adapter_list(self.actived_adapters)
 
@@ -290,7 +474,33 @@ class Scheduler:
                                swap_in_map=swap_in_map,
                                swap_out_map=swap_out_map,
                                copy_map=copy_map,
-                               adapters=adapters)
+                               adapters=adapters,
+                               chunk_sizes=chunk_sizes)
+
+    def fork_sequence(self, seq: SchedulerSequence, index: int,
+                      sampling_param: SamplingParam):
+        """Fork a sequence after its prompt has been prefilled.
+
+        The fork shares the caches of the prompt and feeds the last prompt
+        token again to sample its own first token, the block it writes to
+        would be copied on write.
+
+        Args:
+            seq (SchedulerSequence): The prefilled sequence.
+            index (int): The index of the fork in the parallel samples.
+            sampling_param (SamplingParam): The sampling param of the fork.
+        """
+        fork = seq.session.fork_sequence(seq, index, sampling_param)
+        fork.set_step(fork.num_all_ids - 1)
+        if self.cache_config.window_size > 0 or fork.num_token_ids != 1:
+            # blocks of sliding window are reused in place, and images can
+            # not be partially fed, recompute the prompt instead.
+            fork.set_step(0)
+            self._set_message_status(fork, MessageStatus.WAITING)
+        else:
+            self.block_manager.fork(seq, fork)
+            self._set_message_status(fork, MessageStatus.RUNNING)
+        return fork
 
     def _set_session_status(self, session_id: int, status: MessageStatus):
         """Setup the status of session.
@@ -323,6 +533,14 @@ class Scheduler:
         seq.set_step(0)
         seq.session.remove_sequence(seq)
 
+    def remove_sequence(self, seq: SchedulerSequence):
+        """Remove sequence.
+
+        Args:
+            seq (SchedulerSequence): sequence to remove
+        """
+        self._remove_sequence(seq)
+
     def end_session(self, session_id: int):
         """End session.
 
@@ -0,0 +1,74 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+from typing import List
+
+from ..messages import SchedulerSequence
+
+SeqList = List[SchedulerSequence]
+
+
+class BaseSchedulingPolicy:
+    """Base scheduling policy.
+
+    A policy gives each sequence a sort key, sequence with smaller key would
+    be scheduled first and evicted last. `SamplingParam.priority` always
+    takes precedence over the policy specific key.
+    """
+
+    def sort_key(self, seq: SchedulerSequence):
+        """sort key of the sequence."""
+        raise NotImplementedError('Not implemented.')
+
+    def sort(self, seqs: SeqList):
+        """sort sequences, the most urgent comes first."""
+        return sorted(seqs, key=self.sort_key)
+
+    def sort_evictable(self, seqs: SeqList):
+        """sort sequences, the least urgent comes first."""
+        return list(reversed(self.sort(seqs)))
+
+
+class FCFSPolicy(BaseSchedulingPolicy):
+    """first come first serve."""
+
+    def sort_key(self, seq: SchedulerSequence):
+        """sort key of the sequence."""
+        return (seq.sampling_param.priority, seq.arrive_time)
+
+
+class ShortestPromptFirstPolicy(BaseSchedulingPolicy):
+    """sequence with less tokens to prefill first."""
+
+    def sort_key(self, seq: SchedulerSequence):
+        """sort key of the sequence."""
+        return (seq.sampling_param.priority, seq.num_token_ids,
+                seq.arrive_time)
+
+
+class EarliestDeadlineFirstPolicy(BaseSchedulingPolicy):
+    """sequence with the earliest deadline first, sequences without deadline
+    are served after those with deadline."""
+
+    def sort_key(self, seq: SchedulerSequence):
+        """sort key of the sequence."""
+        deadline = seq.sampling_param.deadline
+        if deadline is None:
+            deadline = float('inf')
+        else:
+            deadline = seq.arrive_time + deadline
+        return (seq.sampling_param.priority, deadline, seq.arrive_time)
+
+
+def build_scheduling_policy(policy_type: str) -> BaseSchedulingPolicy:
+    """build scheduling policy.
+
+    Args:
+        policy_type (str): one of ['fcfs', 'spf', 'edf'].
+    """
+    if policy_type == 'fcfs':
+        return FCFSPolicy()
+    elif policy_type == 'spf':
+        return ShortestPromptFirstPolicy()
+    elif policy_type == 'edf':
+        return EarliestDeadlineFirstPolicy()
+    else:
+        raise TypeError(f'Unknown scheduling policy: {policy_type}')
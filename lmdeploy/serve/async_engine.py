@@ -4,6 +4,7 @@ import dataclasses
 import json
 import os
 import random
+import time
 from contextlib import asynccontextmanager
 from copy import deepcopy
 from itertools import count
@@ -13,7 +14,10 @@ from typing import Any, Dict, List, Literal, Optional, Tuple, Union
 
 from lmdeploy.messages import (GenerationConfig, PytorchEngineConfig, Response,
                                TurbomindEngineConfig)
+from lmdeploy.metrics import ServeMetrics, render_metrics
 from lmdeploy.model import MODELS, ChatTemplateConfig, best_match_model
+from lmdeploy.serve.prefix_planner import plan_prefix_groups
+from lmdeploy.serve.tokenize_service import TokenizeService
 from lmdeploy.serve.utils import LogitsMixin, _get_event_loop
 from lmdeploy.tokenizer import DetokenizeState
 from lmdeploy.utils import _get_and_verify_max_len, _stop_words, get_logger
@@ -48,6 +52,7 @@ class GenOut:
     finish_reason: Optional[Literal['stop', 'length']] = None
     token_ids: List[int] = None
     logprobs: List[Dict[int, float]] = None
+    index: int = 0
 
 
 class Session:
@@ -173,10 +178,14 @@ class AsyncEngine(LogitsMixin):
         self.backend = backend
         self.instance_num = self.backend_config.max_batch_size
         self.tokenizer = self.engine.tokenizer
+        self.tokenize_service = TokenizeService(self.tokenizer)
+        self.metrics = ServeMetrics()
         self.id2step = {}
         self.id2generator = {}
         self.running_session_ids = set()
         self.gens_set = set()
+        # futures of the requests waiting for a free generator
+        self._gen_waiters: List[asyncio.Future] = []
         for i in range(self.instance_num):
             self.gens_set.add(self.engine.create_instance())
         self._session_id = count(0)
@@ -201,9 +210,13 @@ class AsyncEngine(LogitsMixin):
                                            PytorchEngineConfig]] = None,
             **kwargs):
         """Innter build method for pytorch backend."""
-        from lmdeploy.pytorch.engine import Engine
-        self.engine = Engine(model_path=model_path,
-                             engine_config=backend_config)
+        from lmdeploy.pytorch.engine import Engine, MPEngine
+        if getattr(backend_config, 'enable_engine_process', False):
+            self.engine = MPEngine(model_path=model_path,
+                                   engine_config=backend_config)
+        else:
+            self.engine = Engine(model_path=model_path,
+                                 engine_config=backend_config)
         self.backend_config = self.engine.engine_config
         self.hf_tm_cfg = getattr(self.engine.model_config, 'hf_config', None)
 
@@ -244,6 +257,7 @@ class AsyncEngine(LogitsMixin):
             self.gens_set.add(self.id2generator[str(session_id)])
 
         self.running_session_ids.discard(session_id)
+        self._notify_gen_waiters()
 
     async def end_session(self, session_id: int):
         """Clear a session by a session_id."""
@@ -253,6 +267,7 @@ class AsyncEngine(LogitsMixin):
             self.gens_set.add(self.id2generator[str(session_id)])
 
         self.running_session_ids.discard(session_id)
+        self._notify_gen_waiters()
 
     @asynccontextmanager
     async def safe_run(self, session_id: Optional[int] = None):
@@ -266,6 +281,24 @@ class AsyncEngine(LogitsMixin):
         if str(session_id) in self.id2generator:
             self.gens_set.add(self.id2generator[str(session_id)])
         self.running_session_ids.discard(session_id)
+        self._notify_gen_waiters()
+
+    async def get_metrics(self):
+        """Metrics of the server and the engine in the prometheus text
+        exposition format."""
+        metrics = self.metrics.collect()
+        metrics.append(self.tokenize_service.tokenize_time)
+        if self.backend == 'pytorch':
+            metrics += await self.engine.engine_instance.async_get_metrics()
+        return render_metrics(metrics)
+
+    def _notify_gen_waiters(self):
+        """wake up the requests waiting for a generator."""
+        waiters = self._gen_waiters
+        self._gen_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
 
     async def get_generator(self, stop: bool, session_id: int):
         """Only return the model instance if it is available."""
@@ -273,7 +306,9 @@ class AsyncEngine(LogitsMixin):
             return self.engine.create_instance()
         # waiting no generator is available or the same session_id is running
         while self.gens_set == set() or session_id in self.running_session_ids:
-            await asyncio.sleep(0.1)
+            waiter = asyncio.get_running_loop().create_future()
+            self._gen_waiters.append(waiter)
+            await waiter
         generator = self.gens_set.pop()
         self.id2generator[str(session_id)] = generator
         self.running_session_ids.add(session_id)
@@ -287,6 +322,7 @@ class AsyncEngine(LogitsMixin):
                     do_preprocess: bool = True,
                     adapter_name: Optional[str] = None,
                     use_tqdm: bool = False,
+                    prefix_aware: Optional[bool] = None,
                     **kwargs):
         """Inference a batch of prompts.
 
@@ -301,6 +337,12 @@ class AsyncEngine(LogitsMixin):
             adapter_name (str): the adapter name of slora for pytorch backend.
                 Pick one from adapters. Default to None, using the base model.
             use_tqdm (bool): Whether use the progress bar. Default to False
+            prefix_aware (bool): Whether to group the prompts by their shared
+                prefixes and run the groups back to back, so the prefix cache
+                is reused. The first prompt of a group warms the shared
+                prefix before the others start. Default to None, which
+                follows `enable_prefix_caching` of the backend config. The
+                outputs are in the order of the prompts either way.
         """
         need_list_wrap = isinstance(prompts, str) or isinstance(
             prompts[0], Dict)
@@ -318,45 +360,103 @@ class AsyncEngine(LogitsMixin):
             Response('', 0, 0, session_ids[i], index=i)
             for i in range(prompt_num)
         ]
-        generators = []
         if use_tqdm:
             import tqdm
             pbar = tqdm.tqdm(total=len(prompts))
-        for i, prompt in enumerate(prompts):
-            generators.append(
-                self.generate(prompt,
-                              session_ids[i],
-                              gen_config=gen_config[i],
-                              stream_response=True,
-                              sequence_start=True,
-                              sequence_end=True,
-                              do_preprocess=do_preprocess,
-                              adapter_name=adapter_name,
-                              **kwargs))
 
-        async def _inner_call(i, generator):
-            async for out in generator:
-                outputs[i].text += out.response
-                outputs[i].generate_token_len = out.generate_token_len
-                outputs[i].input_token_len = out.input_token_len
-                outputs[i].finish_reason = out.finish_reason
-                if out.token_ids:
-                    outputs[i].token_ids.extend(out.token_ids)
-                if out.logprobs:
-                    if outputs[i].logprobs is None:
-                        outputs[i].logprobs = []
-                    outputs[i].logprobs.extend(out.logprobs)
-                if use_tqdm and out.finish_reason is not None:
-                    pbar.update(1)
+        def _generate(i, input_ids=None):
+            return self.generate(prompts[i],
+                                 session_ids[i],
+                                 gen_config=gen_config[i],
+                                 stream_response=True,
+                                 sequence_start=True,
+                                 sequence_end=True,
+                                 do_preprocess=do_preprocess,
+                                 adapter_name=adapter_name,
+                                 input_ids=input_ids,
+                                 **kwargs)
+
+        async def _inner_call(i, generator, warmed=None):
+            try:
+                async for out in generator:
+                    if warmed is not None:
+                        # the prefill of the prompt is done
+                        warmed.set()
+                    if out.index > 0:
+                        # parallel samples are returned by api_server only.
+                        continue
+                    outputs[i].text += out.response
+                    outputs[i].generate_token_len = out.generate_token_len
+                    outputs[i].input_token_len = out.input_token_len
+                    outputs[i].finish_reason = out.finish_reason
+                    if out.token_ids:
+                        outputs[i].token_ids.extend(out.token_ids)
+                    if out.logprobs:
+                        if outputs[i].logprobs is None:
+                            outputs[i].logprobs = []
+                        outputs[i].logprobs.extend(out.logprobs)
+                    if use_tqdm and out.finish_reason is not None:
+                        pbar.update(1)
+            finally:
+                if warmed is not None:
+                    warmed.set()
+
+        async def _follow_call(i, generator, warmed):
+            """run a follower after the prefill of its leader."""
+            await warmed.wait()
+            await _inner_call(i, generator)
 
         async def gather():
-            await asyncio.gather(
-                *[_inner_call(i, generators[i]) for i in range(len(prompts))])
+            if prefix_aware is None:
+                _prefix_aware = self.backend_config.enable_prefix_caching
+            else:
+                _prefix_aware = prefix_aware
+            if not _prefix_aware or prompt_num == 1:
+                tasks = [
+                    _inner_call(i, _generate(i)) for i in range(prompt_num)
+                ]
+                await asyncio.gather(*tasks)
+                return
+            # the prompts are tokenized once, for both planning and generating
+            input_ids = await self._get_prompts_input_ids(
+                prompts, do_preprocess, adapter_name)
+            groups = plan_prefix_groups(input_ids, self._get_block_size())
+            # the leaders of all the groups are submitted first, the followers
+            # of a group wait for the prefill of their own leader.
+            leaders, followers = [], []
+            for group in groups:
+                leader = group[0]
+                warmed = asyncio.Event() if len(group) > 1 else None
+                generator = _generate(leader, input_ids[leader])
+                leaders.append(_inner_call(leader, generator, warmed))
+                followers += [
+                    _follow_call(i, _generate(i, input_ids[i]), warmed)
+                    for i in group[1:]
+                ]
+            await asyncio.gather(*leaders, *followers)
 
         _get_event_loop().run_until_complete(gather())
         outputs = outputs[0] if need_list_wrap else outputs
         return outputs
 
+    def _get_block_size(self):
+        """number of the tokens in a block of the kv cache."""
+        if self.backend == 'pytorch':
+            return self.backend_config.block_size
+        return self.backend_config.cache_block_seq_len
+
+    async def _get_prompts_input_ids(self, prompts: List, do_preprocess: bool,
+                                     adapter_name: str):
+        """token ids of a batch of prompts."""
+        prompt_inputs = await asyncio.gather(*[
+            self._get_prompt_input(prompt,
+                                   do_preprocess,
+                                   sequence_start=True,
+                                   adapter_name=adapter_name)
+            for prompt in prompts
+        ])
+        return [prompt_input['input_ids'] for prompt_input in prompt_inputs]
+
     def stream_infer(
             self,
             prompts: Union[List[str], str, List[Dict], List[List[Dict]]],
@@ -405,6 +505,8 @@ class AsyncEngine(LogitsMixin):
 
         async def _inner_call(i, generator):
             async for out in generator:
+                if out.index > 0:
+                    continue
                 outputs.put(
                     Response(out.response,
                              out.generate_token_len,
@@ -450,7 +552,8 @@ class AsyncEngine(LogitsMixin):
             prompt = chat_template.messages2prompt(prompt,
                                                    sequence_start,
                                                    tools=tools)
-        input_ids = self.tokenizer.encode(prompt, add_bos=sequence_start)
+        input_ids = await self.tokenize_service.encode(prompt,
+                                                       add_bos=sequence_start)
         return {'prompt': prompt, 'input_ids': input_ids}
 
     async def generate(
@@ -465,6 +568,7 @@ class AsyncEngine(LogitsMixin):
             step: int = 0,
             do_preprocess: bool = True,
             adapter_name: Optional[str] = None,
+            input_ids: Optional[List[int]] = None,
             **kwargs):
         """Generate responses.
 
@@ -479,7 +583,10 @@ class AsyncEngine(LogitsMixin):
             step (int): the offset of the k/v cache
             do_preprocess (bool): whether pre-process the messages. Default to
                 True, which means chat_template will be applied.
+            input_ids (List[int]): the token ids of the messages if they have
+                been tokenized, then the messages are not processed again.
         """
+        start = time.perf_counter()
         if str(session_id) not in self.id2step:
             self.id2step[str(session_id)] = 0
         if step != 0:
@@ -500,17 +607,26 @@ class AsyncEngine(LogitsMixin):
         # set random if it is not set and sequence_start is True
         if gen_config.random_seed is None and sequence_start:
             gen_config.random_seed = random.getrandbits(64)
-        if gen_config.n > 1:
+        if gen_config.n > 1 and self.backend != 'pytorch':
             logger.warning(f"n({gen_config.n}) > 1 hasn't been supported yet. "
                            f'Fallback to 1')
             gen_config.n = 1
+        max_batch_size = self.backend_config.max_batch_size
+        if gen_config.n > max_batch_size:
+            logger.warning(f'n({gen_config.n}) > max_batch_size'
+                           f'({max_batch_size}). Fallback to '
+                           f'{max_batch_size}')
+            gen_config.n = max_batch_size
         prompt = messages
 
-        prompt_input = await self._get_prompt_input(prompt,
-                                                    do_preprocess,
-                                                    sequence_start,
-                                                    adapter_name,
-                                                    tools=tools)
+        if input_ids is None:
+            prompt_input = await self._get_prompt_input(prompt,
+                                                        do_preprocess,
+                                                        sequence_start,
+                                                        adapter_name,
+                                                        tools=tools)
+        else:
+            prompt_input = dict(prompt=prompt, input_ids=input_ids)
         prompt = prompt_input['prompt']
         input_ids = prompt_input['input_ids']
         finish_reason = None
@@ -547,9 +663,16 @@ class AsyncEngine(LogitsMixin):
         else:
             generator = await self.get_generator(False, session_id)
             async with self.safe_run(session_id):
-                state = DetokenizeState(len(input_ids))
-                start_ids_offset = state.ids_offset
-                response = ''
+                # the n parallel samples are detokenized separately.
+                states = [
+                    DetokenizeState(len(input_ids))
+                    for _ in range(gen_config.n)
+                ]
+                start_ids_offset = states[0].ids_offset
+                responses = [''] * gen_config.n
+                all_tokens = [0] * gen_config.n
+                first_token = None
+                detokenize_time = 0.0
                 async for outputs in generator.async_stream_infer(
                         session_id=session_id,
                         **prompt_input,
@@ -560,15 +683,26 @@ class AsyncEngine(LogitsMixin):
                         sequence_end=sequence_end,
                         step=self.id2step[str(session_id)]):
                     # decode res
+                    index = outputs.index
                     res, tokens = input_ids + outputs.token_ids, outputs.num_token  # noqa
+                    all_tokens[index] = tokens
+                    state = states[index]
                     if len(res) <= state.ids_offset:
                         continue
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                        self.metrics.time_to_first_token.observe(first_token -
+                                                                 start)
 
                     ids_offset = state.ids_offset
+                    detokenize_start = time.perf_counter()
                     response, state = self.tokenizer.detokenize_incrementally(
                         res,
                         state,
                         skip_special_tokens=gen_config.skip_special_tokens)
+                    detokenize_time += time.perf_counter() - detokenize_start
+                    states[index] = state
+                    responses[index] = response
 
                     res = res[ids_offset:]
                     logprobs = None
@@ -578,19 +712,35 @@ class AsyncEngine(LogitsMixin):
 
                     # response, history token len,
                     # input token len, gen token len
-                    yield GenOut(response, self.id2step[str(session_id)],
-                                 len(input_ids), tokens, finish_reason, res,
-                                 logprobs)
-
-                finish_reason = 'length' \
-                    if tokens >= gen_config.max_new_tokens else 'stop'
-                # utf-8 char at the end means it's a potential unfinished
-                # byte sequence
-                if not response.endswith('�'):
-                    response = ''  # avaid returning the last response twice
-                yield GenOut(response, self.id2step[str(session_id)],
-                             len(input_ids), tokens, finish_reason)
-                # update step
+                    yield GenOut(response,
+                                 self.id2step[str(session_id)],
+                                 len(input_ids),
+                                 tokens,
+                                 finish_reason,
+                                 res,
+                                 logprobs,
+                                 index=index)
+
+                for index, (response,
+                            tokens) in enumerate(zip(responses, all_tokens)):
+                    finish_reason = 'length' \
+                        if tokens >= gen_config.max_new_tokens else 'stop'
+                    # utf-8 char at the end means it's a potential unfinished
+                    # byte sequence
+                    if not response.endswith('�'):
+                        # avaid returning the last response twice
+                        response = ''
+                    yield GenOut(response,
+                                 self.id2step[str(session_id)],
+                                 len(input_ids),
+                                 tokens,
+                                 finish_reason,
+                                 index=index)
+                self.metrics.detokenize_time.observe(detokenize_time)
+                self.metrics.on_finish(start, first_token, len(input_ids),
+                                       all_tokens)
+                # update step, the forks of the parallel samples are dropped
+                tokens = all_tokens[0]
                 self.id2step[str(session_id)] += len(input_ids) + tokens
                 if sequence_end:
                     self.id2step[str(session_id)] = 0
@@ -660,6 +810,8 @@ class AsyncEngine(LogitsMixin):
                                               step=session._step,
                                               do_preprocess=do_preprocess,
                                               **kwargs):
+                if output.index > 0:
+                    continue
                 resp = session._merge_response(resp, output)
             return resp
 
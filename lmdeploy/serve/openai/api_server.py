@@ -1,6 +1,7 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import asyncio
 import copy
+import json
 import os
 import time
 from functools import partial
@@ -10,14 +11,20 @@ from typing import AsyncGenerator, Dict, List, Literal, Optional, Union
 import uvicorn
 from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.responses import (FileResponse, JSONResponse, Response,
+                               StreamingResponse)
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
+from pydantic import ValidationError
 
 from lmdeploy.archs import get_task
 from lmdeploy.messages import (GenerationConfig, LogitsProcessor,
                                PytorchEngineConfig, TurbomindEngineConfig)
 from lmdeploy.model import ChatTemplateConfig
 from lmdeploy.serve.async_engine import AsyncEngine
+from lmdeploy.serve.openai.batch import BatchManager, BatchRunner
+from lmdeploy.serve.openai.protocol import BatchList, BatchRequest
+
+# isort: split
 from lmdeploy.serve.openai.protocol import (  # noqa: E501
     ChatCompletionRequest, ChatCompletionResponse,
     ChatCompletionResponseChoice, ChatCompletionResponseStreamChoice,
@@ -40,6 +47,7 @@ class VariableInterface:
     session_id: int = 0
     api_keys: Optional[List[str]] = None
     request_hosts = []
+    batch_manager: BatchManager = None
 
 
 app = FastAPI(docs_url='/')
@@ -113,6 +121,14 @@ def create_error_response(status: HTTPStatus,
                         status_code=status.value)
 
 
+def _get_num_samples(n: int) -> int:
+    """Get the number of samples generated for a request, parallel sampling
+    falls back to one sample on the backends other than pytorch."""
+    if VariableInterface.async_engine.backend != 'pytorch':
+        return 1
+    return n
+
+
 async def check_request(request) -> Optional[JSONResponse]:
     """Check if a request is valid."""
     if hasattr(request, 'model') and request.model not in get_model_list():
@@ -123,6 +139,14 @@ async def check_request(request) -> Optional[JSONResponse]:
         return create_error_response(
             HTTPStatus.BAD_REQUEST,
             f'The n `{request.n}` must be a positive int.')
+    if hasattr(request, 'n'):
+        backend_config = VariableInterface.async_engine.backend_config
+        max_batch_size = backend_config.max_batch_size
+        if _get_num_samples(request.n) > max_batch_size:
+            return create_error_response(
+                HTTPStatus.BAD_REQUEST,
+                f'The n `{request.n}` must not exceed the max batch size '
+                f'`{max_batch_size}`.')
     if hasattr(request,
                'top_p') and not (request.top_p > 0 and request.top_p <= 1):
         return create_error_response(
@@ -240,6 +264,14 @@ async def health() -> Response:
     return Response(status_code=200)
 
 
+@app.get('/metrics')
+async def metrics() -> Response:
+    """Metrics of the server and the engine in the prometheus text format."""
+    content = await VariableInterface.async_engine.get_metrics()
+    return Response(content=content,
+                    media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # modified from https://github.com/vllm-project/vllm/blob/v0.5.4/vllm/entrypoints/openai/logits_processors.py#L51  # noqa
 def logit_bias_logits_processor(logit_bias: Union[Dict[int, float],
                                                   Dict[str, float]],
@@ -291,7 +323,7 @@ async def chat_completions_v1(request: ChatCompletionRequest,
         probable tokens with probabilities that add up to top_p or higher
         are kept for generation.
     - n (int): How many chat completion choices to generate for each input
-        message. **Only support one here**.
+        message. Only pytorch backend supports n > 1.
     - stream: whether to stream the results or not. Default to false.
     - max_tokens (int | None): output token nums. Default to None.
     - repetition_penalty (float): The parameter for repetition penalty.
@@ -371,6 +403,7 @@ async def chat_completions_v1(request: ChatCompletionRequest,
     random_seed = request.seed if request.seed else None
 
     gen_config = GenerationConfig(
+        n=_get_num_samples(request.n),
         max_new_tokens=request.max_tokens,
         do_sample=True,
         logprobs=gen_logprobs,
@@ -383,7 +416,9 @@ async def chat_completions_v1(request: ChatCompletionRequest,
         skip_special_tokens=request.skip_special_tokens,
         response_format=response_format,
         logits_processors=logits_processors,
-        random_seed=random_seed)
+        random_seed=random_seed,
+        priority=request.priority,
+        deadline=request.deadline)
 
     tools = None
     if request.tools and request.tool_choice != 'none':
@@ -451,7 +486,7 @@ async def chat_completions_v1(request: ChatCompletionRequest,
                     total_tokens=total_tokens,
                 )
             response_json = create_stream_response_json(
-                index=0,
+                index=res.index,
                 text=res.response,
                 finish_reason=res.finish_reason,
                 logprobs=logprobs,
@@ -465,10 +500,11 @@ async def chat_completions_v1(request: ChatCompletionRequest,
                                  media_type='text/event-stream')
 
     # Non-streaming response
-    final_logprobs = []
-    final_token_ids = []
-    final_res = None
-    text = ''
+    num_choices = gen_config.n
+    final_logprobs = [[] for _ in range(num_choices)]
+    final_token_ids = [[] for _ in range(num_choices)]
+    final_results = [None] * num_choices
+    texts = [''] * num_choices
     async for res in result_generator:
         if await raw_request.is_disconnected():
             # Abort the request if the client disconnects.
@@ -476,57 +512,60 @@ async def chat_completions_v1(request: ChatCompletionRequest,
                 request.session_id)
             return create_error_response(HTTPStatus.BAD_REQUEST,
                                          'Client disconnected')
-        final_res = res
-        text += res.response
+        final_results[res.index] = res
+        texts[res.index] += res.response
         if res.token_ids:
-            final_token_ids.extend(res.token_ids)
+            final_token_ids[res.index].extend(res.token_ids)
         if res.logprobs:
-            final_logprobs.extend(res.logprobs)
-
-    tool_calls = None
-    if request.tool_choice != 'none' and ('<|plugin|>' in text
-                                          or '<function=' in text):
-        if final_res.finish_reason == 'stop':
-            final_res.finish_reason = 'tool_calls'
-        try:  # TODO add json_schema guidance to turbomind
-            text, action_id, name, parameters = VariableInterface.async_engine.parse_tool_response(  # noqa
-                text, request.tools)
-            tool_calls = [
-                ToolCall(id=str(action_id),
-                         function=FunctionResponse(name=name,
-                                                   arguments=parameters))
-            ]
-        except Exception as e:
-            logger.error(f'Exception: {e}')
-            return create_error_response(
-                HTTPStatus.BAD_REQUEST,
-                'Failed to parse fc related info to json format!')
-
-    logprobs = None
-    if gen_logprobs and len(final_logprobs):
-        logprobs = _create_chat_completion_logprobs(
-            VariableInterface.async_engine.tokenizer, final_token_ids,
-            final_logprobs)
+            final_logprobs[res.index].extend(res.logprobs)
 
-    assert final_res is not None
     choices = []
-    choice_data = ChatCompletionResponseChoice(
-        index=0,
-        message=ChatMessage(role='assistant',
-                            content=text,
-                            tool_calls=tool_calls),
-        logprobs=logprobs,
-        finish_reason=final_res.finish_reason,
-    )
-    choices.append(choice_data)
+    for index, (final_res, text) in enumerate(zip(final_results, texts)):
+        tool_calls = None
+        if request.tool_choice != 'none' and ('<|plugin|>' in text
+                                              or '<function=' in text):
+            if final_res.finish_reason == 'stop':
+                final_res.finish_reason = 'tool_calls'
+            try:  # TODO add json_schema guidance to turbomind
+                text, action_id, name, parameters = VariableInterface.async_engine.parse_tool_response(  # noqa
+                    text, request.tools)
+                tool_calls = [
+                    ToolCall(id=str(action_id),
+                             function=FunctionResponse(name=name,
+                                                       arguments=parameters))
+                ]
+            except Exception as e:
+                logger.error(f'Exception: {e}')
+                return create_error_response(
+                    HTTPStatus.BAD_REQUEST,
+                    'Failed to parse fc related info to json format!')
+
+        logprobs = None
+        if gen_logprobs and len(final_logprobs[index]):
+            logprobs = _create_chat_completion_logprobs(
+                VariableInterface.async_engine.tokenizer,
+                final_token_ids[index], final_logprobs[index])
 
+        choice_data = ChatCompletionResponseChoice(
+            index=index,
+            message=ChatMessage(role='assistant',
+                                content=text,
+                                tool_calls=tool_calls),
+            logprobs=logprobs,
+            finish_reason=final_res.finish_reason,
+        )
+        choices.append(choice_data)
+
+    final_res = final_results[0]
+    assert final_res is not None
+    completion_tokens = sum(res.generate_token_len for res in final_results)
     total_tokens = sum([
         final_res.history_token_len, final_res.input_token_len,
-        final_res.generate_token_len
+        completion_tokens
     ])
     usage = UsageInfo(
         prompt_tokens=final_res.input_token_len,
-        completion_tokens=final_res.generate_token_len,
+        completion_tokens=completion_tokens,
         total_tokens=total_tokens,
     )
     response = ChatCompletionResponse(
@@ -558,7 +597,7 @@ async def completions_v1(request: CompletionRequest,
         probable tokens with probabilities that add up to top_p or higher
         are kept for generation.
     - n (int): How many chat completion choices to generate for each input
-        message. **Only support one here**.
+        message. Only pytorch backend supports n > 1.
     - stream: whether to stream the results or not. Default to false.
     - repetition_penalty (float): The parameter for repetition penalty.
         1.0 means no penalty
@@ -603,6 +642,7 @@ async def completions_v1(request: CompletionRequest,
     random_seed = request.seed if request.seed else None
 
     gen_config = GenerationConfig(
+        n=_get_num_samples(request.n),
         max_new_tokens=request.max_tokens if request.max_tokens else 512,
         do_sample=True,
         logprobs=request.logprobs,
@@ -613,7 +653,9 @@ async def completions_v1(request: CompletionRequest,
         ignore_eos=request.ignore_eos,
         stop_words=request.stop,
         skip_special_tokens=request.skip_special_tokens,
-        random_seed=random_seed)
+        random_seed=random_seed,
+        priority=request.priority,
+        deadline=request.deadline)
     generators = []
     for i in range(len(request.prompt)):
         result_generator = VariableInterface.async_engine.generate(
@@ -650,19 +692,21 @@ async def completions_v1(request: CompletionRequest,
 
     async def completion_stream_generator() -> AsyncGenerator[str, None]:
         # First chunk with role
-        for generator in generators:
-            offset = 0
-            all_token_ids = []
-            state = DetokenizeState()
+        for i, generator in enumerate(generators):
+            offsets = [0] * gen_config.n
+            all_token_ids = [[] for _ in range(gen_config.n)]
+            states = [DetokenizeState() for _ in range(gen_config.n)]
             async for res in generator:
                 logprobs = None
                 usage = None
+                index = res.index
                 if request.logprobs and res.logprobs:
-                    logprobs, offset, all_token_ids, state = _create_completion_logprobs(  # noqa E501
-                        VariableInterface.async_engine.tokenizer,
-                        res.token_ids, res.logprobs,
-                        gen_config.skip_special_tokens, offset, all_token_ids,
-                        state)
+                    logprobs, offsets[index], all_token_ids[index], states[
+                        index] = _create_completion_logprobs(  # noqa E501
+                            VariableInterface.async_engine.tokenizer,
+                            res.token_ids, res.logprobs,
+                            gen_config.skip_special_tokens, offsets[index],
+                            all_token_ids[index], states[index])
                 if request.stream_options and request.stream_options.include_usage:  # noqa E501
                     final_res = res
                     total_tokens = sum([
@@ -675,7 +719,7 @@ async def completions_v1(request: CompletionRequest,
                         total_tokens=total_tokens,
                     )
                 response_json = create_stream_response_json(
-                    index=0,
+                    index=i * gen_config.n + index,
                     text=res.response,
                     finish_reason=res.finish_reason,
                     logprobs=logprobs,
@@ -690,13 +734,14 @@ async def completions_v1(request: CompletionRequest,
 
     # Non-streaming response
     usage = UsageInfo()
-    choices = [None] * len(generators)
+    num_choices = gen_config.n
+    choices = [None] * (len(generators) * num_choices)
 
     async def _inner_call(i, generator):
-        final_logprobs = []
-        final_token_ids = []
-        final_res = None
-        text = ''
+        final_logprobs = [[] for _ in range(num_choices)]
+        final_token_ids = [[] for _ in range(num_choices)]
+        final_results = [None] * num_choices
+        texts = [''] * num_choices
         async for res in generator:
             if await raw_request.is_disconnected():
                 # Abort the request if the client disconnects.
@@ -704,38 +749,44 @@ async def completions_v1(request: CompletionRequest,
                     request.session_id)
                 return create_error_response(HTTPStatus.BAD_REQUEST,
                                              'Client disconnected')
-            final_res = res
-            text += res.response
+            final_results[res.index] = res
+            texts[res.index] += res.response
             if res.token_ids:
-                final_token_ids.extend(res.token_ids)
+                final_token_ids[res.index].extend(res.token_ids)
             if res.logprobs:
-                final_logprobs.extend(res.logprobs)
-
-        logprobs = None
-        if request.logprobs and len(final_logprobs):
-            logprobs, _, _, _ = _create_completion_logprobs(
-                VariableInterface.async_engine.tokenizer, final_token_ids,
-                final_logprobs, gen_config.skip_special_tokens)
-
-        assert final_res is not None
-        choice_data = CompletionResponseChoice(
-            index=i,
-            text=text,
-            finish_reason=final_res.finish_reason,
-            logprobs=logprobs,
-        )
-        choices[i] = choice_data
+                final_logprobs[res.index].extend(res.logprobs)
+
+        assert final_results[0] is not None
+        for index, (final_res, text) in enumerate(zip(final_results, texts)):
+            logprobs = None
+            if request.logprobs and len(final_logprobs[index]):
+                logprobs, _, _, _ = _create_completion_logprobs(
+                    VariableInterface.async_engine.tokenizer,
+                    final_token_ids[index], final_logprobs[index],
+                    gen_config.skip_special_tokens)
+
+            choice_data = CompletionResponseChoice(
+                index=i * num_choices + index,
+                text=text,
+                finish_reason=final_res.finish_reason,
+                logprobs=logprobs,
+            )
+            choices[i * num_choices + index] = choice_data
 
+        final_res = final_results[0]
+        completion_tokens = sum(res.generate_token_len
+                                for res in final_results)
         total_tokens = sum([
             final_res.history_token_len, final_res.input_token_len,
-            final_res.generate_token_len
+            completion_tokens
         ])
         usage.prompt_tokens += final_res.input_token_len
-        usage.completion_tokens += final_res.generate_token_len
+        usage.completion_tokens += completion_tokens
         usage.total_tokens += total_tokens
 
     await asyncio.gather(
         *[_inner_call(i, generators[i]) for i in range(len(generators))])
+    choices = [choice for choice in choices if choice is not None]
 
     response = CompletionResponse(
         id=request_id,
@@ -767,23 +818,23 @@ async def encode(request: EncodeRequest, raw_request: Request = None):
         is not. Default to True.
     """
 
-    def encode(prompt: str, do_preprocess: bool, add_bos: bool):
-        if do_preprocess:
-            prompt = VariableInterface.async_engine.chat_template.get_prompt(
-                prompt, sequence_start=add_bos)
-        input_ids = VariableInterface.async_engine.tokenizer.encode(
-            prompt, add_bos=add_bos)
-        return input_ids
+    async_engine = VariableInterface.async_engine
+
+    def preprocess(prompt: str):
+        if request.do_preprocess:
+            prompt = async_engine.chat_template.get_prompt(
+                prompt, sequence_start=request.add_bos)
+        return prompt
 
     if isinstance(request.input, str):
-        encoded = encode(request.input, request.do_preprocess, request.add_bos)
+        encoded = await async_engine.tokenize_service.encode(
+            preprocess(request.input), add_bos=request.add_bos)
         return EncodeResponse(input_ids=encoded, length=len(encoded))
     else:
-        encoded, length = [], []
-        for prompt in request.input:
-            ids = encode(prompt, request.do_preprocess, request.add_bos)
-            encoded.append(ids)
-            length.append(len(ids))
+        encoded = await async_engine.tokenize_service.encode_batch(
+            [preprocess(prompt) for prompt in request.input],
+            add_bos=request.add_bos)
+        length = [len(ids) for ids in encoded]
         return EncodeResponse(input_ids=encoded, length=length)
 
 
@@ -926,6 +977,173 @@ async def chat_interactive_v1(request: GenerateRequest,
         return JSONResponse(ret)
 
 
+class _BatchRawRequest:
+    """Stand-in of the raw request of the requests in a batch."""
+
+    async def is_disconnected(self):
+        """the requests of a batch have no clients."""
+        return False
+
+
+async def batch_handler(url: str, body: Dict):
+    """Handle a request of a batch with the non-streaming api of `url`.
+
+    Returns the status code and the body of the response.
+    """
+    body = dict(body, stream=False)
+    body.setdefault('model', VariableInterface.async_engine.model_name)
+    try:
+        if url == '/v1/chat/completions':
+            response = await chat_completions_v1(
+                ChatCompletionRequest.model_validate(body), _BatchRawRequest())
+        else:
+            response = await completions_v1(
+                CompletionRequest.model_validate(body), _BatchRawRequest())
+    except ValidationError as e:
+        response = create_error_response(HTTPStatus.BAD_REQUEST, str(e))
+    if isinstance(response, JSONResponse):
+        return response.status_code, json.loads(response.body)
+    return HTTPStatus.OK.value, response.model_dump()
+
+
+def _check_batch_manager() -> Optional[JSONResponse]:
+    """Check if the batch api is enabled."""
+    if VariableInterface.batch_manager is None:
+        return create_error_response(
+            HTTPStatus.NOT_FOUND,
+            'The batch api is disabled, please serve with `batch_dir`.')
+    return
+
+
+@app.post('/v1/files', dependencies=[Depends(check_api_key)])
+async def create_file(raw_request: Request,
+                      purpose: str = 'batch',
+                      filename: str = 'batch.jsonl'):
+    """Upload a JSONL file of the requests of a batch.
+
+    Same as OpenAI's API, the file can be uploaded as the `file` field of a
+    multipart form along with the `purpose` field, which requires
+    `python-multipart`. The file can also be the body of the request, with
+    `purpose` and `filename` in the query parameters. The file is written to
+    the disk chunk by chunk.
+    """
+    error_check_ret = _check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    content_type = raw_request.headers.get('content-type', '')
+    if content_type.startswith('multipart/form-data'):
+        form = await raw_request.form()
+        upload = form.get('file')
+        if upload is None or isinstance(upload, str):
+            return create_error_response(HTTPStatus.BAD_REQUEST,
+                                         'The field `file` is required.')
+        purpose = form.get('purpose', purpose)
+        filename = upload.filename or filename
+
+        async def __read_chunks():
+            while chunk := await upload.read(1 << 20):
+                yield chunk
+
+        chunks = __read_chunks()
+    else:
+        chunks = raw_request.stream()
+    return await VariableInterface.batch_manager.create_file(
+        filename, purpose, chunks)
+
+
+@app.get('/v1/files/{file_id}', dependencies=[Depends(check_api_key)])
+async def retrieve_file(file_id: str):
+    """Retrieve a file."""
+    error_check_ret = _check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    file = VariableInterface.batch_manager.files.get(file_id)
+    if file is None:
+        return create_error_response(HTTPStatus.NOT_FOUND,
+                                     f'The file `{file_id}` does not exist.')
+    return file
+
+
+@app.get('/v1/files/{file_id}/content', dependencies=[Depends(check_api_key)])
+async def retrieve_file_content(file_id: str):
+    """Download the content of a file."""
+    error_check_ret = _check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    manager: BatchManager = VariableInterface.batch_manager
+    if file_id not in manager.files:
+        return create_error_response(HTTPStatus.NOT_FOUND,
+                                     f'The file `{file_id}` does not exist.')
+    return FileResponse(manager.file_path(file_id),
+                        media_type='application/jsonl')
+
+
+@app.post('/v1/batches', dependencies=[Depends(check_api_key)])
+async def create_batch(request: BatchRequest):
+    """Create a batch of the requests in an uploaded file.
+
+    Refer to `https://platform.openai.com/docs/api-reference/batch/create`
+    for the API specification. The requests are run with bounded concurrency
+    and ordered to reuse the prefix cache, and the results are written to the
+    output file incrementally. Batches interrupted by a restart of the server
+    resume from where they stopped.
+    """
+    error_check_ret = _check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    manager: BatchManager = VariableInterface.batch_manager
+    if request.input_file_id not in manager.files:
+        return create_error_response(
+            HTTPStatus.NOT_FOUND,
+            f'The file `{request.input_file_id}` does not exist.')
+    return manager.create_batch(request)
+
+
+@app.get('/v1/batches/{batch_id}', dependencies=[Depends(check_api_key)])
+async def retrieve_batch(batch_id: str):
+    """Retrieve a batch."""
+    error_check_ret = _check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    batch = VariableInterface.batch_manager.get_batch(batch_id)
+    if batch is None:
+        return create_error_response(
+            HTTPStatus.NOT_FOUND, f'The batch `{batch_id}` does not exist.')
+    return batch
+
+
+@app.post('/v1/batches/{batch_id}/cancel',
+          dependencies=[Depends(check_api_key)])
+async def cancel_batch(batch_id: str):
+    """Cancel a batch, the finished results are kept in the output file."""
+    error_check_ret = _check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    batch = VariableInterface.batch_manager.cancel_batch(batch_id)
+    if batch is None:
+        return create_error_response(
+            HTTPStatus.NOT_FOUND, f'The batch `{batch_id}` does not exist.')
+    return batch
+
+
+@app.get('/v1/batches', dependencies=[Depends(check_api_key)])
+async def list_batches(after: Optional[str] = None, limit: int = 20):
+    """List the batches."""
+    error_check_ret = _check_batch_manager()
+    if error_check_ret is not None:
+        return error_check_ret
+    batches, has_more = VariableInterface.batch_manager.list_batches(
+        after, limit)
+    return BatchList(data=batches, has_more=has_more)
+
+
+@app.on_event('startup')
+async def resume_batches():
+    """Resume the batches interrupted by the last shutdown."""
+    if VariableInterface.batch_manager is not None:
+        VariableInterface.batch_manager.resume_batches()
+
+
 def serve(model_path: str,
           model_name: Optional[str] = None,
           backend: Literal['turbomind', 'pytorch'] = 'turbomind',
@@ -941,6 +1159,8 @@ def serve(model_path: str,
           log_level: str = 'ERROR',
           api_keys: Optional[Union[List[str], str]] = None,
           ssl: bool = False,
+          batch_dir: Optional[str] = None,
+          batch_max_concurrency: int = 64,
           **kwargs):
     """An example to perform model inference through the command line
     interface.
@@ -979,6 +1199,9 @@ def serve(model_path: str,
         api_keys (List[str] | str | None): Optional list of API keys. Accepts string type as
             a single api_key. Default to None, which means no api key applied.
         ssl (bool): Enable SSL. Requires OS Environment variables 'SSL_KEYFILE' and 'SSL_CERTFILE'.
+        batch_dir (str): The directory to save the files and the batches of the batch api.
+            The batch api is disabled if it is not set. Default to None.
+        batch_max_concurrency (int): Max number of the requests in flight of a batch.
     """  # noqa E501
     if os.getenv('TM_LOG_LEVEL') is None:
         os.environ['TM_LOG_LEVEL'] = log_level
@@ -1011,6 +1234,9 @@ def serve(model_path: str,
         backend_config=backend_config,
         chat_template_config=chat_template_config,
         **kwargs)
+    if batch_dir is not None:
+        VariableInterface.batch_manager = BatchManager(
+            batch_dir, batch_handler, max_concurrency=batch_max_concurrency)
 
     for i in range(3):
         print(
@@ -1025,6 +1251,62 @@ def serve(model_path: str,
                 ssl_certfile=ssl_certfile)
 
 
+def run_batch(model_path: str,
+              input_path: str,
+              output_path: str,
+              error_path: Optional[str] = None,
+              model_name: Optional[str] = None,
+              backend: Literal['turbomind', 'pytorch'] = 'turbomind',
+              backend_config: Optional[Union[PytorchEngineConfig,
+                                             TurbomindEngineConfig]] = None,
+              chat_template_config: Optional[ChatTemplateConfig] = None,
+              max_concurrency: int = 64,
+              window_size: int = 4096,
+              log_level: str = 'ERROR',
+              **kwargs):
+    """Run the requests of a JSONL file in the format of OpenAI's batch api
+    offline, without launching a server.
+
+    The results are appended to the output file as soon as they finish, and
+    a job run again with the same output file resumes from where it stopped.
+
+    Args:
+        model_path (str): the path of a model, refer to `serve`.
+        input_path (str): the JSONL file of the requests.
+        output_path (str): the JSONL file of the results.
+        error_path (str): the JSONL file of the failed requests. They are
+            written to `output_path` if it is not set.
+        model_name (str): the name of the served model, refer to `serve`.
+        backend (str): either `turbomind` or `pytorch` backend.
+        backend_config (TurbomindEngineConfig | PytorchEngineConfig): beckend
+            config instance. Default to none.
+        chat_template_config (ChatTemplateConfig): chat template configuration.
+            Default to None.
+        max_concurrency (int): max number of the requests in flight.
+        window_size (int): number of the requests read and sorted together to
+            reuse the prefix cache.
+        log_level(str): set log level.
+    Returns:
+        BatchRequestCounts: counts of the requests.
+    """
+    if os.getenv('TM_LOG_LEVEL') is None:
+        os.environ['TM_LOG_LEVEL'] = log_level
+    logger.setLevel(log_level)
+
+    _, pipeline_class = get_task(model_path)
+    VariableInterface.async_engine = pipeline_class(
+        model_path=model_path,
+        model_name=model_name,
+        backend=backend,
+        backend_config=backend_config,
+        chat_template_config=chat_template_config,
+        **kwargs)
+    runner = BatchRunner(batch_handler,
+                         max_concurrency=max_concurrency,
+                         window_size=window_size)
+    return asyncio.run(runner.run(input_path, output_path, error_path))
+
+
 if __name__ == '__main__':
     import fire
 
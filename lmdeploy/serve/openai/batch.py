@@ -0,0 +1,437 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Batch inference of the requests in a JSONL file, in the format of the
+OpenAI batch API.
+
+Each line of the input file is a request such as::
+
+    {"custom_id": "req-1", "method": "POST", "url": "/v1/chat/completions",
+     "body": {"model": "internlm2", "messages": [...]}}
+
+and each line of the output file is the result of a request::
+
+    {"id": "batch_req_...", "custom_id": "req-1",
+     "response": {"status_code": 200, "request_id": "...", "body": {...}},
+     "error": null}
+"""
+import asyncio
+import json
+import os
+import time
+from functools import partial
+from typing import (AsyncIterator, Awaitable, Callable, Dict, List, Optional,
+                    Set, Tuple)
+
+import shortuuid
+
+from lmdeploy.serve.openai.protocol import (BatchObject, BatchRequest,
+                                            BatchRequestCounts, FileObject)
+from lmdeploy.utils import get_logger
+
+logger = get_logger('lmdeploy')
+
+# the endpoints a batch can request
+BATCH_ENDPOINTS = ('/v1/chat/completions', '/v1/completions')
+
+# `handler(url, body) -> (status_code, response_body)`
+BatchHandler = Callable[[str, Dict], Awaitable[Tuple[int, Dict]]]
+
+
+def _prefix_key(body: Dict):
+    """the sort key of a request, requests sharing the same prompt prefix are
+    adjacent after sorting."""
+    prompt = body.get('messages', body.get('prompt', ''))
+    if isinstance(prompt, str):
+        return prompt
+    return json.dumps(prompt, ensure_ascii=False, sort_keys=True)
+
+
+def _load_finished(path: Optional[str]) -> Tuple[Set[str], int]:
+    """custom ids of the requests in a result file and the number of the
+    failed ones.
+
+    A partially written last line left by an interrupted job is truncated.
+    """
+    finished = set()
+    num_failed = 0
+    if path is None or not os.path.exists(path):
+        return finished, num_failed
+    with open(path, 'rb+') as f:
+        size = 0
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                record = json.loads(line)
+                finished.add(record['custom_id'])
+            except (ValueError, KeyError):
+                break
+            num_failed += record.get('error') is not None
+            size += len(line)
+        f.truncate(size)
+    return finished, num_failed
+
+
+def _make_record(custom_id: str, status_code: int, body: Dict):
+    """the result line of a request."""
+    error = None
+    if status_code != 200:
+        error = dict(code=str(status_code),
+                     message=body.get('message', str(body)))
+    return dict(id=f'batch_req_{shortuuid.random()}',
+                custom_id=custom_id,
+                response=dict(status_code=status_code,
+                              request_id=body.get('id', custom_id),
+                              body=body),
+                error=error)
+
+
+class BatchRunner:
+    """Run the requests of a JSONL file with bounded concurrency.
+
+    The input file is read in windows of `window_size` lines, the requests of
+    a window are sorted by their prompts so that those sharing a prefix are
+    scheduled back to back and reuse the prefix cache. At most
+    `max_concurrency` requests are in flight, and results are appended to the
+    output file as soon as they finish, so the memory does not grow with the
+    size of the input. The output files are the checkpoint as well, requests
+    already in them are skipped when a job is run again.
+
+    Args:
+        handler (BatchHandler): coroutine function to handle a request, it
+            takes the url and the body of a request and returns the status
+            code and the body of the response.
+        max_concurrency (int): max number of the requests in flight.
+        window_size (int): number of the lines sorted together.
+    """
+
+    def __init__(self,
+                 handler: BatchHandler,
+                 max_concurrency: int = 64,
+                 window_size: int = 4096):
+        assert max_concurrency > 0 and window_size > 0
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.window_size = window_size
+        self.request_counts = BatchRequestCounts()
+
+    def _parse_line(self, line: str, line_no: int, endpoint: Optional[str]):
+        """parse a line of the input file, return the custom id, the request
+        and the error message."""
+        try:
+            request = json.loads(line)
+            custom_id = str(request['custom_id'])
+        except (ValueError, KeyError, TypeError):
+            return f'line-{line_no}', None, 'invalid request line'
+        url = request.get('url', endpoint)
+        if url not in BATCH_ENDPOINTS:
+            return custom_id, None, f'unsupported url `{url}`'
+        if endpoint is not None and url != endpoint:
+            return custom_id, None, (f'url `{url}` does not match the '
+                                     f'endpoint `{endpoint}` of the batch')
+        if not isinstance(request.get('body'), dict):
+            return custom_id, None, 'the body should be an object'
+        request['url'] = url
+        return custom_id, request, None
+
+    async def _read_windows(self, input_path: str, finished: Set[str],
+                            endpoint: Optional[str], queue: asyncio.Queue,
+                            write: Callable):
+        """feed the unfinished requests to the queue, window by window."""
+
+        async def __flush(window: List[Tuple[str, Dict]]):
+            window.sort(key=lambda x: _prefix_key(x[1]['body']))
+            for item in window:
+                await queue.put(item)
+            window.clear()
+
+        window = []
+        with open(input_path, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f):
+                if not line.strip():
+                    continue
+                custom_id, request, err_msg = self._parse_line(
+                    line, line_no, endpoint)
+                if custom_id in finished:
+                    continue
+                self.request_counts.total += 1
+                if err_msg is not None:
+                    write(custom_id, 400,
+                          dict(message=err_msg, type='invalid_request_error'))
+                    continue
+                window.append((custom_id, request))
+                if len(window) >= self.window_size:
+                    await __flush(window)
+        await __flush(window)
+
+    async def _worker(self, queue: asyncio.Queue, write: Callable):
+        """handle the requests in the queue."""
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            custom_id, request = item
+            try:
+                status_code, body = await self.handler(request['url'],
+                                                       request['body'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'Batch request `{custom_id}` failed: {e}')
+                status_code, body = 500, dict(message=str(e),
+                                              type='internal_error')
+            write(custom_id, status_code, body)
+
+    async def run(self,
+                  input_path: str,
+                  output_path: str,
+                  error_path: Optional[str] = None,
+                  endpoint: Optional[str] = None) -> BatchRequestCounts:
+        """run the requests of the input file.
+
+        Args:
+            input_path (str): the input JSONL file.
+            output_path (str): the JSONL file of the succeeded requests.
+            error_path (str): the JSONL file of the failed requests. The
+                failed ones go to `output_path` if it is not given.
+            endpoint (str): the url all the requests should have. The url of
+                a request defaults to it when missing.
+        Returns:
+            BatchRequestCounts: counts of the requests, including those
+                finished by previous runs.
+        """
+        if error_path is None:
+            error_path = output_path
+        finished, num_failed = _load_finished(output_path)
+        if error_path != output_path:
+            failed, num_error_failed = _load_finished(error_path)
+            finished |= failed
+            num_failed += num_error_failed
+            del failed
+        counts = self.request_counts = BatchRequestCounts(
+            total=len(finished),
+            completed=len(finished) - num_failed,
+            failed=num_failed)
+        if counts.total > 0:
+            logger.info(f'Resume batch from {counts.total} finished requests.')
+
+        out_file = open(output_path, 'a', encoding='utf-8')
+        err_file = out_file
+        if error_path != output_path:
+            err_file = open(error_path, 'a', encoding='utf-8')
+
+        def __write(custom_id: str, status_code: int, body: Dict):
+            """append the result of a request."""
+            record = _make_record(custom_id, status_code, body)
+            f = out_file if status_code == 200 else err_file
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            if status_code == 200:
+                counts.completed += 1
+            else:
+                counts.failed += 1
+
+        queue = asyncio.Queue(maxsize=self.max_concurrency)
+        workers = [
+            asyncio.ensure_future(self._worker(queue, __write))
+            for _ in range(self.max_concurrency)
+        ]
+        try:
+            await self._read_windows(input_path, finished, endpoint, queue,
+                                     __write)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            out_file.close()
+            if err_file is not out_file:
+                err_file.close()
+        return counts
+
+
+class BatchManager:
+    """Files and batches of the batch API, persisted in `batch_dir`.
+
+    The batches in progress are resumed from their checkpoints by
+    `resume_batches` after a restart of the server.
+
+    Args:
+        batch_dir (str): the directory to save the files and the batches.
+        handler (BatchHandler): the handler of the requests.
+        max_concurrency (int): max number of the requests in flight of a
+            batch.
+    """
+
+    def __init__(self,
+                 batch_dir: str,
+                 handler: BatchHandler,
+                 max_concurrency: int = 64):
+        self.batch_dir = batch_dir
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.files: Dict[str, FileObject] = dict()
+        self.batches: Dict[str, BatchObject] = dict()
+        self._tasks: Dict[str, asyncio.Task] = dict()
+        self._runners: Dict[str, BatchRunner] = dict()
+        os.makedirs(self._meta_dir('files'), exist_ok=True)
+        os.makedirs(self._meta_dir('batches'), exist_ok=True)
+        for name in os.listdir(self._meta_dir('files')):
+            with open(os.path.join(self._meta_dir('files'), name)) as f:
+                file = FileObject.model_validate_json(f.read())
+            self.files[file.id] = file
+        for name in os.listdir(self._meta_dir('batches')):
+            with open(os.path.join(self._meta_dir('batches'), name)) as f:
+                batch = BatchObject.model_validate_json(f.read())
+            self.batches[batch.id] = batch
+
+    def _meta_dir(self, kind: str):
+        """directory of the metadata."""
+        return os.path.join(self.batch_dir, kind)
+
+    def file_path(self, file_id: str):
+        """path of the content of a file."""
+        return os.path.join(self.batch_dir, f'{file_id}.jsonl')
+
+    def _save(self, obj):
+        """save the metadata of a file or a batch."""
+        kind = 'files' if isinstance(obj, FileObject) else 'batches'
+        path = os.path.join(self._meta_dir(kind), f'{obj.id}.json')
+        with open(path + '.tmp', 'w') as f:
+            f.write(obj.model_dump_json())
+        os.replace(path + '.tmp', path)
+
+    async def create_file(self, filename: str, purpose: str,
+                          chunks: AsyncIterator[bytes]) -> FileObject:
+        """save an uploaded file chunk by chunk."""
+        file = FileObject(filename=filename, purpose=purpose)
+        with open(self.file_path(file.id), 'wb') as f:
+            async for chunk in chunks:
+                f.write(chunk)
+                file.bytes += len(chunk)
+        self.files[file.id] = file
+        self._save(file)
+        return file
+
+    def _add_result_file(self, file_id: str, filename: str):
+        """register a result file of a batch."""
+        path = self.file_path(file_id)
+        file = FileObject(id=file_id,
+                          filename=filename,
+                          purpose='batch_output',
+                          bytes=os.path.getsize(path))
+        self.files[file.id] = file
+        self._save(file)
+
+    def create_batch(self, request: BatchRequest) -> BatchObject:
+        """create a batch and start it."""
+        batch = BatchObject(endpoint=request.endpoint,
+                            input_file_id=request.input_file_id,
+                            completion_window=request.completion_window,
+                            metadata=request.metadata,
+                            output_file_id=f'file-{shortuuid.random()}',
+                            error_file_id=f'file-{shortuuid.random()}')
+        self.batches[batch.id] = batch
+        self._start(batch)
+        return batch
+
+    def _start(self, batch: BatchObject):
+        """start the task of a batch."""
+        batch.status = 'in_progress'
+        batch.in_progress_at = batch.in_progress_at or int(time.time())
+        # the result files exist even if the batch ends before running.
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            open(self.file_path(file_id), 'a').close()
+        self._save(batch)
+        runner = BatchRunner(self.handler,
+                             max_concurrency=self.max_concurrency)
+        self._runners[batch.id] = runner
+        task = asyncio.ensure_future(self._run(batch, runner))
+        task.add_done_callback(partial(self._on_task_done, batch))
+        self._tasks[batch.id] = task
+
+    def _on_task_done(self, batch: BatchObject, task: asyncio.Task):
+        """finish the batch cancelled before its task started to run."""
+        if batch.status == 'cancelling':
+            batch.status = 'cancelled'
+            batch.cancelled_at = int(time.time())
+            self._finish(batch)
+
+    def _finish(self, batch: BatchObject):
+        """release the task of a batch and save its results."""
+        self._tasks.pop(batch.id, None)
+        self._runners.pop(batch.id, None)
+        self._add_result_file(batch.output_file_id, f'{batch.id}_output.jsonl')
+        self._add_result_file(batch.error_file_id, f'{batch.id}_error.jsonl')
+        self._save(batch)
+
+    async def _run(self, batch: BatchObject, runner: BatchRunner):
+        """run a batch and record its status."""
+        input_path = self.file_path(batch.input_file_id)
+        output_path = self.file_path(batch.output_file_id)
+        error_path = self.file_path(batch.error_file_id)
+        try:
+            batch.request_counts = await runner.run(input_path,
+                                                    output_path,
+                                                    error_path,
+                                                    endpoint=batch.endpoint)
+            batch.finalizing_at = int(time.time())
+            batch.status = 'completed'
+            batch.completed_at = int(time.time())
+        except asyncio.CancelledError:
+            batch.request_counts = runner.request_counts
+            batch.status = 'cancelled'
+            batch.cancelled_at = int(time.time())
+        except Exception as e:
+            logger.error(f'Batch `{batch.id}` failed: {e}')
+            batch.request_counts = runner.request_counts
+            batch.errors = dict(
+                object='list',
+                data=[dict(code='batch_failed', message=str(e))])
+            batch.status = 'failed'
+            batch.failed_at = int(time.time())
+        finally:
+            self._finish(batch)
+
+    def get_batch(self, batch_id: str) -> Optional[BatchObject]:
+        """get a batch with the latest request counts."""
+        batch = self.batches.get(batch_id)
+        runner = self._runners.get(batch_id)
+        if batch is not None and runner is not None:
+            batch.request_counts = runner.request_counts
+        return batch
+
+    def list_batches(self, after: Optional[str] = None, limit: int = 20):
+        """the batches created after `after`, the latest first."""
+        batches = sorted(self.batches.values(),
+                         key=lambda x: x.created_at,
+                         reverse=True)
+        if after is not None:
+            ids = [batch.id for batch in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        return [self.get_batch(batch.id)
+                for batch in batches[:limit]], len(batches) > limit
+
+    def cancel_batch(self, batch_id: str) -> Optional[BatchObject]:
+        """cancel a batch."""
+        batch = self.get_batch(batch_id)
+        if batch is None:
+            return None
+        task = self._tasks.get(batch_id)
+        if task is not None:
+            batch.status = 'cancelling'
+            batch.cancelling_at = int(time.time())
+            self._save(batch)
+            task.cancel()
+        return batch
+
+    def resume_batches(self):
+        """restart the batches interrupted by the last shutdown."""
+        for batch in self.batches.values():
+            if batch.status in ('validating', 'in_progress', 'finalizing'):
+                logger.info(f'Resume batch `{batch.id}`.')
+                self._start(batch)
+            elif batch.status == 'cancelling':
+                batch.status = 'cancelled'
+                batch.cancelled_at = int(time.time())
+                self._save(batch)
@@ -137,6 +137,8 @@ class ChatCompletionRequest(BaseModel):
     skip_special_tokens: Optional[bool] = True
     top_k: Optional[int] = 40
     seed: Optional[int] = None
+    priority: Optional[int] = 0
+    deadline: Optional[float] = None
 
 
 class FunctionResponse(BaseModel):
@@ -252,6 +254,8 @@ class CompletionRequest(BaseModel):
     skip_special_tokens: Optional[bool] = True
     top_k: Optional[int] = 40  # for opencompass
     seed: Optional[int] = None
+    priority: Optional[int] = 0
+    deadline: Optional[float] = None
 
 
 class CompletionResponseChoice(BaseModel):
@@ -348,3 +352,60 @@ class GenerateResponse(BaseModel):
     input_tokens: int
     history_tokens: int
     finish_reason: Optional[Literal['stop', 'length']] = None
+
+
+class FileObject(BaseModel):
+    """File object."""
+    id: str = Field(default_factory=lambda: f'file-{shortuuid.random()}')
+    object: str = 'file'
+    bytes: int = 0
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    filename: str = ''
+    purpose: str = 'batch'
+
+
+class BatchRequest(BaseModel):
+    """Batch request."""
+    input_file_id: str
+    endpoint: Literal['/v1/chat/completions', '/v1/completions']
+    completion_window: str = '24h'
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchRequestCounts(BaseModel):
+    """Request counts of a batch."""
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchObject(BaseModel):
+    """Batch object."""
+    id: str = Field(default_factory=lambda: f'batch_{shortuuid.random()}')
+    object: str = 'batch'
+    endpoint: str
+    errors: Optional[Dict[str, Any]] = None
+    input_file_id: str
+    completion_window: str = '24h'
+    status: Literal['validating', 'failed', 'in_progress', 'finalizing',
+                    'completed', 'expired', 'cancelling',
+                    'cancelled'] = 'validating'
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    in_progress_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    cancelling_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts = Field(
+        default_factory=BatchRequestCounts)
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchList(BaseModel):
+    """Batch list."""
+    object: str = 'list'
+    data: List[BatchObject] = []
+    has_more: bool = False
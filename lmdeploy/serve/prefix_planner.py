@@ -0,0 +1,62 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+"""Plan the order of a batch of prompts to reuse the prefix cache."""
+from typing import Dict, List, Tuple
+
+
+class _PrefixNode:
+    """Node of the prefix trie, each node is a block of token ids."""
+    __slots__ = ('children', 'indices')
+
+    def __init__(self):
+        self.children: Dict[Tuple[int, ...], '_PrefixNode'] = dict()
+        # the prompts whose full blocks end at this node
+        self.indices: List[int] = []
+
+
+def _traverse(node: _PrefixNode) -> List[int]:
+    """prompts of the subtree in depth first order."""
+    order = []
+    stack = [node]
+    while len(stack) > 0:
+        node = stack.pop()
+        order += node.indices
+        stack.extend(reversed(node.children.values()))
+    return order
+
+
+def plan_prefix_groups(input_ids: List[List[int]],
+                       block_size: int = 64) -> List[List[int]]:
+    """Group the prompts by their shared prefixes.
+
+    A trie is built over the full blocks of the token ids, the granularity the
+    prefix cache is matched in. The prompts sharing the first block are in
+    the same group, in the depth first order of the trie, so the prompts
+    sharing longer prefixes are adjacent. The groups are in the order of the
+    first appearance of their prompts.
+
+    The first prompt of a group is meant to be run alone to warm the shared
+    prefix, the others are run after its prefill and hit the cache.
+
+    Args:
+        input_ids (List[List[int]]): token ids of the prompts.
+        block_size (int): number of the tokens in a block of the cache.
+    Returns:
+        List[List[int]]: indices of the prompts in each group.
+    """
+    assert block_size > 0
+    root = _PrefixNode()
+    for idx, ids in enumerate(input_ids):
+        node = root
+        for start in range(0, len(ids) - block_size + 1, block_size):
+            key = tuple(ids[start:start + block_size])
+            child = node.children.get(key)
+            if child is None:
+                child = node.children[key] = _PrefixNode()
+            node = child
+        node.indices.append(idx)
+
+    groups = [_traverse(child) for child in root.children.values()]
+    # prompts shorter than a block share nothing with the others
+    groups += [[idx] for idx in root.indices]
+    groups.sort(key=lambda group: min(group))
+    return groups
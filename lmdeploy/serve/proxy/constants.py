@@ -4,6 +4,9 @@ import enum
 
 LATENCY_DEEQUE_LEN = 15
 API_TIMEOUT_LEN = 100
+PREFIX_AFFINITY_LEN = 256
+PREFIX_AFFINITY_LOAD_FACTOR = 1.25
+NUM_VIRTUAL_NODES = 64
 
 
 class Strategy(enum.Enum):
@@ -11,6 +14,7 @@ class Strategy(enum.Enum):
     RANDOM = enum.auto()
     MIN_EXPECTED_LATENCY = enum.auto()
     MIN_OBSERVED_LATENCY = enum.auto()
+    PREFIX_AFFINITY = enum.auto()
 
     @classmethod
     def from_str(cls, name):
@@ -21,9 +25,12 @@ class Strategy(enum.Enum):
             return cls.MIN_EXPECTED_LATENCY
         elif name == 'min_observed_latency':
             return cls.MIN_OBSERVED_LATENCY
+        elif name == 'prefix_affinity':
+            return cls.PREFIX_AFFINITY
         else:
             raise ValueError(f'Invalid strategy: {name}. Supported: random, '
-                             f'min_expected_latency, min_observed_latency.')
+                             f'min_expected_latency, min_observed_latency, '
+                             f'prefix_affinity.')
 
 
 class ErrorCodes(enum.Enum):
@@ -1,21 +1,26 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import asyncio
+import bisect
 import copy
+import hashlib
 import json
+import math
 import os
 import os.path as osp
 import random
 import time
 from collections import deque
 from http import HTTPStatus
-from typing import Deque, Dict, List, Literal, Optional, Union
+from typing import Deque, Dict, List, Literal, Optional, Set, Union
 
+import httpx
 import numpy as np
 import requests
 import uvicorn
 import yaml
 from fastapi import BackgroundTasks, Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 
 from lmdeploy.serve.openai.api_server import (check_api_key,
@@ -24,8 +29,11 @@ from lmdeploy.serve.openai.protocol import (  # noqa: E501
     ChatCompletionRequest, CompletionRequest, ModelCard, ModelList,
     ModelPermission)
 from lmdeploy.serve.proxy.constants import (API_TIMEOUT_LEN,
-                                            LATENCY_DEEQUE_LEN, ErrorCodes,
-                                            Strategy, err_msg)
+                                            LATENCY_DEEQUE_LEN,
+                                            NUM_VIRTUAL_NODES,
+                                            PREFIX_AFFINITY_LEN,
+                                            PREFIX_AFFINITY_LOAD_FACTOR,
+                                            ErrorCodes, Strategy, err_msg)
 from lmdeploy.utils import get_logger
 
 logger = get_logger('lmdeploy')
@@ -46,6 +54,49 @@ class Node(BaseModel):
     status: Optional[Status] = None
 
 
+def _hash_str(text: str) -> int:
+    """stable 64 bit hash of a string."""
+    digest = hashlib.blake2b(text.encode('utf-8', errors='ignore'),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def get_prompt_prefix(prompt: Union[str, List, None],
+                      max_len: int = PREFIX_AFFINITY_LEN) -> Optional[str]:
+    """Get the leading characters of a prompt or a chat history.
+
+    Chat messages are flattened in order as `role: content`, images and other
+    non-text contents are skipped, so requests sharing the same system prompt
+    and leading turns share the same prefix.
+    """
+    if prompt is None:
+        return None
+    if isinstance(prompt, str):
+        return prompt[:max_len]
+    pieces = []
+    length = 0
+    for message in prompt:
+        if isinstance(message, str):
+            text = message
+        elif isinstance(message, dict):
+            content = message.get('content', '')
+            if isinstance(content, list):
+                content = ''.join(
+                    item.get('text', '') for item in content
+                    if isinstance(item, dict) and item.get('type') == 'text')
+            text = f'{message.get("role", "")}: {content or ""}\n'
+        elif isinstance(message, int):
+            # token ids
+            text = f'{message},'
+        else:
+            text = str(message)
+        pieces.append(text)
+        length += len(text)
+        if length >= max_len:
+            break
+    return ''.join(pieces)[:max_len]
+
+
 class NodeManager:
     """Manage all the sub nodes.
 
@@ -59,14 +110,42 @@ class NodeManager:
             - min_observed_latency: Based on previous finished requests. The
                 sooner they get processed, the more requests will be dispatched
                 to.
+            - prefix_affinity: requests sharing the same prompt prefix are
+                dispatched to the same node by consistent hashing, so that
+                the prefix cache of the node can be reused. A request spills
+                over to the next node on the hash ring if the node is much
+                busier than the average.
+        prefix_affinity_len (int): the number of leading characters of the
+            prompt used by `prefix_affinity`.
+        load_factor (float): a node is skipped by `prefix_affinity` if its
+            unfinished requests exceed `load_factor` times the average.
+        max_connections (int): the max number of connections to each node.
+        max_keepalive_connections (int): the max number of idle keep-alive
+            connections to each node.
     """
 
     def __init__(self,
                  config_path: Optional[str] = None,
-                 strategy: str = 'min_expected_latency') -> None:
+                 strategy: str = 'min_expected_latency',
+                 prefix_affinity_len: int = PREFIX_AFFINITY_LEN,
+                 load_factor: float = PREFIX_AFFINITY_LOAD_FACTOR,
+                 max_connections: int = 2048,
+                 max_keepalive_connections: int = 256) -> None:
         self.nodes = dict()
         self.strategy = Strategy.from_str(strategy)
+        self.prefix_affinity_len = prefix_affinity_len
+        self.load_factor = load_factor
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.clients: Dict[str, httpx.AsyncClient] = dict()
+        # clients of the removed nodes, closed after their requests finish.
+        self._removed_clients: Set[httpx.AsyncClient] = set()
+        self._num_requests: Dict[httpx.AsyncClient, int] = dict()
+        self._closing_tasks: Set[asyncio.Task] = set()
         self.latencies = dict()
+        self._ring_urls = None
+        self._ring_keys = []
+        self._ring_nodes = []
         self.config_path = osp.join(osp.dirname(osp.realpath(__file__)),
                                     'proxy_config.yml')
         if config_path is not None:
@@ -113,8 +192,67 @@ class NodeManager:
         """Remove a node."""
         if node_url in self.nodes.keys():
             self.nodes.pop(node_url)
+            client = self.clients.pop(node_url, None)
+            if client is not None:
+                self._removed_clients.add(client)
+                self._close_idle_client(client)
             self.update_config_file()
 
+    def get_client(self, node_url: str) -> httpx.AsyncClient:
+        """Get the pooled keep-alive client of a node."""
+        client = self.clients.get(node_url)
+        if client is None:
+            limits = httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections)
+            client = httpx.AsyncClient(base_url=node_url,
+                                       limits=limits,
+                                       timeout=API_TIMEOUT_LEN)
+            self.clients[node_url] = client
+        return client
+
+    def _acquire_client(self, node_url: str) -> httpx.AsyncClient:
+        """Get the client of a node and count the in-flight request."""
+        client = self.get_client(node_url)
+        self._num_requests[client] = self._num_requests.get(client, 0) + 1
+        return client
+
+    def _release_client(self, client: httpx.AsyncClient):
+        """Finish the in-flight request of the client."""
+        num_requests = self._num_requests.pop(client) - 1
+        if num_requests > 0:
+            self._num_requests[client] = num_requests
+        else:
+            self._close_idle_client(client)
+
+    def _close_idle_client(self, client: httpx.AsyncClient):
+        """Close the client of a removed node if no request is using it.
+
+        Without a running event loop, the client is closed by `close`.
+        """
+        if client not in self._removed_clients:
+            return
+        if client in self._num_requests:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._removed_clients.discard(client)
+        task = loop.create_task(client.aclose())
+        self._closing_tasks.add(task)
+        task.add_done_callback(self._closing_tasks.discard)
+
+    async def close(self):
+        """Close the clients of all nodes."""
+        clients = list(self.clients.values()) + list(self._removed_clients)
+        self.clients.clear()
+        self._removed_clients.clear()
+        for client in clients:
+            await client.aclose()
+        if len(self._closing_tasks) > 0:
+            await asyncio.gather(*self._closing_tasks)
+
     @property
     def model_list(self):
         """Supported model list."""
@@ -128,12 +266,58 @@ class NodeManager:
         """Return the status."""
         return self.nodes
 
-    def get_node_url(self, model_name: str):
-        """Add a node to the manager.
+    def _get_ring(self):
+        """Get the consistent hash ring, rebuilt when nodes changed."""
+        urls = tuple(self.nodes.keys())
+        if urls != self._ring_urls:
+            ring = sorted((_hash_str(f'{url}#{i}'), url) for url in urls
+                          for i in range(NUM_VIRTUAL_NODES))
+            self._ring_keys = [key for key, _ in ring]
+            self._ring_nodes = [url for _, url in ring]
+            self._ring_urls = urls
+        return self._ring_keys, self._ring_nodes
+
+    def _get_affinity_url(self, model_name: str, prefix: str):
+        """Walk the hash ring from the prefix and return the first node
+        serving the model that is not overloaded."""
+        matched_urls = [
+            url for url, status in self.nodes.items()
+            if model_name in status.models
+        ]
+        if len(matched_urls) == 0:
+            return None
+        # bounded loads: capacity of a node after assigning this request.
+        total = sum(self.nodes[url].unfinished for url in matched_urls) + 1
+        capacity = math.ceil(self.load_factor * total / len(matched_urls))
+
+        ring_keys, ring_nodes = self._get_ring()
+        start = bisect.bisect(ring_keys, _hash_str(prefix))
+        num_ring = len(ring_nodes)
+        visited = set()
+        for i in range(num_ring):
+            url = ring_nodes[(start + i) % num_ring]
+            if url in visited:
+                continue
+            visited.add(url)
+            status = self.nodes[url]
+            if model_name not in status.models:
+                continue
+            if status.unfinished < capacity:
+                return url
+            if len(visited) == len(self.nodes):
+                break
+        # unreachable with load_factor >= 1, fallback to the least loaded.
+        return min(matched_urls, key=lambda url: self.nodes[url].unfinished)
+
+    def get_node_url(self,
+                     model_name: str,
+                     prompt: Union[str, List, None] = None):
+        """Get a node url to handle the request.
 
         Args:
-            model_name (str): A http url. Can be the url generated by
-                `lmdeploy serve api_server`.
+            model_name (str): the model in the request.
+            prompt (str | List | None): the prompt or the chat messages of
+                the request, used by `prefix_affinity`.
         Return:
             A node url or None.
         """
@@ -157,7 +341,15 @@ class NodeManager:
                                        ] * len(urls_without_speeds)
             return all_matched_urls, all_the_speeds
 
-        if self.strategy == Strategy.RANDOM:
+        strategy = self.strategy
+        if strategy == Strategy.PREFIX_AFFINITY:
+            prefix = get_prompt_prefix(prompt, self.prefix_affinity_len)
+            if prefix:
+                return self._get_affinity_url(model_name, prefix)
+            # nothing to be affine to, dispatch by expected latency
+            strategy = Strategy.MIN_EXPECTED_LATENCY
+
+        if strategy == Strategy.RANDOM:
             all_matched_urls, all_the_speeds = get_matched_urls()
             if len(all_matched_urls) == 0:
                 return None
@@ -167,7 +359,7 @@ class NodeManager:
                                    weights=weights)[0]
             url = all_matched_urls[index]
             return url
-        elif self.strategy == Strategy.MIN_EXPECTED_LATENCY:
+        elif strategy == Strategy.MIN_EXPECTED_LATENCY:
             all_matched_urls, all_the_speeds = get_matched_urls()
             if len(all_matched_urls) == 0:
                 return None
@@ -184,7 +376,7 @@ class NodeManager:
                     min_index = index
             url = all_matched_urls[min_index]
             return url
-        elif self.strategy == Strategy.MIN_OBSERVED_LATENCY:
+        elif strategy == Strategy.MIN_OBSERVED_LATENCY:
             all_matched_urls, latencies = [], []
             for node_url, node_status in self.nodes.items():
                 if model_name in node_status.models:
@@ -199,7 +391,7 @@ class NodeManager:
             index = np.argmin(np.array(latencies))
             return all_matched_urls[index]
         else:
-            raise ValueError(f'Invalid strategy: {self.strategy}')
+            raise ValueError(f'Invalid strategy: {strategy}')
 
     async def check_request_model(self, model_name) -> Optional[JSONResponse]:
         """Check if a request is valid."""
@@ -217,7 +409,7 @@ class NodeManager:
         """
         logger.info(f'no model name: {model_name}')
         ret = {
-            'error_code': ErrorCodes.MODEL_NOT_FOUND,
+            'error_code': ErrorCodes.MODEL_NOT_FOUND.value,
             'text': err_msg[ErrorCodes.MODEL_NOT_FOUND],
         }
         return json.dumps(ret).encode() + b'\n'
@@ -226,32 +418,32 @@ class NodeManager:
         """Handle the api time out."""
         logger.info(f'api timeout: {node_url}')
         ret = {
-            'error_code': ErrorCodes.API_TIMEOUT,
+            'error_code': ErrorCodes.API_TIMEOUT.value,
             'text': err_msg[ErrorCodes.API_TIMEOUT],
         }
         return json.dumps(ret).encode() + b'\n'
 
-    def stream_generate(self, request: Dict, node_url: str, node_path: str):
-        """Return a generator to handle the input request.
+    async def stream_generate(self, request: Dict, node_url: str,
+                              node_path: str):
+        """Return an async generator to handle the input request.
+
+        The server-sent events of the node are forwarded as they arrive.
 
         Args:
             request (Dict): the input request.
             node_url (str): the node url.
             node_path (str): the node path. Such as `/v1/chat/completions`.
         """
+        client = self._acquire_client(node_url)
         try:
-            response = requests.post(
-                node_url + node_path,
-                json=request,
-                stream=request['stream'],
-                timeout=API_TIMEOUT_LEN,
-            )
-            for chunk in response.iter_lines(decode_unicode=False,
-                                             delimiter=b'\n'):
-                if chunk:
-                    yield chunk + b'\n\n'
-        except requests.exceptions.RequestException as e:  # noqa
+            async with client.stream('POST', node_path,
+                                     json=request) as response:
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+        except httpx.HTTPError as e:  # noqa
             yield self.handle_api_timeout(node_url)
+        finally:
+            self._release_client(client)
 
     async def generate(self, request: Dict, node_url: str, node_path: str):
         """Return a the response of the input request.
@@ -261,15 +453,14 @@ class NodeManager:
             node_url (str): the node url.
             node_path (str): the node path. Such as `/v1/chat/completions`.
         """
+        client = self._acquire_client(node_url)
         try:
-            import httpx
-            async with httpx.AsyncClient() as client:
-                response = await client.post(node_url + node_path,
-                                             json=request,
-                                             timeout=API_TIMEOUT_LEN)
-                return response.text
-        except requests.exceptions.RequestException as e:  # noqa
+            response = await client.post(node_path, json=request)
+            return response.content
+        except httpx.HTTPError as e:  # noqa
             return self.handle_api_timeout(node_url)
+        finally:
+            self._release_client(client)
 
     def pre_call(self, node_url):
         """Preprocess before the request get processed.
@@ -313,6 +504,12 @@ app.add_middleware(
 node_manager = NodeManager()
 
 
+@app.on_event('shutdown')
+async def shutdown():
+    """Close the connections to nodes."""
+    await node_manager.close()
+
+
 @app.get('/v1/models', dependencies=[Depends(check_api_key)])
 def available_models():
     """Show available models."""
@@ -352,7 +549,7 @@ def add_node(node: Node, raw_request: Request = None):
 
 
 @app.post('/nodes/remove', dependencies=[Depends(check_api_key)])
-def remove_node(node_url: str):
+async def remove_node(node_url: str):
     """Show available models."""
     try:
         node_manager.remove(node_url)
@@ -399,7 +596,7 @@ async def chat_completions_v1(request: ChatCompletionRequest,
     check_response = await node_manager.check_request_model(request.model)
     if check_response is not None:
         return check_response
-    node_url = node_manager.get_node_url(request.model)
+    node_url = node_manager.get_node_url(request.model, request.messages)
     if not node_url:
         return node_manager.handle_unavailable_model(request.model)
 
@@ -409,12 +606,14 @@ async def chat_completions_v1(request: ChatCompletionRequest,
         response = node_manager.stream_generate(request_dict, node_url,
                                                 '/v1/chat/completions')
         background_task = node_manager.create_background_tasks(node_url, start)
-        return StreamingResponse(response, background=background_task)
+        return StreamingResponse(response,
+                                 media_type='text/event-stream',
+                                 background=background_task)
     else:
         response = await node_manager.generate(request_dict, node_url,
                                                '/v1/chat/completions')
         node_manager.post_call(node_url, start)
-        return JSONResponse(json.loads(response))
+        return Response(response, media_type='application/json')
 
 
 @app.post('/v1/completions', dependencies=[Depends(check_api_key)])
@@ -457,7 +656,12 @@ async def completions_v1(request: CompletionRequest,
     check_response = await node_manager.check_request_model(request.model)
     if check_response is not None:
         return check_response
-    node_url = node_manager.get_node_url(request.model)
+    prompt = request.prompt
+    if isinstance(prompt, list) and len(prompt) > 0 and isinstance(
+            prompt[0], str):
+        # batched prompts are handled by one node, route by the first one.
+        prompt = prompt[0]
+    node_url = node_manager.get_node_url(request.model, prompt)
     if not node_url:
         return node_manager.handle_unavailable_model(request.model)
 
@@ -467,18 +671,24 @@ async def completions_v1(request: CompletionRequest,
         response = node_manager.stream_generate(request_dict, node_url,
                                                 '/v1/completions')
         background_task = node_manager.create_background_tasks(node_url, start)
-        return StreamingResponse(response, background=background_task)
+        return StreamingResponse(response,
+                                 media_type='text/event-stream',
+                                 background=background_task)
     else:
         response = await node_manager.generate(request_dict, node_url,
                                                '/v1/completions')
         node_manager.post_call(node_url, start)
-        return JSONResponse(json.loads(response))
+        return Response(response, media_type='application/json')
 
 
 def proxy(server_name: str = '0.0.0.0',
           server_port: int = 10086,
           strategy: Literal['random', 'min_expected_latency',
-                            'min_observed_latency'] = 'min_expected_latency',
+                            'min_observed_latency',
+                            'prefix_affinity'] = 'min_expected_latency',
+          prefix_affinity_len: int = PREFIX_AFFINITY_LEN,
+          max_connections: int = 2048,
+          max_keepalive_connections: int = 256,
           api_keys: Optional[Union[List[str], str]] = None,
           ssl: bool = False,
           **kwargs):
@@ -487,14 +697,23 @@ def proxy(server_name: str = '0.0.0.0',
     Args:
         server_name (str): the server name of the proxy. Default to '0.0.0.0'.
         server_port (str): the server port. Default to 10086.
-        strategy ('random' | 'min_expected_latency' | 'min_observed_latency'):
-            the strategy to dispatch requests to nodes. Default to
-            'min_expected_latency'
+        strategy ('random' | 'min_expected_latency' | 'min_observed_latency'
+            | 'prefix_affinity'): the strategy to dispatch requests to nodes.
+            Default to 'min_expected_latency'
+        prefix_affinity_len (int): the number of leading prompt characters
+            hashed by the 'prefix_affinity' strategy. Default to 256.
+        max_connections (int): the max number of pooled connections to each
+            node. Default to 2048.
+        max_keepalive_connections (int): the max number of idle keep-alive
+            connections to each node. Default to 256.
         api_keys (List[str] | str | None): Optional list of API keys. Accepts string type as
             a single api_key. Default to None, which means no api key applied.
         ssl (bool): Enable SSL. Requires OS Environment variables 'SSL_KEYFILE' and 'SSL_CERTFILE'.
     """  # noqa
     node_manager.strategy = Strategy.from_str(strategy)
+    node_manager.prefix_affinity_len = prefix_affinity_len
+    node_manager.max_connections = max_connections
+    node_manager.max_keepalive_connections = max_keepalive_connections
     if api_keys is not None:
         if isinstance(api_keys, str):
             api_keys = api_keys.split(',')
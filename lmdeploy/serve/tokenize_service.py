@@ -0,0 +1,217 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import asyncio
+import copy
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Dict, List, Union
+
+from lmdeploy.metrics import Histogram
+from lmdeploy.tokenizer import HuggingFaceTokenizer, Tokenizer
+from lmdeploy.utils import get_logger
+
+logger = get_logger('lmdeploy')
+
+# texts following a special token in the probes of the split check
+_PROBES = ['hello', ' hello', '\nhello', '\n\nhello world']
+
+
+class TokenizeService:
+    """Tokenize prompts in a pool of threads, off the event loop.
+
+    Each worker holds its own copy of the tokenizer. A prompt is split after
+    the special tokens of the chat template, the fragments before the last
+    one, such as the system prompt, the tool schemas and the history turns,
+    are cached, so that only the variable suffix is tokenized.
+
+    Args:
+        tokenizer (Tokenizer): the tokenizer.
+        num_workers (int): the number of worker threads.
+        cache_size (int): the max number of cached fragments.
+    """
+
+    def __init__(self,
+                 tokenizer: Tokenizer,
+                 num_workers: int = None,
+                 cache_size: int = 1024):
+        if num_workers is None:
+            num_workers = min(4, os.cpu_count() or 1)
+        self.tokenizer = tokenizer
+        self.num_workers = num_workers
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._split_pattern = self._build_split_pattern(tokenizer)
+        # whether a prompt can be split after a special token
+        self._split_safe: Dict[str, bool] = dict()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix='lmdeploy_tokenize')
+        self.tokenize_time = Histogram(
+            'lmdeploy_tokenize_time_seconds',
+            'Time to tokenize a batch of prompts, including the queueing.')
+
+    @staticmethod
+    def _build_split_pattern(tokenizer: Tokenizer):
+        """pattern of the special tokens that split prompts into fragments."""
+        model = tokenizer.model
+        if not isinstance(model, HuggingFaceTokenizer):
+            return None
+        added_tokens = getattr(model.model, 'added_tokens_decoder', None)
+        if not added_tokens:
+            return None
+        # tokens stripping the spaces around them change the fragments
+        tokens = [
+            tok.content for tok in added_tokens.values() if tok.special
+            and len(tok.content) > 0 and not tok.lstrip and not tok.rstrip
+        ]
+        if len(tokens) == 0:
+            return None
+        tokens = sorted(set(tokens), key=len, reverse=True)
+        return re.compile('|'.join(re.escape(tok) for tok in tokens))
+
+    def _get_tokenizer(self):
+        """the tokenizer of current worker."""
+        tokenizer = getattr(self._local, 'tokenizer', None)
+        if tokenizer is None:
+            try:
+                tokenizer = copy.deepcopy(self.tokenizer)
+            except Exception as e:
+                logger.debug(f'Failed to copy tokenizer: {e}')
+                tokenizer = self.tokenizer
+            self._local.tokenizer = tokenizer
+        return tokenizer
+
+    def _is_split_safe(self, tokenizer: Tokenizer, special: str):
+        """whether encoding the texts before and after the special token
+        separately gives the same ids as encoding them together."""
+        safe = self._split_safe.get(special)
+        if safe is not None:
+            return safe
+        texts = [special + probe for probe in _PROBES]
+        expected = tokenizer.encode_batch(texts, add_bos=True)
+        prefix = tokenizer.encode_batch([special], add_bos=True)[0]
+        suffixes = tokenizer.encode_batch(_PROBES,
+                                          add_bos=False,
+                                          add_special_tokens=False)
+        safe = all(ids == prefix + suffix
+                   for ids, suffix in zip(expected, suffixes))
+        if not safe:
+            logger.debug(f'Prompts would not be split after {special}.')
+        self._split_safe[special] = safe
+        return safe
+
+    def _split(self, tokenizer: Tokenizer, prompt: str):
+        """split the prompt into fragments."""
+        if self._split_pattern is None or self.cache_size <= 0:
+            return [prompt]
+        fragments = []
+        start = 0
+        for match in self._split_pattern.finditer(prompt):
+            end = match.end()
+            if end == len(prompt):
+                break
+            if not self._is_split_safe(tokenizer, match.group()):
+                continue
+            fragments.append(prompt[start:end])
+            start = end
+        fragments.append(prompt[start:])
+        return fragments
+
+    def _get_cache(self, key):
+        """get cached ids."""
+        with self._cache_lock:
+            ids = self._cache.get(key)
+            if ids is not None:
+                self._cache.move_to_end(key)
+            return ids
+
+    def _put_cache(self, key, ids: List[int]):
+        """put ids into the cache."""
+        with self._cache_lock:
+            self._cache[key] = ids
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _encode_batch(self, prompts: List[str], add_bos: List[bool]):
+        """encode prompts in a worker."""
+        tokenizer = self._get_tokenizer()
+
+        # the first fragment of a prompt is encoded with special tokens, the
+        # others are not.
+        outputs = []
+        firsts = dict()
+        others = dict()
+        for prompt, bos in zip(prompts, add_bos):
+            fragments = self._split(tokenizer, prompt)
+            output = []
+            for i, frag in enumerate(fragments):
+                key = (frag, i == 0, i == 0 and bos)
+                cached = i + 1 < len(fragments)
+                ids = self._get_cache(key) if cached else None
+                if ids is None:
+                    misses = firsts if i == 0 else others
+                    misses.setdefault(key, []).append((output, i, cached))
+                output.append(ids)
+            outputs.append(output)
+
+        def __encode(misses: Dict, **kwargs):
+            """encode missed fragments."""
+            if len(misses) == 0:
+                return
+            keys = list(misses.keys())
+            for bos in (True, False):
+                batch = [key for key in keys if key[2] == bos]
+                if len(batch) == 0:
+                    continue
+                texts = [key[0] for key in batch]
+                encoded = tokenizer.encode_batch(texts, add_bos=bos, **kwargs)
+                for key, ids in zip(batch, encoded):
+                    for output, i, cached in misses[key]:
+                        output[i] = ids
+                        if cached:
+                            self._put_cache(key, ids)
+
+        __encode(firsts)
+        __encode(others, add_special_tokens=False)
+
+        return [list(chain.from_iterable(output)) for output in outputs]
+
+    async def encode_batch(self, prompts: List[str],
+                           add_bos: Union[bool, List[bool]]):
+        """Tokenize a batch of prompts.
+
+        Args:
+            prompts (List[str]): prompts
+            add_bos (bool | List[bool]): whether to add `bos` token id to
+                the prompts
+        Returns:
+            List[List[int]]: token ids of each prompt
+        """
+        if len(prompts) == 0:
+            return []
+        if isinstance(add_bos, bool):
+            add_bos = [add_bos] * len(prompts)
+        loop = asyncio.get_running_loop()
+        with self.tokenize_time.time():
+            return await loop.run_in_executor(self._executor,
+                                              self._encode_batch, prompts,
+                                              add_bos)
+
+    async def encode(self, prompt: str, add_bos: bool = True):
+        """Tokenize a prompt.
+
+        Args:
+            prompt (str): a prompt
+            add_bos (bool): whether to add `bos` token id to the prompt
+        Returns:
+            List[int]: token ids
+        """
+        return (await self.encode_batch([prompt], add_bos))[0]
+
+    def close(self):
+        """shutdown the workers."""
+        self._executor.shutdown(wait=False)
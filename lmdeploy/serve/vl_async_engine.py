@@ -64,13 +64,11 @@ class VLAsyncEngine(AsyncEngine):
         results = {}
         input_ids = []
         if len(segs) > 1:
-            # yapf: disable
-            images_with_kwargs = await self.vl_prompt_template.async_collect_pil_images(prompt)  # noqa: E501
-            # yapf: enable
+            images_with_kwargs = self.vl_prompt_template.collect_images(prompt)
             features = []
             if len(images_with_kwargs) > 0:
                 images, image_kwargs = list(zip(*images_with_kwargs))
-                features = await self.vl_encoder.async_infer(
+                features = await self.vl_encoder.async_load_and_infer(
                     images, image_kwargs)
 
                 from lmdeploy.vl.templates import MiniCPMVTempateWrapper
@@ -88,22 +86,23 @@ class VLAsyncEngine(AsyncEngine):
                     f'the number of {IMAGE_TOKEN} is not equal '
                     f'to input images, {len(segs) - 1} vs {len(features)}')
                 features = features[:len(segs) - 1]
-            for i, seg in enumerate(segs):
+            segs_ids = await self.tokenize_service.encode_batch(
+                segs,
+                add_bos=[(i == 0) and sequence_start
+                         for i in range(len(segs))])
+            for i, seg_ids in enumerate(segs_ids):
                 if i > 0 and i <= len(features):
                     image_dim = features[i - 1].shape[0]
                     begins.append(len(input_ids))
                     ends.append(begins[-1] + image_dim)
                     input_ids.extend([IMAGE_DUMMY_TOKEN_INDEX] * image_dim)
-                seg_ids = self.tokenizer.encode(seg,
-                                                add_bos=((i == 0)
-                                                         and sequence_start))
                 input_ids.extend(seg_ids)
             ranges = np.stack([begins, ends], axis=1).tolist()
             results['input_embeddings'] = features or None
             results['input_embedding_ranges'] = ranges or None
         else:
-            input_ids = self.tokenizer.encode(decorated,
-                                              add_bos=sequence_start)
+            input_ids = await self.tokenize_service.encode(
+                decorated, add_bos=sequence_start)
 
         results['input_ids'] = input_ids
         results['prompt'] = decorated
@@ -114,6 +113,9 @@ class VLAsyncEngine(AsyncEngine):
                     **kwargs):
         """Inference a batch of prompts."""
         prompts = self._convert_prompts(prompts)
+        # the image tokens of different images are the same, they can not be
+        # grouped by the token ids
+        kwargs.setdefault('prefix_aware', False)
         return super().batch_infer(prompts, **kwargs)
 
     def stream_infer(self, prompts: Union[VLPromptType, List[Dict],
@@ -1,10 +1,15 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import hashlib
 import json
+import os
 import os.path as osp
-from collections import deque
+import re
+import tempfile
+from collections import OrderedDict, deque
 from dataclasses import dataclass
 from typing import List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import torch
 
 from lmdeploy.utils import get_logger
@@ -26,11 +31,14 @@ class DetokenizeState:
             string (prev + new tokens). Default to 0 for the first round.
         read_offset (int): the end index of tokens to be converted to
             string (prev token). Default to 0 for the first round.
+        pending_bytes (bytes | None): the trailing bytes of an unfinished
+            utf-8 character, used by the token bytes table.
     """
     ids_offset: int = 0
     prev_tokens: Optional[List[str]] = None
     prefix_offset: int = 0
     read_offset: int = 0
+    pending_bytes: Optional[bytes] = None
 
     def as_tuple(self) -> Tuple:
         """Return a tuple of states."""
@@ -38,6 +46,239 @@ class DetokenizeState:
                 self.read_offset)
 
 
+def _split_utf8_tail(data: bytes):
+    """split the bytes of an unfinished utf-8 character at the end."""
+    num_bytes = len(data)
+    for pos in range(num_bytes - 1, max(num_bytes - 4, 0) - 1, -1):
+        byte = data[pos]
+        if byte & 0xC0 == 0x80:
+            # continuation byte
+            continue
+        if byte & 0xE0 == 0xC0:
+            char_len = 2
+        elif byte & 0xF0 == 0xE0:
+            char_len = 3
+        elif byte & 0xF8 == 0xF0:
+            char_len = 4
+        else:
+            char_len = 1
+        if num_bytes - pos < char_len:
+            return data[:pos], data[pos:]
+        break
+    return data, b''
+
+
+class TokenBytesTable:
+    """Lookup table from token ids to the bytes they are decoded to.
+
+    Streamed ids are decoded by concatenating their bytes, instead of
+    converting all the previous ids to tokens and strings every round. Only
+    fast tokenizers with byte level or sentencepiece style decoders are
+    supported.
+
+    Args:
+        token_bytes (List[bytes]): the bytes of each token id.
+        special_ids (Sequence[int]): ids of the special tokens.
+        strip_prefix_space (bool): whether the space at the start of the
+            text is removed by the decoder.
+    """
+
+    _BYTE_TOKEN = re.compile(r'<0x([0-9A-Fa-f]{2})>')
+
+    def __init__(self,
+                 token_bytes: List[bytes],
+                 special_ids: Sequence[int],
+                 strip_prefix_space: bool = False):
+        self.token_bytes = token_bytes
+        self.special_ids = set(special_ids)
+        self.strip_prefix_space = strip_prefix_space
+
+    @staticmethod
+    def _get_decoder_type(decoder: dict):
+        """get the type of supported decoders, None if not supported."""
+        if decoder is None:
+            return None
+        decoder_type = decoder['type']
+        if decoder_type == 'ByteLevel':
+            return 'byte_level'
+        if decoder_type == 'Metaspace':
+            return 'metaspace'
+        if decoder_type != 'Sequence':
+            return None
+        types = [dec['type'] for dec in decoder['decoders']]
+        replaces = [
+            dec for dec in decoder['decoders'] if dec['type'] == 'Replace'
+        ]
+        if set(types) - {'Replace', 'ByteFallback', 'Fuse', 'Strip'}:
+            return None
+        if len(replaces) != 1 or replaces[0]['content'] != ' ' or replaces[0][
+                'pattern'].get('String') != '▁':
+            return None
+        if 'ByteFallback' in types:
+            return 'byte_fallback'
+        return 'metaspace'
+
+    @classmethod
+    def build(cls, tokenizer):
+        """build the table of a huggingface tokenizer, return None if the
+        tokenizer is not supported."""
+        if not getattr(tokenizer, 'is_fast', False):
+            return None
+        try:
+            tokenizer_json = json.loads(tokenizer.backend_tokenizer.to_str())
+        except Exception:
+            return None
+        decoder = tokenizer_json.get('decoder')
+        decoder_type = cls._get_decoder_type(decoder)
+        if decoder_type is None:
+            return None
+
+        if decoder_type == 'byte_level':
+            from transformers.models.gpt2.tokenization_gpt2 import \
+                bytes_to_unicode
+            byte_decoder = {c: b for b, c in bytes_to_unicode().items()}
+
+        vocab = tokenizer.get_vocab()
+        added_vocab = tokenizer.get_added_vocab()
+        token_bytes = [b''] * (max(vocab.values()) + 1)
+        for token, token_id in vocab.items():
+            if token in added_vocab:
+                token_bytes[token_id] = token.encode()
+            elif decoder_type == 'byte_level':
+                try:
+                    token_bytes[token_id] = bytes(byte_decoder[c]
+                                                  for c in token)
+                except KeyError:
+                    return None
+            else:
+                match = cls._BYTE_TOKEN.fullmatch(token)
+                if decoder_type == 'byte_fallback' and match is not None:
+                    token_bytes[token_id] = bytes([int(match.group(1), 16)])
+                else:
+                    token_bytes[token_id] = token.replace('▁', ' ').encode()
+
+        if decoder['type'] == 'Metaspace':
+            default_scheme = ('always' if decoder.get('add_prefix_space', True)
+                              else 'never')
+            strip_prefix_space = decoder.get('prepend_scheme',
+                                             default_scheme) != 'never'
+        elif decoder['type'] == 'Sequence':
+            strip_prefix_space = any(dec['type'] == 'Strip'
+                                     for dec in decoder['decoders'])
+        else:
+            strip_prefix_space = False
+        return cls(token_bytes, tokenizer.all_special_ids, strip_prefix_space)
+
+    def get_bytes(self, token_ids: Sequence[int], skip_special_tokens: bool):
+        """concatenate the bytes of the tokens."""
+        token_bytes = self.token_bytes
+        num_tokens = len(token_bytes)
+        special_ids = self.special_ids if skip_special_tokens else ()
+        return b''.join(token_bytes[i] for i in token_ids
+                        if i < num_tokens and i not in special_ids)
+
+    def detokenize_incrementally(self,
+                                 all_input_ids: Sequence[int],
+                                 state: DetokenizeState,
+                                 skip_special_tokens: bool = True):
+        """Incrementally detokenize the input indexes.
+
+        Bytes of an unfinished utf-8 character at the end are kept in the
+        state until the character is completed by the following tokens.
+        """
+        ids_offset = state.ids_offset
+        # ids before read_offset have been decoded, the prompt is taken as
+        # decoded in the first round.
+        read_offset = state.read_offset
+        if state.pending_bytes is None:
+            read_offset = ids_offset
+        pending_bytes = state.pending_bytes or b''
+        data = pending_bytes + self.get_bytes(all_input_ids[ids_offset:],
+                                              skip_special_tokens)
+        data, pending_bytes = _split_utf8_tail(data)
+        new_text = data.decode('utf-8', errors='replace')
+        if len(new_text) > 0:
+            if self.strip_prefix_space and read_offset == 0:
+                new_text = new_text[1:] if new_text[0] == ' ' else new_text
+            read_offset = len(all_input_ids)
+        return new_text, DetokenizeState(len(all_input_ids),
+                                         read_offset=read_offset,
+                                         pending_bytes=pending_bytes)
+
+
+class VocabIndex:
+    """Substring index over the strings of the vocabulary.
+
+    The strings are joined into one text, so a substring is located by the
+    regex engine in one pass and mapped back to the token ids by binary
+    search over the start of each string.
+
+    Args:
+        token_strs (List[str]): the string of each token id.
+    """
+
+    _SEP = '\0'
+
+    def __init__(self, token_strs: List[str]):
+        self.token_strs = token_strs
+        self._text = self._SEP.join(token_strs)
+        lengths = np.array([len(tok) + 1 for tok in token_strs],
+                           dtype=np.int64)
+        self._starts = np.cumsum(lengths) - lengths
+
+    def find(self, sub: str) -> List[int]:
+        """ids of the tokens containing the substring."""
+        if len(sub) == 0 or self._SEP in sub:
+            return []
+        positions = [
+            match.start() for match in re.finditer(re.escape(sub), self._text)
+        ]
+        if len(positions) == 0:
+            return []
+        token_ids = np.searchsorted(self._starts, positions, side='right') - 1
+        return np.unique(token_ids).tolist()
+
+    @staticmethod
+    def _fingerprint(vocab: dict):
+        """fingerprint of the vocabulary the index is built with."""
+        content = json.dumps(sorted(vocab.items()))
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    @classmethod
+    def load(cls, path: str, vocab: dict):
+        """load the index saved with the same vocabulary, None if not
+        available."""
+        if not osp.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data['fingerprint'] != cls._fingerprint(vocab):
+                return None
+            return cls(data['token_strs'])
+        except Exception:
+            return None
+
+    def save(self, path: str, vocab: dict):
+        """save the strings beside the model, skipped if the directory is
+        not writable."""
+        data = dict(fingerprint=self._fingerprint(vocab),
+                    token_strs=self.token_strs)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=osp.dirname(path),
+                                            suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, path)
+            finally:
+                if osp.exists(tmp_path):
+                    os.remove(tmp_path)
+        except Exception as e:
+            get_logger('lmdeploy').debug(
+                f'Failed to save vocab index to {path}: {e}')
+
+
 class SentencePieceTokenizer:
     """Tokenizer of sentencepiece.
 
@@ -121,6 +362,16 @@ class SentencePieceTokenizer:
         """
         return self.model.Encode(s, add_bos=add_bos, **kwargs)
 
+    def encode_batch(self, texts: List[str], add_bos: bool = True, **kwargs):
+        """Tokenize a batch of prompts.
+
+        Args:
+            texts (List[str]): prompts
+        Returns:
+            List[List[int]]: token ids of each prompt
+        """
+        return [self.encode(s, add_bos, **kwargs) for s in texts]
+
     def decode(self,
                t: Sequence[int],
                offset: Optional[int] = None,
@@ -195,10 +446,13 @@ class HuggingFaceTokenizer:
         model_dir (str): the directory of the tokenizer model
     """
 
+    VOCAB_INDEX_FILE = '.lmdeploy_vocab_index.json'
+
     def __init__(self, model_dir: str):
         self._check_transformers_version(model_dir)
         from transformers import AutoTokenizer
         self.logger = get_logger('lmdeploy')
+        self.model_dir = model_dir
         self.model = AutoTokenizer.from_pretrained(model_dir,
                                                    trust_remote_code=True)
         self._prefix_space_tokens = None
@@ -217,9 +471,12 @@ class HuggingFaceTokenizer:
         self._vocab_size_with_added: int = None
         self._maybe_decode_bytes: bool = None
         # TODO maybe lack a constant.py
-        self._indexes_tokens_deque = deque(maxlen=10)
+        self._indexes_cache: OrderedDict = OrderedDict()
+        self.max_indexes_cache_size = 1024
         self.max_indexes_num = 5
-        self.token2id = {}
+        self._vocab_index: VocabIndex = None
+        self._token_bytes_table: TokenBytesTable = None
+        self._token_bytes_table_built = False
 
     def _check_transformers_version(self, model_dir: str):
         import transformers
@@ -289,6 +546,19 @@ class HuggingFaceTokenizer:
         else:
             return decoded
 
+    @property
+    def token_bytes_table(self):
+        """the token bytes table for incremental decoding, None if the
+        tokenizer is not supported."""
+        if not self._token_bytes_table_built:
+            self._token_bytes_table_built = True
+            self._token_bytes_table = TokenBytesTable.build(self.model)
+            if self._token_bytes_table is None:
+                self.logger.info('Token bytes table is not supported by '
+                                 f'{type(self.model).__name__}, fallback to '
+                                 'convert_tokens_to_string.')
+        return self._token_bytes_table
+
     @property
     def maybe_decode_bytes(self):
         """Check if self.model.convert_ids_to_tokens return not a str value."""
@@ -302,33 +572,59 @@ class HuggingFaceTokenizer:
                     break
         return self._maybe_decode_bytes
 
+    def _build_vocab_index(self):
+        """build the substring index of the vocabulary."""
+        vocab_size = self.vocab_size
+        table = self.token_bytes_table
+        if table is not None:
+            token_strs = [
+                tok.decode('utf-8', errors='replace')
+                for tok in table.token_bytes[:vocab_size]
+            ]
+            return VocabIndex(token_strs)
+        if not self.maybe_decode_bytes:
+            token_strs = self.model.convert_ids_to_tokens(
+                list(range(vocab_size)))
+            return VocabIndex(token_strs)
+
+        # decode is much slower than convert_ids_to_tokens, the strings are
+        # saved beside the model.
+        path = osp.join(self.model_dir, self.VOCAB_INDEX_FILE)
+        vocab = self.model.get_vocab()
+        index = VocabIndex.load(path, vocab)
+        if index is not None:
+            return index
+        token_strs = []
+        for i in range(vocab_size):
+            try:
+                token_strs.append(self.model.decode(i))
+            except:  # noqa: E722
+                # some tokens just can't be decoded by `decode`
+                token_strs.append('')
+        index = VocabIndex(token_strs)
+        index.save(path, vocab)
+        return index
+
+    @property
+    def vocab_index(self):
+        """substring index of the vocabulary."""
+        if self._vocab_index is None:
+            self._vocab_index = self._build_vocab_index()
+        return self._vocab_index
+
     def indexes_containing_token(self, token: str):
         """Return all the possible indexes, whose decoding output may contain
         the input token."""
-        # traversing vocab is time consuming, can not be accelerated with
-        # multi threads (computation) or multi process (can't pickle tokenizer)
-        # so, we maintain latest 10 stop words and return directly if matched
-        for _token, _indexes in self._indexes_tokens_deque:
-            if token == _token:
-                return _indexes
-
-        if self.token2id == {}:
-            # decode is slower than convert_ids_to_tokens
-            if self.maybe_decode_bytes:
-                for i in range(self.vocab_size):
-                    try:
-                        self.token2id[self.model.decode(i)] = i
-                    except:  # noqa: E722
-                        # some tokens just can't be decoded by `decode`
-                        pass
-            else:
-                self.token2id = {
-                    self.model.convert_ids_to_tokens(i): i
-                    for i in range(self.vocab_size)
-                }
-        if token == ' ':  # ' ' is special
-            token = '▁'
-        indexes = [i for _token, i in self.token2id.items() if token in _token]
+        indexes = self._indexes_cache.get(token)
+        if indexes is not None:
+            self._indexes_cache.move_to_end(token)
+            return indexes
+
+        query = token
+        if token == ' ' and self.token_bytes_table is None:
+            # ' ' is special
+            query = '▁'
+        indexes = self.vocab_index.find(query)
         if len(indexes) > self.max_indexes_num:
             # multiple id decode to same token
             indexes = [i for i in indexes if self.decode([i]) == token]
@@ -344,7 +640,9 @@ class HuggingFaceTokenizer:
                     f'The token {token}, its length of indexes {indexes} is '
                     'not 1. Currently, it can not be used as stop words')
                 indexes = []
-        self._indexes_tokens_deque.append((token, indexes))
+        self._indexes_cache[token] = indexes
+        if len(self._indexes_cache) > self.max_indexes_cache_size:
+            self._indexes_cache.popitem(last=False)
         return indexes
 
     def encode(self,
@@ -372,6 +670,39 @@ class HuggingFaceTokenizer:
                 encoded = encoded[1:]
         return encoded
 
+    def encode_batch(self,
+                     texts: List[str],
+                     add_bos: bool = True,
+                     add_special_tokens: bool = True,
+                     **kwargs):
+        """Tokenize a batch of prompts. The batch of a fast tokenizer is
+        encoded in parallel without holding the GIL.
+
+        Args:
+            texts (List[str]): prompts
+            add_bos (bool): Whether to add `bos` token id when encoding
+                the prompts
+            add_special_tokens (bool): Whether or not to add special tokens
+                when encoding the prompts
+        Returns:
+            List[List[int]]: token ids of each prompt
+        """
+        if not self.model.is_fast:
+            return [
+                self.encode(s, add_bos, add_special_tokens, **kwargs)
+                for s in texts
+            ]
+        encoded = self.model(texts,
+                             add_special_tokens=add_special_tokens,
+                             return_attention_mask=False,
+                             **kwargs)['input_ids']
+        if not add_bos:
+            encoded = [
+                ids[1:] if len(ids) and ids[0] == self.bos_token_id else ids
+                for ids in encoded
+            ]
+        return encoded
+
     def decode(self,
                t: Sequence[int],
                offset: Optional[int] = None,
@@ -454,6 +785,11 @@ class HuggingFaceTokenizer:
             state (DetokenizeState): an instance of DetokenizeState. Consists
                 of incrementally decoding states.
         """
+        table = self.token_bytes_table
+        if table is not None and state.prev_tokens is None:
+            return table.detokenize_incrementally(
+                all_input_ids, state, skip_special_tokens=skip_special_tokens)
+
         tokenizer = self.model
         ids_offset, prev_tokens, prefix_offset, read_offset = state.as_tuple()
         # This is the first iteration for this sequence
@@ -533,6 +869,18 @@ class ChatGLM4Tokenizer(HuggingFaceTokenizer):
                                                      add_special_tokens=False,
                                                      **kwargs)
 
+    def encode_batch(self,
+                     texts: List[str],
+                     add_bos: bool = True,
+                     add_special_tokens: bool = True,
+                     **kwargs):
+        """tokenize a batch of prompts."""
+        return super(ChatGLM4Tokenizer,
+                     self).encode_batch(texts,
+                                        add_bos,
+                                        add_special_tokens=False,
+                                        **kwargs)
+
 
 class Tokenizer:
     """Tokenize prompts or de-tokenize tokens into texts.
@@ -599,6 +947,27 @@ class Tokenizer:
         """
         return self.model.encode(s, add_bos, add_special_tokens, **kwargs)
 
+    def encode_batch(self,
+                     texts: List[str],
+                     add_bos: bool = True,
+                     add_special_tokens: bool = True,
+                     **kwargs):
+        """Tokenize a batch of prompts.
+
+        Args:
+            texts (List[str]): prompts
+            add_bos (bool): Whether to add `bos` token id when encoding
+                the prompts
+            add_special_tokens (bool): Whether or not to add special tokens
+                when encoding the prompts
+        Returns:
+            List[List[int]]: token ids of each prompt
+        """
+        if isinstance(self.model, SentencePieceTokenizer):
+            return self.model.encode_batch(texts, add_bos, **kwargs)
+        return self.model.encode_batch(texts, add_bos, add_special_tokens,
+                                       **kwargs)
+
     def decode(
         self,
         t: Sequence[int],
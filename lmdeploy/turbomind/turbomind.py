@@ -8,7 +8,7 @@ from concurrent.futures import ThreadPoolExecutor
 from dataclasses import asdict
 from itertools import repeat
 from queue import LifoQueue, Queue
-from typing import Dict, Iterable, List, Union
+from typing import Callable, Dict, Iterable, List, Union
 
 import numpy as np
 import torch
@@ -362,16 +362,19 @@ class TurboMindInstance:
         self.executor = ThreadPoolExecutor(1)
         self.future = self.executor.submit(_func)
 
-    def _async_forward_callback(self, result, ctx, que: LifoQueue):
+    def _async_forward_callback(self, result, ctx, que: LifoQueue,
+                                notify: Callable):
         que.put((False, result))
+        notify()
 
-    def _async_forward_thread(self, inputs, que: LifoQueue):
+    def _async_forward_thread(self, inputs, que: LifoQueue, notify: Callable):
         instance_comm = self.tm_model.model_comm.create_instance_comm(
             self.gpu_count)
 
         def _func():
             output = self.model_inst.forward(inputs, instance_comm)
             que.put((True, output))
+            notify()
 
         self.executor = ThreadPoolExecutor(1)
         self.future = self.executor.submit(_func)
@@ -618,9 +621,21 @@ class TurboMindInstance:
         """
         # start forward thread
         que = LifoQueue()
+        event_loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def _notify():
+            """wake up the generator from the forward thread."""
+            if not event.is_set():
+                event_loop.call_soon_threadsafe(event.set)
+
         from functools import partial
-        _forward_callback = partial(self._async_forward_callback, que=que)
-        _forward_thread = partial(self._async_forward_thread, que=que)
+        _forward_callback = partial(self._async_forward_callback,
+                                    que=que,
+                                    notify=_notify)
+        _forward_thread = partial(self._async_forward_thread,
+                                  que=que,
+                                  notify=_notify)
         if stream_output and not stop:
             logger.info(f'Register stream callback for {session_id}')
             self.model_inst.register_callback(_forward_callback)
@@ -646,9 +661,17 @@ class TurboMindInstance:
         # generator
         while True:
             while que.qsize() == 0:  # let other requests in
-                await asyncio.sleep(0.002)
-
-            finish, tm_outputs = que.get()
+                event.clear()
+                # outputs might be put before the event is cleared
+                if que.qsize() == 0:
+                    await event.wait()
+
+            # the latest output covers the earlier streaming ones
+            with que.mutex:
+                items = list(que.queue)
+                que.queue.clear()
+            finish, tm_outputs = next((item for item in items if item[0]),
+                                      items[-1])
 
             outputs = _tm_dict_to_torch_dict(tm_outputs)
 
@@ -1,8 +1,11 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import asyncio
 import inspect
+import os
 import queue
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from threading import Thread
 from typing import Dict, List, Optional, Union
 
@@ -12,7 +15,9 @@ from PIL.Image import Image
 from lmdeploy.messages import (PytorchEngineConfig, TurbomindEngineConfig,
                                VisionConfig)
 from lmdeploy.utils import get_logger
+from lmdeploy.vl.feature_cache import ImageFeatureCache, digest_image
 from lmdeploy.vl.model.builder import load_vl_model
+from lmdeploy.vl.utils import ImageFetcher, decode_image
 
 logger = get_logger('lmdeploy')
 
@@ -27,52 +32,123 @@ def _raise_exception_on_finish(task: asyncio.Task) -> None:
         raise e
 
 
+@dataclass
+class _Request:
+    """images of a request."""
+    outputs: List
+    que: Union[queue.Queue, asyncio.Queue]
+    num_remain: int
+
+
+@dataclass
+class _WaitingImage:
+    """an image waiting to be batched."""
+    request: _Request
+    index: int
+    image: Image
+    kwargs: Dict
+    bucket: int
+    arrive_time: float
+
+
 class Record:
-    """Batching manager."""
+    """Batching manager.
+
+    Images are put into buckets of similar resolutions. A batch is made of
+    the images in the bucket of the earliest waiting image, so that a high
+    resolution image does not inflate a batch of small images.
+    """
 
     def __init__(self, thread_safe):
         self.thread_safe = thread_safe
-        self.number = []
-        self.waiting = []
-        self.kwargs = []
-        self.done = []
-        self.res_que = []
+        self.waiting: List[_WaitingImage] = []
         self.total = 0
 
+    @staticmethod
+    def _get_bucket(image: Image):
+        """bucket of the image, the areas of the images in a bucket differ
+        by less than 2x."""
+        if not isinstance(image, Image):
+            return 0
+        width, height = image.size
+        return max(width * height, 1).bit_length()
+
     def enqueue(self, images: List[Image], kwargs: List[Dict],
                 que: Union[queue.Queue, asyncio.Queue]):
         """add ith request to manager."""
-        self.number.append(len(images))
-        self.waiting.extend(images)
-        self.kwargs.extend(kwargs)
-        self.res_que.append(que)
+        request = _Request([None] * len(images), que, len(images))
+        now = time.perf_counter()
+        for i, (image, kw) in enumerate(zip(images, kwargs)):
+            self.waiting.append(
+                _WaitingImage(request, i, image, kw, self._get_bucket(image),
+                              now))
         self.total += len(images)
         self.log('received', len(images))
+        if len(images) == 0:
+            self.notify(request)
+
+    def get_wait_time(self, max_wait_time: float):
+        """remaining time for the earliest waiting image to wait for a
+        batch."""
+        if self.total == 0:
+            return None
+        elapsed = time.perf_counter() - self.waiting[0].arrive_time
+        return max_wait_time - elapsed
 
     def dequeue(self, max_batch_size):
-        """try to dequeue max batch size images."""
-        inputs = self.waiting[:max_batch_size]
-        kwargs = self.kwargs[:max_batch_size]
-        self.waiting = self.waiting[max_batch_size:]
-        self.kwargs = self.kwargs[max_batch_size:]
-        self.total -= len(inputs)
-        self.log('process', len(inputs))
-        return inputs, kwargs
-
-    def notify(self):
-        """set result if request i is finished."""
-        if len(self.number) == 0 or self.number[0] > len(self.done):
-            return False
-        num_images = self.number.pop(0)
-        outputs = self.done[:num_images]
-        self.done = self.done[num_images:]
-        que = self.res_que.pop(0)
+        """try to dequeue max batch size images of the same bucket."""
+        bucket = self.waiting[0].bucket
+        items = []
+        waiting = []
+        for item in self.waiting:
+            if len(items) < max_batch_size and item.bucket == bucket:
+                items.append(item)
+            else:
+                waiting.append(item)
+        self.waiting = waiting
+        self.total -= len(items)
+        self.log('process', len(items))
+        return items
+
+    def done(self, items: List[_WaitingImage], outputs: List):
+        """set the outputs of the images."""
+        for item, output in zip(items, outputs):
+            request = item.request
+            if request.num_remain == 0:
+                # the request has failed
+                continue
+            request.outputs[item.index] = output
+            request.num_remain -= 1
+            if request.num_remain == 0:
+                self.notify(request)
+
+    def fail(self, items: List[_WaitingImage], error: Exception):
+        """fail the requests of the images."""
+        requests = []
+        for item in items:
+            if all(req is not item.request for req in requests):
+                requests.append(item.request)
+        for request in requests:
+            # the other images of the request are dropped
+            num_waiting = len(self.waiting)
+            self.waiting = [
+                item for item in self.waiting if item.request is not request
+            ]
+            self.total -= num_waiting - len(self.waiting)
+            request.num_remain = 0
+            request.outputs = error
+            self.notify(request)
+
+    def notify(self, request: _Request):
+        """set result of the finished request."""
+        que = request.que
+        outputs = request.outputs
+        num_images = len(outputs) if isinstance(outputs, list) else 0
         self.log('done', num_images)
         if self.thread_safe:
             que._loop.call_soon_threadsafe(que.put_nowait, outputs)
         else:
             que.put_nowait(outputs)
-        return True
 
     def log(self, task: str, num: int):
         logger.info(f'ImageEncoder {task} {num} images, '
@@ -92,6 +168,21 @@ class ImageEncoder:
             vision_config = VisionConfig()
         self.vision_config = vision_config
         self.max_batch_size = vision_config.max_batch_size
+        self.feature_cache = None
+        if (vision_config.feature_cache_size > 0
+                or vision_config.feature_cache_dir is not None):
+            self.feature_cache = ImageFeatureCache(
+                vision_config.feature_cache_size,
+                cache_dir=vision_config.feature_cache_dir,
+                max_disk_size=vision_config.feature_cache_disk_size,
+                namespace=model_path)
+        self.draft_size = None
+        if vision_config.draft_decode:
+            self.draft_size = self.model.draft_size()
+        self.fetcher = ImageFetcher()
+        num_workers = min(8, os.cpu_count() or 1)
+        self._decode_executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix='lmdeploy_decode')
         torch.cuda.empty_cache()
         self._que: asyncio.Queue = None
         self._loop_task: asyncio.Task = None
@@ -131,24 +222,59 @@ class ImageEncoder:
         return self._que
 
     async def _forward_loop(self):
-        """working loop to process images."""
+        """working loop to process images.
+
+        A batch is launched once it is full or its earliest image has waited
+        for `max_wait_time`. At most `max_inflight_batches` batches are run
+        at the same time. By default the batches are run one by one; more
+        batches let the preprocessing of a batch on cpu overlap the forward of
+        the previous one on gpu, for the thread-safe vision models.
+        """
         logger.info('start ImageEncoder._forward_loop')
         record = Record(self.vision_config.thread_safe)
+        loop = asyncio.get_event_loop()
+        max_wait_time = self.vision_config.max_wait_time
+        max_inflight_batches = self.vision_config.max_inflight_batches
+        executor = ThreadPoolExecutor(max_workers=max_inflight_batches,
+                                      thread_name_prefix='lmdeploy_vision')
+        inflight = set()
+
+        async def __forward(items: List[_WaitingImage]):
+            """forward a batch."""
+            inputs = [item.image for item in items]
+            kwargs = [item.kwargs for item in items]
+            try:
+                outputs = await loop.run_in_executor(executor, self.forward,
+                                                     inputs, kwargs)
+            except Exception as e:
+                logger.error(f'ImageEncoder forward failed: {e}')
+                record.fail(items, e)
+                return
+            record.done(items, outputs)
+
+        getter = None
         while True:
-            while record.total == 0 or (self._que.qsize() and
-                                        record.total < self.max_batch_size):
-                while self._que.qsize() == 0:
-                    await asyncio.sleep(0.01)
-                item = await self._que.get()
-                record.enqueue(item[0], item[1], item[2])
-            inputs, kwargs = record.dequeue(self.max_batch_size)
-            future = asyncio.get_event_loop().run_in_executor(
-                None, self.forward, inputs, kwargs)
-            future.add_done_callback(_raise_exception_on_finish)
-            outputs = await future
-            record.done.extend(outputs)
-            while record.notify():
-                pass
+            if getter is None:
+                getter = asyncio.ensure_future(self._que.get())
+            wait_time = record.get_wait_time(max_wait_time)
+            if record.total < self.max_batch_size and (wait_time is None
+                                                       or wait_time > 0):
+                done, _ = await asyncio.wait({getter}, timeout=wait_time)
+                if getter in done:
+                    record.enqueue(*getter.result())
+                    getter = None
+                    continue
+            if record.total == 0:
+                continue
+
+            while len(inflight) >= max_inflight_batches:
+                await asyncio.wait(inflight,
+                                   return_when=asyncio.FIRST_COMPLETED)
+            items = record.dequeue(self.max_batch_size)
+            task = loop.create_task(__forward(items))
+            task.add_done_callback(_raise_exception_on_finish)
+            task.add_done_callback(inflight.discard)
+            inflight.add(task)
 
     def _init_input_params(self,
                            inputs: List[Image],
@@ -180,11 +306,8 @@ class ImageEncoder:
         results = self.forward(inputs, params)
         return results
 
-    async def async_infer(self,
-                          inputs: List[Image],
-                          params: List[Dict] = None):
-        """async infer."""
-        params = self._init_input_params(inputs, params)
+    async def _async_forward(self, inputs: List[Image], params: List[Dict]):
+        """forward images in the working loop."""
         outputs = asyncio.Queue()
         item = (inputs, params, outputs)
         if self.vision_config.thread_safe:
@@ -192,4 +315,81 @@ class ImageEncoder:
         else:
             self.req_que.put_nowait(item)
         results = await outputs.get()
+        if isinstance(results, Exception):
+            raise results
         return results
+
+    def _decode_images(self, inputs: List[Union[Image, bytes]]):
+        """decode the images that are not decoded yet."""
+        return [
+            x if isinstance(x, Image) else decode_image(x, self.draft_size)
+            for x in inputs
+        ]
+
+    def _get_cached_features(self, inputs: List[Union[Image, bytes]],
+                             params: List[Dict]):
+        """get the keys and the cached features of the images."""
+        if self.draft_size is not None:
+            # features of the draft decoded images differ from the full ones
+            params = [dict(p, draft_size=self.draft_size) for p in params]
+        keys = [digest_image(x, p) for x, p in zip(inputs, params)]
+        features = [self.feature_cache.get(key) for key in keys]
+        return keys, features
+
+    def _put_cached_features(self, keys: List[str], features: List):
+        """put the features of the images into the cache."""
+        for key, feature in zip(keys, features):
+            self.feature_cache.put(key, feature)
+
+    async def async_infer(self,
+                          inputs: List[Union[Image, bytes]],
+                          params: List[Dict] = None):
+        """async infer.
+
+        The inputs could also be the images fetched by `fetch_image`, which
+        are decoded only if their features are not cached.
+        """
+        params = self._init_input_params(inputs, params)
+        loop = asyncio.get_event_loop()
+        if self.feature_cache is None:
+            inputs = await loop.run_in_executor(self._decode_executor,
+                                                self._decode_images, inputs)
+            return await self._async_forward(inputs, params)
+
+        keys, results = await loop.run_in_executor(None,
+                                                   self._get_cached_features,
+                                                   inputs, params)
+        missed = [i for i, feature in enumerate(results) if feature is None]
+        if len(missed) > 0:
+            images = await loop.run_in_executor(self._decode_executor,
+                                                self._decode_images,
+                                                [inputs[i] for i in missed])
+            outputs = await self._async_forward(images,
+                                                [params[i] for i in missed])
+            await loop.run_in_executor(None, self._put_cached_features,
+                                       [keys[i] for i in missed], outputs)
+            for i, feature in zip(missed, outputs):
+                results[i] = feature
+        metrics = self.feature_cache.metrics
+        logger.info(f'ImageEncoder feature cache hit '
+                    f'{len(inputs) - len(missed)}/{len(inputs)} images, '
+                    f'hit rate {metrics.hit_rate:.2%}.')
+        return results
+
+    async def async_load_and_infer(self,
+                                   images: List[Union[str, Image]],
+                                   params: List[Dict] = None):
+        """fetch, decode and infer the images given by urls, local paths,
+        base64 data or Image.Image.
+
+        Each image is sent to the forward loop as soon as it is fetched,
+        instead of waiting for all the images of the request.
+        """
+        params = self._init_input_params(images, params)
+
+        async def __infer(image, param):
+            data = await self.fetcher.fetch(image)
+            return (await self.async_infer([data], [param]))[0]
+
+        return await asyncio.gather(
+            *[__infer(image, param) for image, param in zip(images, params)])
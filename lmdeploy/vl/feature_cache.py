@@ -0,0 +1,215 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import hashlib
+import json
+import os
+import os.path as osp
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Union
+
+import torch
+from PIL.Image import Image
+
+from lmdeploy.utils import get_logger
+
+logger = get_logger('lmdeploy')
+
+_MB = 1 << 20
+
+
+def digest_image(image: Union[bytes, Image], params: Dict = None):
+    """content hash of the image and its processing params."""
+    if image is None:
+        return None
+    hasher = hashlib.sha256()
+    if isinstance(image, Image):
+        hasher.update(f'{image.mode}{image.size}'.encode())
+        hasher.update(image.tobytes())
+    else:
+        hasher.update(image)
+    if params:
+        hasher.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return hasher.hexdigest()
+
+
+def _to_cpu(feature: Any):
+    """move the tensors of the feature to cpu."""
+    if isinstance(feature, torch.Tensor):
+        return feature.cpu()
+    if isinstance(feature, dict):
+        return {k: _to_cpu(v) for k, v in feature.items()}
+    if isinstance(feature, (list, tuple)):
+        return type(feature)(_to_cpu(v) for v in feature)
+    return feature
+
+
+def _get_nbytes(feature: Any):
+    """memory size of the tensors of the feature."""
+    if isinstance(feature, torch.Tensor):
+        return feature.numel() * feature.element_size()
+    if isinstance(feature, dict):
+        return sum(_get_nbytes(v) for v in feature.values())
+    if isinstance(feature, (list, tuple)):
+        return sum(_get_nbytes(v) for v in feature)
+    return 0
+
+
+@dataclass
+class FeatureCacheMetrics:
+    """Metrics of the feature cache."""
+    num_hits: int = 0
+    num_disk_hits: int = 0
+    num_misses: int = 0
+
+    @property
+    def hit_rate(self):
+        """ratio of the images hitting the cache."""
+        total = self.num_hits + self.num_disk_hits + self.num_misses
+        if total == 0:
+            return 0.0
+        return (self.num_hits + self.num_disk_hits) / total
+
+
+class ImageFeatureCache:
+    """Content addressed cache of the vision features.
+
+    The recently used features are kept in memory, the features evicted from
+    memory are spilled to the disk tier if `cache_dir` is given.
+
+    Args:
+        max_memory_size (int): max memory in MB of the cached features.
+        cache_dir (str): directory of the disk tier.
+        max_disk_size (int): max disk space in MB of the disk tier.
+        namespace (str): features of different models are put in different
+            sub directories of `cache_dir`.
+    """
+
+    def __init__(self,
+                 max_memory_size: int,
+                 cache_dir: str = None,
+                 max_disk_size: int = 0,
+                 namespace: str = ''):
+        self.max_memory_size = max_memory_size * _MB
+        self.max_disk_size = max_disk_size * _MB
+        self.metrics = FeatureCacheMetrics()
+        self._lock = threading.Lock()
+        self._memory: OrderedDict = OrderedDict()
+        self._memory_size = 0
+        self._disk: OrderedDict = OrderedDict()
+        self._disk_size = 0
+        self.cache_dir = None
+        if cache_dir is not None and self.max_disk_size > 0:
+            namespace = hashlib.sha256(namespace.encode()).hexdigest()[:16]
+            self.cache_dir = osp.join(cache_dir, namespace)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        """index the features saved by previous runs."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pt'):
+                continue
+            stat = os.stat(osp.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, name[:-3], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_size += size
+        self._evict_disk()
+
+    def _get_path(self, key: str):
+        """path of the feature on disk."""
+        return osp.join(self.cache_dir, f'{key}.pt')
+
+    def _evict_memory(self):
+        """evict the least recently used features from memory."""
+        evicted = []
+        while self._memory_size > self.max_memory_size and len(self._memory):
+            key, feature = self._memory.popitem(last=False)
+            self._memory_size -= _get_nbytes(feature)
+            evicted.append((key, feature))
+        return evicted
+
+    def _evict_disk(self):
+        """remove the least recently used features from disk."""
+        while self._disk_size > self.max_disk_size and len(self._disk):
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            try:
+                os.remove(self._get_path(key))
+            except OSError:
+                pass
+
+    def _save(self, key: str, feature: Any):
+        """save the feature to disk."""
+        if self.cache_dir is None or key in self._disk:
+            return
+        path = self._get_path(key)
+        try:
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            torch.save(feature, tmp_path)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except Exception as e:
+            logger.warning(f'Failed to save vision feature to {path}: {e}')
+            return
+        with self._lock:
+            self._disk[key] = size
+            self._disk_size += size
+            self._evict_disk()
+
+    def _load(self, key: str):
+        """load the feature from disk."""
+        with self._lock:
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+        try:
+            return torch.load(self._get_path(key), map_location='cpu')
+        except Exception as e:
+            logger.warning(f'Failed to load vision feature {key}: {e}')
+            with self._lock:
+                size = self._disk.pop(key, 0)
+                self._disk_size -= size
+            return None
+
+    def get(self, key: str):
+        """get the cached feature, None if missed."""
+        if key is None:
+            return None
+        with self._lock:
+            feature = self._memory.get(key)
+            if feature is not None:
+                self._memory.move_to_end(key)
+                self.metrics.num_hits += 1
+                return feature
+        if self.cache_dir is not None:
+            feature = self._load(key)
+            if feature is not None:
+                self.metrics.num_disk_hits += 1
+                self._put_memory(key, feature)
+                return feature
+        self.metrics.num_misses += 1
+        return None
+
+    def _put_memory(self, key: str, feature: Any):
+        """put the feature in memory, spill the evicted ones to disk."""
+        nbytes = _get_nbytes(feature)
+        if nbytes > self.max_memory_size:
+            self._save(key, feature)
+            return
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = feature
+            self._memory_size += nbytes
+            evicted = self._evict_memory()
+        for evicted_key, evicted_feature in evicted:
+            self._save(evicted_key, evicted_feature)
+
+    def put(self, key: str, feature: Any):
+        """put the feature into the cache."""
+        if key is None:
+            return
+        self._put_memory(key, _to_cpu(feature))
@@ -1,6 +1,6 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 from abc import ABC, abstractmethod
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import PIL
 import torch
@@ -50,6 +50,17 @@ class VisonModel(ABC):
         """
         raise NotImplementedError()
 
+    def draft_size(self) -> Optional[Tuple[int, int]]:
+        """the size that the images could be downsampled to while they are
+        decoded, used if `draft_decode` is enabled.
+
+        The images decoded at a reduced scale are close to, but not the same
+        as, the full resolution ones resized by the model, so the outputs of
+        `forward` may slightly differ. None means the full resolution is
+        required.
+        """
+        return None
+
     @classmethod
     def match(cls, config: AutoConfig):
         """check whether the config match the model."""
@@ -69,6 +69,11 @@ class CogVLMVisionModel(VisonModel):
         self.model = model.model.vision
         self.model.eval()
 
+    def draft_size(self):
+        """images are resized to a fixed size."""
+        image_size = self.hf_config.vision_config['image_size']
+        return (image_size, image_size)
+
     @torch.no_grad()
     def forward(self, images: List[Image]) -> List[torch.Tensor]:
         """forward."""
@@ -81,6 +81,11 @@ class GLM4VisionModel(VisonModel):
                                  (0.26862954, 0.26130258, 0.27577711)),
         ])
 
+    def draft_size(self):
+        """images are resized to a fixed size."""
+        image_size = self.hf_config.vision_config['image_size']
+        return (image_size, image_size)
+
     @torch.no_grad()
     def forward(self, images: List[Image]) -> List[torch.Tensor]:
         """forward."""
@@ -60,6 +60,11 @@ class QwenVisionModel(VisonModel):
 
         self.model = model.transformer.visual.eval()
 
+    def draft_size(self):
+        """images are resized to a fixed size."""
+        image_size = self.hf_config.visual['image_size']
+        return (image_size, image_size)
+
     @torch.no_grad()
     def forward(self, images: List[Image]) -> List[torch.Tensor]:
         """forward."""
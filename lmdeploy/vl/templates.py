@@ -9,7 +9,7 @@ from lmdeploy.archs import get_model_arch
 from lmdeploy.model import BaseModel
 from lmdeploy.utils import get_logger
 from lmdeploy.vl.constants import IMAGE_TOKEN
-from lmdeploy.vl.utils import load_image
+from lmdeploy.vl.utils import decode_image, fetch_image, load_image
 
 logger = get_logger('lmdeploy')
 
@@ -68,6 +68,42 @@ class VLChatTemplateWrapper:
     async def async_collect_pil_images(
             self, messages: Dict) -> List[Tuple[PIL.Image.Image, Dict]]:
         """collect image from messages."""
+        images_with_kwargs = await self.async_collect_images(messages)
+
+        def _inner_call(i, images):
+            images[i][0] = decode_image(images[i][0])
+
+        await asyncio.gather(*[
+            asyncio.get_event_loop().run_in_executor(None, _inner_call, i,
+                                                     images_with_kwargs)
+            for i in range(len(images_with_kwargs))
+        ])
+
+        return images_with_kwargs
+
+    async def async_collect_images(
+        self, messages: Dict
+    ) -> List[Tuple[Union[bytes, PIL.Image.Image, None], Dict]]:
+        """collect image from messages, the images are fetched but not
+        decoded."""
+        images_with_kwargs = self.collect_images(messages)
+
+        def _inner_call(i, images):
+            url_or_data = images[i][0]
+            images[i][0] = fetch_image(url_or_data)
+
+        await asyncio.gather(*[
+            asyncio.get_event_loop().run_in_executor(None, _inner_call, i,
+                                                     images_with_kwargs)
+            for i in range(len(images_with_kwargs))
+        ])
+
+        return images_with_kwargs
+
+    def collect_images(
+            self,
+            messages: Dict) -> List[Tuple[Union[str, PIL.Image.Image], Dict]]:
+        """collect the urls or the data of the images from messages."""
         images_with_kwargs = []
         for message in messages:
             role = message['role']
@@ -91,17 +127,6 @@ class VLChatTemplateWrapper:
                         images_with_kwargs.append([data, item_copy])
                     except KeyError:
                         logger.error(f'invalid format {message}')
-
-        def _inner_call(i, images):
-            url_or_data = images[i][0]
-            images[i][0] = load_image(url_or_data)
-
-        await asyncio.gather(*[
-            asyncio.get_event_loop().run_in_executor(None, _inner_call, i,
-                                                     images_with_kwargs)
-            for i in range(len(images_with_kwargs))
-        ])
-
         return images_with_kwargs
 
     def append_image_token(self, prompt, num_images: int):
@@ -1,9 +1,14 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import asyncio
 import base64
 import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Union
+from typing import Tuple, Union
+from urllib.parse import urlparse
 
+import httpx
 import requests
 from PIL import Image, ImageFile
 
@@ -51,8 +56,14 @@ def load_image_from_base64(image: Union[bytes, str]) -> Image.Image:
     return Image.open(BytesIO(base64.b64decode(image)))
 
 
-def load_image(image_url: Union[str, Image.Image]) -> Image.Image:
-    """load image from url, local path or openai GPT4V."""
+def fetch_image(image_url: Union[str, Image.Image]):
+    """fetch the encoded image from url, local path or openai GPT4V, the
+    image is not decoded.
+
+    Returns:
+        bytes | Image.Image | None: the encoded image, the image itself if
+            it is an Image.Image, None if it fails to be fetched.
+    """
     FETCH_TIMEOUT = int(os.environ.get('LMDEPLOY_FETCH_TIMEOUT', 10))
     headers = {
         'User-Agent':
@@ -60,28 +71,128 @@ def load_image(image_url: Union[str, Image.Image]) -> Image.Image:
         '(KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
     }
     try:
-        ImageFile.LOAD_TRUNCATED_IMAGES = True
         if isinstance(image_url, Image.Image):
-            img = image_url
+            return image_url
         elif image_url.startswith('http'):
             response = requests.get(image_url,
                                     headers=headers,
                                     timeout=FETCH_TIMEOUT)
             response.raise_for_status()
-            img = Image.open(BytesIO(response.content))
+            return response.content
         elif image_url.startswith('data:image'):
-            img = load_image_from_base64(image_url.split(',')[1])
+            return base64.b64decode(image_url.split(',')[1])
         else:
             # Load image from local path
-            img = Image.open(image_url)
-
-        # check image valid
-        img = img.convert('RGB')
+            with open(image_url, 'rb') as f:
+                return f.read()
     except Exception as error:
         if isinstance(image_url, str) and len(image_url) > 100:
             image_url = image_url[:100] + ' ...'
         logger.error(f'{error}, image_url={image_url}')
+        return None
+
+
+def decode_image(image: Union[bytes, Image.Image, None],
+                 draft_size: Tuple[int, int] = None) -> Image.Image:
+    """decode the image fetched by `fetch_image`.
+
+    Args:
+        image (bytes | Image.Image | None): the fetched image.
+        draft_size (Tuple[int, int]): if given, the image is decoded at the
+            smallest scale not smaller than the size. It only works for the
+            formats supporting draft mode, such as JPEG.
+    """
+    try:
+        if image is None:
+            raise ValueError('failed to fetch image')
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+        if isinstance(image, Image.Image):
+            img = image
+        else:
+            img = Image.open(BytesIO(image))
+            if draft_size is not None:
+                img.draft('RGB', draft_size)
+        # check image valid
+        img = img.convert('RGB')
+    except Exception as error:
+        logger.error(f'{error}, failed to decode image')
         # use dummy image
         img = Image.new('RGB', (32, 32))
 
     return img
+
+
+def load_image(image_url: Union[str, Image.Image]) -> Image.Image:
+    """load image from url, local path or openai GPT4V."""
+    return decode_image(fetch_image(image_url))
+
+
+class ImageFetcher:
+    """Fetch images asynchronously.
+
+    The images on the web are fetched with pooled keep-alive clients, one
+    for each event loop, and the concurrent requests to a host are limited.
+    The others are read in a pool of threads.
+
+    Args:
+        max_connections (int): the max connections of a client.
+        max_connections_per_host (int): the max concurrent requests to a
+            host.
+        num_workers (int): the number of threads reading the other images.
+    """
+
+    def __init__(self,
+                 max_connections: int = 64,
+                 max_connections_per_host: int = 8,
+                 num_workers: int = 8):
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix='lmdeploy_fetch')
+        # clients and host semaphores are bound to event loops
+        self._loop_states = weakref.WeakKeyDictionary()
+
+    def _get_loop_state(self):
+        """get the client and host semaphores of current event loop."""
+        loop = asyncio.get_running_loop()
+        state = self._loop_states.get(loop)
+        if state is None:
+            FETCH_TIMEOUT = int(os.environ.get('LMDEPLOY_FETCH_TIMEOUT', 10))
+            headers = {
+                'User-Agent':
+                'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                '(KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+            }
+            limits = httpx.Limits(max_connections=self.max_connections)
+            client = httpx.AsyncClient(headers=headers,
+                                       limits=limits,
+                                       timeout=FETCH_TIMEOUT,
+                                       follow_redirects=True)
+            state = (client, dict())
+            self._loop_states[loop] = state
+        return state
+
+    async def fetch(self, image_url: Union[str, Image.Image]):
+        """fetch the encoded image, refer to `fetch_image`."""
+        if isinstance(image_url, Image.Image):
+            return image_url
+        if not image_url.startswith('http'):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fetch_image,
+                                              image_url)
+        client, semaphores = self._get_loop_state()
+        host = urlparse(image_url).netloc
+        semaphore = semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_connections_per_host)
+            semaphores[host] = semaphore
+        try:
+            async with semaphore:
+                response = await client.get(image_url)
+                response.raise_for_status()
+                return response.content
+        except Exception as error:
+            if len(image_url) > 100:
+                image_url = image_url[:100] + ' ...'
+            logger.error(f'{error}, image_url={image_url}')
+            return None
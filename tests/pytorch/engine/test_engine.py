@@ -0,0 +1,206 @@
+import asyncio
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from lmdeploy.messages import PytorchEngineConfig
+from lmdeploy.pytorch.config import CacheConfig, SchedulerConfig
+from lmdeploy.pytorch.engine.engine import Engine, NoRunningSeqs
+from lmdeploy.pytorch.engine.engine_metrics import EngineMetrics
+from lmdeploy.pytorch.engine.request import Request, RequestType
+from lmdeploy.pytorch.messages import MessageStatus, SamplingParam
+from lmdeploy.pytorch.paging import Scheduler
+
+
+def _next_token(token_ids):
+    """next token generated by the stub model, never eos."""
+    return token_ids % 30 + 2
+
+
+class _StubModelAgent:
+    """model agent without a model, the logits select the next token of the
+    inputs."""
+
+    def __init__(self, vocab_size: int = 32):
+        self.model_config = SimpleNamespace(eos_token_id=[0],
+                                            bos_token_id=1,
+                                            cogvlm_style=False)
+        self.vocab_size = vocab_size
+        self.cache_maps = []
+        self.num_launched = 0
+
+    def _forward(self, inputs, swap_in_map, swap_out_map, copy_map=None):
+        self.cache_maps.append((swap_in_map, swap_out_map, copy_map or {}))
+        input_ids = inputs.input_ids
+        logits = torch.zeros(*input_ids.shape,
+                             self.vocab_size,
+                             device=input_ids.device)
+        logits.scatter_(-1, _next_token(input_ids)[..., None], 1.0)
+        return dict(logits=logits)
+
+    async def async_forward(self,
+                            inputs,
+                            swap_in_map,
+                            swap_out_map,
+                            copy_map=None):
+        return self._forward(inputs, swap_in_map, swap_out_map, copy_map)
+
+    def launch_forward(self, inputs, swap_in_map, swap_out_map, copy_map=None):
+        self.num_launched += 1
+        return self._forward(inputs, swap_in_map, swap_out_map, copy_map)
+
+
+def _build_engine(enable_overlap: bool = False):
+    """engine with a stub model agent, the loop is not started."""
+    scheduler_config = SchedulerConfig(max_batches=4,
+                                       max_session_len=128,
+                                       max_request_output_len=64,
+                                       prefill_interval=4)
+    cache_config = CacheConfig(max_batches=4,
+                               block_size=16,
+                               num_cpu_blocks=4,
+                               num_gpu_blocks=16)
+    engine = Engine.__new__(Engine)
+    engine.engine_config = PytorchEngineConfig(enable_overlap=enable_overlap)
+    engine.scheduler_config = scheduler_config
+    engine.cache_config = cache_config
+    engine.scheduler = Scheduler(scheduler_config, cache_config)
+    engine.adapter_manager = engine.scheduler.adapter_manager
+    engine.model_agent = _StubModelAgent()
+    engine.metrics = EngineMetrics(engine.scheduler)
+    engine.spec_decoder = None
+    engine._create_buffers()
+    return engine
+
+
+@pytest.fixture
+def engine():
+    yield _build_engine()
+
+
+def _add_message(engine, session_id, token_ids, sampling_param):
+    req = Request(type=RequestType.ADD_MESSAGE,
+                  sender_id=0,
+                  req_id=0,
+                  data=dict(session_id=session_id,
+                            token_ids=token_ids,
+                            sampling_param=sampling_param,
+                            adapter_name=None))
+    engine._on_add_message([req])
+    sess = engine.scheduler.sessions[session_id]
+    return next(iter(sess.sequences.values()))
+
+
+def test_session_guided_state(engine):
+    engine.scheduler.add_session(0)
+    response_format = dict(type='regex_schema', regex_schema='[0-9]+')
+    msg = _add_message(engine, 0, [1, 2, 3],
+                       SamplingParam(response_format=response_format))
+
+    # the state is built by the engine loop and finished by the request
+    msg.guided_state = object()
+    msg.status = MessageStatus.STOPPED
+
+    # next request of the session is not guided by previous format
+    next_msg = _add_message(engine, 0, [4, 5], SamplingParam())
+    assert next_msg is msg
+    assert msg.status == MessageStatus.WAITING
+    assert msg.guided_state is None
+
+
+def test_queue_time(engine):
+    metrics = EngineMetrics(engine.scheduler)
+    engine.scheduler.add_session(0)
+    msg = _add_message(engine, 0, [1, 2, 3], SamplingParam())
+    metrics.on_schedule([msg], is_prefill=True)
+    assert metrics.queue_time.count == 1
+
+    # recomputed after preemption, the request is not queued again
+    msg.update_token_ids([4])
+    metrics.on_schedule([msg], is_prefill=True)
+    assert metrics.queue_time.count == 1
+
+    # next request of the session
+    msg.status = MessageStatus.STOPPED
+    _add_message(engine, 0, [5, 6], SamplingParam())
+    metrics.on_schedule([msg], is_prefill=True)
+    assert metrics.queue_time.count == 2
+
+
+async def _async_generate(engine):
+    """run the engine loop until all the sequences stop."""
+    in_que = asyncio.Queue()
+    out_que = asyncio.Queue()
+    loop_background = asyncio.get_event_loop().create_task(
+        engine._async_loop_background(in_que, out_que))
+    outputs = defaultdict(list)
+    finished = set()
+
+    async def __step(is_prefill):
+        in_que.put_nowait(is_prefill)
+        finish = False
+        while not finish:
+            finish, out = await out_que.get()
+            if isinstance(out, NoRunningSeqs):
+                break
+            if isinstance(out, Exception):
+                raise out
+            step_outputs = engine._make_infer_outputs(*out)
+            for out in step_outputs.values():
+                key = (out.session_id, out.index)
+                assert key not in finished
+                outputs[key] += out.token_ids
+                if out.finish:
+                    finished.add(key)
+
+    try:
+        while engine.scheduler.has_unfinished():
+            if engine.scheduler.has_waiting():
+                await __step(True)
+            if engine.scheduler.has_running():
+                await __step(False)
+    finally:
+        loop_background.cancel()
+    assert finished == set(outputs)
+    return dict(outputs)
+
+
+def _generate(enable_overlap: bool):
+    engine = _build_engine(enable_overlap)
+    for session_id in range(3):
+        engine.scheduler.add_session(session_id)
+    _add_message(engine, 0, [1, 2, 3], SamplingParam(max_new_tokens=6))
+    _add_message(engine, 1, [4, 5],
+                 SamplingParam(max_new_tokens=16, stop_words=[11]))
+    # the forks write to the last block of the prompt
+    _add_message(engine, 2, [1] * 20, SamplingParam(max_new_tokens=4, n=2))
+    outputs = asyncio.new_event_loop().run_until_complete(
+        _async_generate(engine))
+    return outputs, engine.model_agent
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='requires cuda')
+def test_overlap():
+    outputs, agent = _generate(enable_overlap=False)
+    assert agent.num_launched == 0
+    assert outputs == {
+        (0, 0): [5, 7, 9, 11, 13, 15],
+        (1, 0): [7, 9],
+        (2, 0): [3, 5, 7, 9],
+        (2, 1): [3, 5, 7, 9],
+    }
+
+    overlap_outputs, overlap_agent = _generate(enable_overlap=True)
+    assert overlap_agent.num_launched > 0
+    assert overlap_outputs == outputs
+
+    # cache ops are performed once, by the first forward of a step
+    def __get_cache_maps(agent):
+        return [maps for maps in agent.cache_maps if any(maps)]
+
+    cache_maps = __get_cache_maps(agent)
+    assert len(cache_maps) == 1
+    assert len(cache_maps[0][2]) == 1
+    assert __get_cache_maps(overlap_agent) == cache_maps
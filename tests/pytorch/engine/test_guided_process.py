@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+pytest.importorskip('outlines')
+
+
+@pytest.fixture
+def tokens():
+    yield [str(i) for i in range(10)] + list('abc{}":,')
+
+
+def _build_tokenizer(tokens):
+    """character level tokenizer of the tokens."""
+    from tokenizers import Regex, Tokenizer
+    from tokenizers.decoders import Fuse
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import Split
+    from transformers import PreTrainedTokenizerFast
+
+    vocab = dict(
+        (tok, idx) for idx, tok in enumerate(['<unk>', '</s>'] + tokens))
+    backend = Tokenizer(WordLevel(vocab, unk_token='<unk>'))
+    backend.pre_tokenizer = Split(Regex('.'), behavior='isolated')
+    backend.decoder = Fuse()
+    return PreTrainedTokenizerFast(tokenizer_object=backend,
+                                   unk_token='<unk>',
+                                   eos_token='</s>')
+
+
+class _CountCompile:
+
+    def __init__(self, monkeypatch):
+        from lmdeploy.pytorch.engine import guided_process
+        self.num_compiled = 0
+        compile_fn = guided_process._compile_guided_logits_processor
+
+        def _compile(*args, **kwargs):
+            self.num_compiled += 1
+            return compile_fn(*args, **kwargs)
+
+        monkeypatch.setattr(guided_process, '_compile_guided_logits_processor',
+                            _compile)
+
+
+def _get_processor(guide, tokenizer, type, cache_dir):
+    """get processor in a fresh memory cache state."""
+    from lmdeploy.pytorch.engine.guided_process import \
+        _get_guided_logits_processor
+    _get_guided_logits_processor.cache_clear()
+    return _get_guided_logits_processor(guide, tokenizer, type, cache_dir)
+
+
+def _get_masks(processor, token_ids, vocab_size):
+    """masks of the states along the token ids."""
+    state = 0
+    masks = [processor.get_allowed_mask(state, vocab_size)]
+    for token_id in token_ids:
+        state = processor.get_next_state(state, token_id)
+        masks.append(processor.get_allowed_mask(state, vocab_size))
+    return masks
+
+
+@pytest.mark.parametrize('type,guide', [
+    ('regex_schema', '[0-9]{2}[a-c]'),
+    ('json_schema', '{"type": "object", "properties": {"a": '
+     '{"type": "integer"}}, "required": ["a"]}'),
+])
+def test_disk_cache(tmp_path, monkeypatch, tokens, type, guide):
+    tokenizer = _build_tokenizer(tokens)
+    vocab_size = len(tokenizer)
+    token_ids = tokenizer.encode('12a' if type == 'regex_schema' else '{"')
+    cache_dir = str(tmp_path)
+    counter = _CountCompile(monkeypatch)
+
+    processor = _get_processor(guide, tokenizer, type, cache_dir)
+    assert counter.num_compiled == 1
+    masks = _get_masks(processor, token_ids, vocab_size)
+
+    # reloaded from the disk by a fresh memory cache
+    reloaded = _get_processor(guide, tokenizer, type, cache_dir)
+    assert counter.num_compiled == 1
+    assert reloaded is not processor
+    reloaded_masks = _get_masks(reloaded, token_ids, vocab_size)
+    for mask, reloaded_mask in zip(masks, reloaded_masks):
+        assert mask.equal(reloaded_mask)
+
+    # another vocabulary does not hit the cache
+    other_tokenizer = _build_tokenizer(tokens + ['d'])
+    _get_processor(guide, other_tokenizer, type, cache_dir)
+    assert counter.num_compiled == 2
+
+
+def test_precompile(tmp_path, monkeypatch, tokens):
+    from lmdeploy.pytorch.engine.logits_process import \
+        precompile_guided_processors
+    tokenizer = _build_tokenizer(tokens)
+    cache_dir = str(tmp_path)
+    response_formats = [
+        dict(type='regex_schema', regex_schema='[a-c]+'),
+        dict(type='json_schema',
+             json_schema=dict(name='test',
+                              schema=dict(
+                                  type='object',
+                                  properties=dict(b=dict(type='integer'))))),
+        dict(type='regex_schema', regex_schema='['),
+    ]
+    precompile_guided_processors(response_formats, tokenizer, cache_dir)
+    cache_files = [
+        name for _, _, names in os.walk(cache_dir) for name in names
+    ]
+    # the invalid regex is skipped
+    assert len(cache_files) == 2
+    assert all(name.endswith('.pkl') for name in cache_files)
+
+    counter = _CountCompile(monkeypatch)
+    from lmdeploy.pytorch.engine.guided_process import \
+        _get_guided_logits_processor
+    _get_guided_logits_processor.cache_clear()
+    precompile_guided_processors(response_formats[:2], tokenizer, cache_dir)
+    assert counter.num_compiled == 0
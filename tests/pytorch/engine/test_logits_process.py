@@ -122,3 +122,40 @@ def test_filter_minp_sorted():
 
     out = _filter_minp_sorted_(scores, min_p)
     torch.testing.assert_close(out, gt)
+
+
+def test_guided_sampling():
+    import numpy as np
+
+    from lmdeploy.pytorch.engine.logits_process import _guided_sampling
+
+    class _GuidedState:
+
+        def __init__(self, allowed_tokens):
+            self.allowed_tokens = allowed_tokens
+
+        def get_allowed_mask(self, vocab_size):
+            allowed = np.zeros(vocab_size, dtype=bool)
+            allowed[self.allowed_tokens] = True
+            return torch.from_numpy(np.packbits(allowed, bitorder='little'))
+
+    filter_value: float = -float('inf')
+    batch_size = 4
+    num_tokens = 21
+    scores = torch.rand(batch_size, num_tokens)
+    gt = scores.clone()
+    allowed_tokens = [[0, 7, 8, 20], None, [3], [15, 16]]
+    guided_states = [
+        None if tokens is None else _GuidedState(tokens)
+        for tokens in allowed_tokens
+    ]
+
+    out = _guided_sampling(guided_states, scores)
+    for idx, tokens in enumerate(allowed_tokens):
+        if tokens is None:
+            torch.testing.assert_close(out[idx], gt[idx])
+            continue
+        mask = torch.ones(num_tokens, dtype=torch.bool)
+        mask[tokens] = False
+        assert (out[idx][mask] == filter_value).all()
+        torch.testing.assert_close(out[idx][tokens], gt[idx][tokens])
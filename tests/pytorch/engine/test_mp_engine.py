@@ -0,0 +1,97 @@
+import asyncio
+import multiprocessing as mp
+import os
+import tempfile
+
+import pytest
+import torch
+
+from lmdeploy.pytorch.engine.mp_engine import EngineServer, MPEngine
+from lmdeploy.pytorch.engine.request import (RequestManager, RequestType,
+                                             Response, ResponseType)
+
+
+class _DummyEngine:
+    engine_config = 'engine_config'
+    cache_config = 'cache_config'
+    model_path = 'model_path'
+
+    def __init__(self):
+        self.req_manager = RequestManager(False)
+        self.req_manager.bind_func(RequestType.ADD_MESSAGE,
+                                   self._on_add_message)
+        self.req_manager.start_loop(self._loop)
+
+    def _on_add_message(self, reqs, **kwargs):
+        for req in reqs:
+            self.req_manager.response(
+                Response(type=ResponseType.FINISH,
+                         sender_id=req.sender_id,
+                         req_id=req.req_id,
+                         data=dict(token_ids=torch.tensor([req.data]))))
+
+    async def _loop(self):
+        while True:
+            if self.req_manager.has_requests():
+                self.req_manager.step()
+            await asyncio.sleep(0.001)
+
+
+def _serve(address, conn):
+    asyncio.run(EngineServer(_DummyEngine(), address).serve(conn))
+
+
+class TestMPEngine:
+
+    @pytest.fixture
+    def engine(self):
+        socket_dir = tempfile.mkdtemp()
+        address = os.path.join(socket_dir, 'engine.sock')
+        ctx = mp.get_context('fork')
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_serve, args=(address, child_conn))
+        proc.start()
+        assert parent_conn.recv() == ('engine_config', 'cache_config',
+                                      'model_path')
+
+        engine = MPEngine.__new__(MPEngine)
+        engine._proc = proc
+        engine._address = address
+        engine._socket_dir = socket_dir
+        engine.req_manager = RequestManager(False)
+        engine.req_manager.start_loop(engine._ipc_loop)
+        yield engine
+        engine.close()
+        assert not proc.is_alive()
+        assert not os.path.exists(socket_dir)
+
+    def test_send_recv(self, engine):
+
+        async def __test():
+            senders = [engine.req_manager.build_sender() for _ in range(3)]
+            req_ids = []
+            for idx, sender in enumerate(senders):
+                req_id = await sender.async_send_async(RequestType.ADD_MESSAGE,
+                                                       idx)
+                req_ids.append(req_id)
+            for idx, (sender, req_id) in enumerate(zip(senders, req_ids)):
+                resp = await sender.async_recv(req_id)
+                assert resp.type == ResponseType.FINISH
+                assert resp.sender_id == sender.sender_id
+                assert resp.data['token_ids'].tolist() == [idx]
+
+            # requests can not be pickled are failed.
+            sender = senders[0]
+            req_id = await sender.async_send_async(RequestType.ADD_MESSAGE,
+                                                   lambda x: x)
+            resp = await sender.async_recv(req_id)
+            assert resp.type == ResponseType.INTERNAL_ENGINE_ERROR
+
+            # stop the ipc loop
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+            await asyncio.sleep(0.01)
+
+        event_loop = asyncio.new_event_loop()
+        event_loop.run_until_complete(__test())
@@ -57,3 +57,30 @@ class TestRequestHander:
         req_id = sender.send_async(RequestType.STOP_ENGINE, 'test')
         resp = sender.recv(req_id)
         assert resp.data == 'test success'
+
+    @pytest.mark.parametrize('thread_safe', [True, False])
+    def test_wait_requests(self, manager, event_loop):
+
+        def __add_message_callback(reqs, **kwargs):
+            for req in reqs:
+                manager.response(
+                    Response(type=ResponseType.FINISH,
+                             sender_id=req.sender_id,
+                             req_id=req.req_id,
+                             data=req.data))
+
+        async def __idle_loop():
+            while True:
+                await manager.wait_requests()
+                manager.step()
+
+        asyncio.set_event_loop(event_loop)
+        manager.bind_func(RequestType.ADD_MESSAGE, __add_message_callback)
+        sender = manager.build_sender()
+        manager.start_loop(__idle_loop)
+
+        for idx in range(3):
+            req_id = sender.send_async(RequestType.ADD_MESSAGE, idx)
+            resp = sender.recv(req_id)
+            assert resp.type == ResponseType.FINISH
+            assert resp.data == idx
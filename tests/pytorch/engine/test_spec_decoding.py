@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+
+
+def test_ngram_lookup():
+    from lmdeploy.pytorch.engine.spec_decoding import NGramDrafter
+
+    drafter = NGramDrafter(max_ngram_size=3, min_ngram_size=1)
+    token_ids = np.array([1, 2, 3, 4, 5, 6, 9, 2, 3, 4, 7, 8, 2, 3, 4])
+    # the first match of the longest suffix wins
+    out = drafter.lookup(token_ids, 2)
+    np.testing.assert_array_equal(out, [5, 6])
+
+    # fall back to shorter ngram
+    token_ids = np.array([1, 2, 3, 4, 9, 8, 4])
+    out = drafter.lookup(token_ids, 4)
+    np.testing.assert_array_equal(out, [9, 8, 4])
+
+    # nothing matched
+    token_ids = np.array([1, 2, 3])
+    assert len(drafter.lookup(token_ids, 4)) == 0
+
+
+def test_accept_draft_tokens():
+    from lmdeploy.pytorch.engine.spec_decoding import accept_draft_tokens
+
+    drafts = [
+        np.array([1, 2, 3]),
+        np.array([], dtype=np.int64),
+        np.array([4, 5])
+    ]
+    sampled = np.array([1, 2, 3, 7, 6, 4, 9, 8])
+    outputs = accept_draft_tokens(drafts, sampled)
+    np.testing.assert_array_equal(outputs[0], [1, 2, 3, 7])
+    np.testing.assert_array_equal(outputs[1], [6])
+    np.testing.assert_array_equal(outputs[2], [4, 9])
+
+
+def test_expand_sampling_inputs():
+    from lmdeploy.pytorch.engine.logits_process import SamplingInputs
+    from lmdeploy.pytorch.engine.spec_decoding import expand_sampling_inputs
+
+    sampling_inputs = SamplingInputs(
+        temperature=torch.tensor([0.5, 1.0]),
+        top_k=torch.tensor([4, 8]),
+        random_seeds=torch.tensor([11, 12]),
+        random_offsets=torch.tensor([3, 5]),
+        max_top_k=8,
+        response_formats=(None, None),
+    )
+    num_rows = torch.tensor([3, 1])
+    out = expand_sampling_inputs(sampling_inputs, num_rows)
+    torch.testing.assert_close(out.temperature,
+                               torch.tensor([0.5, 0.5, 0.5, 1.0]))
+    torch.testing.assert_close(out.top_k, torch.tensor([4, 4, 4, 8]))
+    torch.testing.assert_close(out.random_seeds, torch.tensor([11, 11, 11,
+                                                               12]))
+    torch.testing.assert_close(out.random_offsets, torch.tensor([3, 4, 5, 5]))
+    assert out.max_top_k == 8
+    assert out.response_formats == (None, None, None, None)
@@ -54,8 +54,11 @@ class TestBlockTire:
         node = getattr(seq.logical_blocks, 'last_shared_node', None)
         assert node is not None
         assert node.num_matched == block_size * 2
-        assert np.array_equal(node.tokens, [2] * block_size)
-        assert np.array_equal(node.parent.tokens, [1] * block_size)
+        root = block_trie.get_root(seq.adapter_name)
+        keys = block_trie.hasher(root.hash_key, seq.history_cache[:])
+        assert node.hash_key == keys[1]
+        assert node.parent.hash_key == keys[0]
+        assert block_trie.get_node(keys[0]) is node.parent
         assert node in block_trie.leaves
         assert node.parent not in block_trie.leaves
 
@@ -70,8 +73,8 @@ class TestBlockTire:
         node = getattr(seq.logical_blocks, 'last_shared_node', None)
         assert node is not None
         assert node.num_matched == block_size * 3
-        expect_tokens = [3] * (block_size // 2) + [4] * (block_size // 2)
-        assert np.array_equal(node.tokens, expect_tokens)
+        keys = block_trie.hasher(root.hash_key, seq.history_cache[:])
+        assert node.hash_key == keys[2]
         assert node in block_trie.leaves
         assert len(block_trie.leaves) == 1
 
@@ -97,7 +100,7 @@ class TestBlockTire:
         node = getattr(seq.logical_blocks, 'last_shared_node', None)
         assert node is not None
         assert node.num_matched == block_size
-        assert np.array_equal(node.tokens, [1] * block_size)
+        assert node.parent is block_trie.get_root(seq.adapter_name)
         block_mgr.allocate(seq)
         block_trie.allocate(seq)
         assert len(block_trie.leaves) == 2
@@ -112,6 +115,12 @@ class TestBlockTire:
         ref_cnt = allocator.get_ref_count(logical_blocks.get_real_blocks())
         assert np.array_equal(ref_cnt, [4, 3])
 
+        # test hit rate
+        num_query_tokens = (2 * block_size - 1) + (2 * block_size +
+                                                   block_size // 2 - 1)
+        assert block_trie.num_query_tokens == num_query_tokens
+        assert block_trie.num_hit_tokens == 3 * block_size
+
     def test_evict(self, block_trie, block_size, num_gpu_blocks):
         block_mgr = block_trie.block_manager
         sess = SchedulerSession(0, block_size)
@@ -132,4 +141,171 @@ class TestBlockTire:
         block_trie.evict(4)
         new_leaf = next(iter(block_trie.leaves))
         assert leaf != new_leaf
+        assert block_trie.get_node(leaf.hash_key) is None
+        assert block_trie.get_node(new_leaf.hash_key) is new_leaf
+        assert block_mgr.get_num_free_gpu_blocks() == 5
+
+    def test_hasher(self, block_trie, block_size):
+        hasher = block_trie.hasher
+        tokens = np.arange(block_size * 4)
+        keys = hasher(0, tokens)
+        assert len(keys) == 4
+        assert len(set(keys)) == 4
+
+        # keys are chained
+        assert hasher(keys[1], tokens[block_size * 2:]) == keys[2:]
+        assert hasher(1, tokens) != keys
+
+        # partial block is ignored
+        assert hasher(0, tokens[:-1]) == keys[:3]
+        assert hasher(0, tokens[:block_size - 1]) == []
+
+    def test_evict_lru(self, block_trie, block_size):
+        block_mgr = block_trie.block_manager
+        allocator = block_trie.allocator
+        sess = SchedulerSession(0, block_size)
+        seq0 = sess.add_sequence([1] * block_size * 2 + [0])
+        seq1 = sess.add_sequence([2] * block_size * 2 + [0])
+        for seq in [seq0, seq1]:
+            block_mgr.allocate(seq)
+            block_trie.allocate(seq)
+        assert block_trie.num_evictable == 0
+        leaf0 = seq0.logical_blocks.last_shared_node
+        leaf1 = seq1.logical_blocks.last_shared_node
+
+        # seq0 is released first
+        block_mgr.free(seq0)
+        allocator._log_mem.access_time[leaf0.block] -= 1
+        block_mgr.free(seq1)
+        assert block_trie.num_evictable == 2
+        assert block_trie.evict(1) == 1
+        assert leaf0 not in block_trie.leaves
+        assert leaf0.parent is None
+        assert leaf1 in block_trie.leaves
+
+        # matched leaf is not evictable
+        seq2 = sess.add_sequence([2] * block_size * 2 + [0])
+        block_trie.match(seq2)
+        assert block_trie.num_evictable == 1
+        assert block_trie.evict(4) == 1
+        assert leaf1.parent is not None
+        assert block_trie.evict(4) == 0
+
+        block_mgr.free(seq2)
+        assert block_trie.evict(4) == 2
+        assert len(block_trie.leaves) == 0
+        assert block_mgr.get_num_free_gpu_blocks() == 16
+
+    def test_snapshot(self, block_trie, cache_config, block_size):
+        block_mgr = block_trie.block_manager
+        sess = SchedulerSession(0, block_size)
+        seq0 = sess.add_sequence([1] * block_size * 3 + [0])
+        seq1 = sess.add_sequence([1] * block_size * 2 + [2] * block_size + [0])
+        for seq in [seq0, seq1]:
+            block_mgr.allocate(seq)
+            block_trie.allocate(seq)
+        block_mgr.free(seq0)
+
+        # leaf in use is skipped
+        snapshot = block_trie.get_snapshot()
+        assert snapshot['adapter_names'] == [None]
+        assert np.array_equal(snapshot['parents'], [-1, 0, 1])
+        assert np.array_equal(snapshot['num_matched'],
+                              [block_size, block_size * 2, block_size * 3])
+
+        new_mgr = build_block_manager(cache_config)
+        new_trie = BlockTrie(cache_config, new_mgr)
+        blocks = new_mgr.allocator.allocate(3, 'gpu')
+        new_trie.load_snapshot(snapshot, blocks)
+        assert len(new_trie.leaves) == 1
+        assert new_trie.num_evictable == 1
+
+        seq2 = sess.add_sequence([1] * block_size * 3 + [3])
+        new_trie.match(seq2)
+        assert seq2.history_len == block_size * 3
+        assert np.array_equal(seq2.logical_blocks.get_real_blocks(), blocks)
+
+
+class TestHostPrefixCache:
+
+    @pytest.fixture
+    def block_size(self):
+        yield 16
+
+    @pytest.fixture
+    def cache_config(self, block_size):
+        yield CacheConfig(max_batches=256,
+                          block_size=block_size,
+                          num_cpu_blocks=2,
+                          num_gpu_blocks=8,
+                          enable_prefix_caching=True,
+                          enable_host_prefix_cache=True)
+
+    @pytest.fixture
+    def block_mgr(self, cache_config):
+        yield build_block_manager(cache_config)
+
+    @pytest.fixture
+    def block_trie(self, cache_config, block_mgr):
+        yield BlockTrie(cache_config, block_mgr)
+
+    def test_demote_promote(self, block_trie, block_mgr, block_size):
+        allocator = block_trie.allocator
+        sess = SchedulerSession(0, block_size)
+        token_ids = [1] * block_size * 3 + [0]
+        seq = sess.add_sequence(token_ids)
+        block_mgr.allocate(seq)
+        block_trie.allocate(seq)
+        leaf = seq.logical_blocks.last_shared_node
+        block_mgr.free(seq)
         assert block_mgr.get_num_free_gpu_blocks() == 5
+
+        # demote, host cache can only hold two blocks
+        swap_out_map = dict()
+        assert block_trie.evict(3, swap_out_map) == 3
+        assert len(swap_out_map) == 3
+        assert block_mgr.get_num_free_gpu_blocks() == 8
+        assert block_mgr.get_num_free_cpu_blocks() == 0
+        assert block_trie.num_host_blocks == 1
+        assert leaf.parent is None
+        node = block_trie.get_node(leaf.hash_key)
+        assert node is None
+        assert len(block_trie.leaves) == 1
+        node = next(iter(block_trie.leaves))
+        assert node.on_host and node.parent.on_host
+
+        # leaf without swap in map
+        seq = sess.add_sequence(token_ids)
+        block_trie.match(seq)
+        assert seq.history_len == 0
+
+        # promote
+        swap_in_map = dict()
+        block_trie.match(seq, swap_in_map)
+        assert seq.history_len == block_size * 2
+        assert len(swap_in_map) == 2
+        assert not node.on_host and not node.parent.on_host
+        assert block_mgr.get_num_free_cpu_blocks() == 2
+        ref_cnt = allocator.get_ref_count(seq.logical_blocks.get_real_blocks())
+        assert np.array_equal(ref_cnt, [2, 2])
+
+        # drop without swap out map
+        block_mgr.free(seq)
+        assert block_trie.evict(4) == 2
+        assert len(block_trie.leaves) == 0
+        assert block_mgr.get_num_free_gpu_blocks() == 8
+
+    def test_evict_host(self, block_trie, block_mgr, block_size):
+        sess = SchedulerSession(0, block_size)
+        seq = sess.add_sequence([1] * block_size * 2 + [0])
+        block_mgr.allocate(seq)
+        block_trie.allocate(seq)
+        block_mgr.free(seq)
+        block_trie.evict(2, dict())
+        assert block_trie.num_host_blocks == 1
+        assert block_trie.evict_host(1) == 1
+        assert block_trie.num_host_blocks == 1
+        assert block_trie.evict_host(4) == 1
+        assert block_trie.num_host_blocks == 0
+        assert block_mgr.get_num_free_cpu_blocks() == 2
+        assert len(block_trie.leaves) == 0
@@ -2,42 +2,63 @@ import pytest
 import torch
 
 from lmdeploy.pytorch.config import CacheConfig, SchedulerConfig
-from lmdeploy.pytorch.messages import MessageStatus
+from lmdeploy.pytorch.messages import MessageStatus, SamplingParam
 from lmdeploy.pytorch.paging.scheduler import Scheduler
 
 
-class TestScheduler:
+@pytest.fixture
+def block_size():
+    yield 16
 
-    @pytest.fixture
-    def block_size(self):
-        yield 16
 
-    @pytest.fixture
-    def num_cpu_blocks(self):
-        yield 4
+@pytest.fixture
+def num_cpu_blocks():
+    yield 4
 
-    @pytest.fixture
-    def num_gpu_blocks(self):
-        yield 4
 
-    @pytest.fixture
-    def cache_config(self, block_size, num_cpu_blocks, num_gpu_blocks):
-        yield CacheConfig(max_batches=256,
-                          block_size=block_size,
-                          num_cpu_blocks=num_cpu_blocks,
-                          num_gpu_blocks=num_gpu_blocks)
+@pytest.fixture
+def num_gpu_blocks():
+    yield 4
 
-    @pytest.fixture
-    def scheduler_config(self):
-        yield SchedulerConfig(max_batches=4,
-                              max_session_len=128,
-                              max_request_output_len=64,
-                              eviction_type='recompute')
 
-    @pytest.fixture
-    def scheduler(self, cache_config, scheduler_config):
-        yield Scheduler(scheduler_config=scheduler_config,
-                        cache_config=cache_config)
+@pytest.fixture
+def cache_kwargs():
+    """extra cache config of a test."""
+    yield dict()
+
+
+@pytest.fixture
+def cache_config(block_size, num_cpu_blocks, num_gpu_blocks, cache_kwargs):
+    yield CacheConfig(max_batches=256,
+                      block_size=block_size,
+                      num_cpu_blocks=num_cpu_blocks,
+                      num_gpu_blocks=num_gpu_blocks,
+                      **cache_kwargs)
+
+
+@pytest.fixture
+def scheduler_kwargs():
+    """extra scheduler config of a test."""
+    yield dict()
+
+
+@pytest.fixture
+def scheduler_config(scheduler_kwargs):
+    kwargs = dict(max_batches=4,
+                  max_session_len=128,
+                  max_request_output_len=64,
+                  eviction_type='recompute')
+    kwargs.update(scheduler_kwargs)
+    yield SchedulerConfig(**kwargs)
+
+
+@pytest.fixture
+def scheduler(cache_config, scheduler_config):
+    yield Scheduler(scheduler_config=scheduler_config,
+                    cache_config=cache_config)
+
+
+class TestScheduler:
 
     def test_schedule_base(self, scheduler, block_size, num_gpu_blocks):
         block_manager = scheduler.block_manager
@@ -181,3 +202,325 @@ class TestScheduler:
         assert seq1.status == MessageStatus.WAITING
         assert seq2.status == MessageStatus.RUNNING
         assert block_manager.get_num_free_gpu_blocks() == 0
+
+    def test_preempt_lower_priority(self, scheduler, block_size,
+                                    num_gpu_blocks):
+        block_manager = scheduler.block_manager
+        session = scheduler.add_session(0)
+        seq1 = session.add_sequence(torch.tensor([1] * block_size * 2))
+        scheduler.add_sequence(seq1)
+        seq2 = session.add_sequence(torch.tensor([2] * block_size * 2),
+                                    sampling_param=SamplingParam(priority=-1))
+        scheduler.add_sequence(seq2)
+        scheduler.schedule(is_prefill=True)
+        assert seq1.status == MessageStatus.RUNNING
+        assert seq2.status == MessageStatus.RUNNING
+        assert block_manager.get_num_free_gpu_blocks() == 0
+
+        # the urgent seq2 preempts seq1 with lower priority
+        seq1.update_token_ids(torch.tensor([1] * block_size))
+        seq2.update_token_ids(torch.tensor([2] * block_size))
+        scheduler.schedule(is_prefill=False)
+        assert seq1.status == MessageStatus.WAITING
+        assert seq1.history_len == 0
+        assert seq2.status == MessageStatus.RUNNING
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 3
+
+    def test_fork(self, scheduler, block_size, num_gpu_blocks):
+        block_manager = scheduler.block_manager
+        session = scheduler.add_session(0)
+        seq = session.add_sequence(torch.tensor([1] * (block_size + 2)),
+                                   sampling_param=SamplingParam(n=2))
+        scheduler.add_sequence(seq)
+        scheduler.schedule(is_prefill=True)
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+
+        fork = scheduler.fork_sequence(seq, 1, SamplingParam())
+        seq.update_token_ids(torch.tensor([2]))
+        assert fork.status == MessageStatus.RUNNING
+        assert fork.index == 1
+        assert fork.history_len == block_size + 1
+        assert len(fork.token_ids) == 1
+        # prompt blocks are shared
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+
+        # the last block is written by both sequences
+        output = scheduler.schedule(is_prefill=False)
+        assert len(output.running) == 2
+        assert len(output.copy_map) == 1
+        seq_table, fork_table = scheduler.get_block_tables([seq, fork])
+        assert seq_table[0] == fork_table[0]
+        assert seq_table[1] != fork_table[1]
+        assert output.copy_map == {seq_table[1]: fork_table[1]} or \
+            output.copy_map == {fork_table[1]: seq_table[1]}
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 3
+
+        fork.status = MessageStatus.STOPPED
+        scheduler.remove_sequence(fork)
+        assert block_manager.get_num_free_gpu_blocks() == num_gpu_blocks - 2
+
+    def test_fork_slots(self, scheduler, block_size):
+        session = scheduler.add_session(0)
+        seq1 = session.add_sequence(torch.tensor([1] * 2))
+        scheduler.add_sequence(seq1)
+        scheduler.schedule(is_prefill=True)
+        seq1.update_token_ids(torch.tensor([1]))
+
+        # the forks do not fit in the slots left by the running sequence
+        session = scheduler.add_session(1)
+        seq2 = session.add_sequence(torch.tensor([2] * 2),
+                                    sampling_param=SamplingParam(n=4))
+        scheduler.add_sequence(seq2)
+        output = scheduler.schedule(is_prefill=True)
+        assert len(output.running) == 0
+        assert seq2.status == MessageStatus.WAITING
+
+        seq2.sampling_param.n = 3
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq2]
+
+
+class TestChunkedPrefillScheduler:
+
+    @pytest.fixture
+    def num_gpu_blocks(self):
+        yield 16
+
+    @pytest.fixture
+    def cache_kwargs(self, block_size):
+        yield dict(max_prefill_token_num=block_size * 4)
+
+    @pytest.fixture
+    def scheduler_kwargs(self):
+        yield dict(max_session_len=256, enable_chunked_prefill=True)
+
+    def test_chunked_prefill(self, scheduler, block_size):
+        session = scheduler.add_session(0)
+        seq1 = session.add_sequence(torch.tensor([1] * block_size))
+        scheduler.add_sequence(seq1)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1]
+        assert len(output.chunk_sizes) == 0
+
+        # seq1 decoding
+        seq1.update_token_ids(torch.tensor([1]))
+
+        session = scheduler.add_session(1)
+        seq2 = session.add_sequence(torch.tensor([2] * block_size * 6))
+        scheduler.add_sequence(seq2)
+        output = scheduler.schedule(is_prefill=True)
+
+        # decoding sequence and first chunk are scheduled together
+        assert output.running == [seq1, seq2]
+        assert output.chunk_sizes == {seq2.seq_id: block_size * 3}
+        assert seq2.status == MessageStatus.RUNNING
+        # only the blocks of the chunk are allocated
+        assert len(seq2.logical_blocks) == 3
+
+        # engine put partially prefilled sequence back
+        seq2.set_step(seq2.history_len + output.chunk_sizes[seq2.seq_id])
+        seq2.status = MessageStatus.WAITING
+        seq1.update_token_ids(torch.tensor([1]))
+        output = scheduler.schedule(is_prefill=True)
+
+        # the rest of the prompt fits in the budget
+        assert output.running == [seq1, seq2]
+        assert len(output.chunk_sizes) == 0
+        assert seq2.history_len == block_size * 3
+        assert seq2.num_token_ids == block_size * 3
+        assert len(seq2.logical_blocks) == 6
+
+    def test_unsplittable_prefill(self, scheduler, block_size):
+        session = scheduler.add_session(0)
+        seq1 = session.add_sequence(torch.tensor([1] * block_size))
+        scheduler.add_sequence(seq1)
+        scheduler.schedule(is_prefill=True)
+        seq1.update_token_ids(torch.tensor([1]))
+
+        # logits of the whole prompt can not be returned by chunks
+        session = scheduler.add_session(1)
+        seq2 = session.add_sequence(torch.tensor([2] * block_size * 6),
+                                    return_logits=True)
+        scheduler.add_sequence(seq2)
+        output = scheduler.schedule(is_prefill=True)
+
+        # prefilled alone instead of waiting for decoding to finish
+        assert output.running == [seq2]
+        assert len(output.chunk_sizes) == 0
+        assert seq1.status == MessageStatus.RUNNING
+        assert seq2.status == MessageStatus.RUNNING
+        assert len(seq2.logical_blocks) == 6
+
+
+class TestChunkedPrefillWithPrefixCaching:
+
+    @pytest.fixture
+    def num_gpu_blocks(self):
+        yield 16
+
+    @pytest.fixture
+    def cache_kwargs(self, block_size):
+        yield dict(max_prefill_token_num=block_size * 4,
+                   enable_prefix_caching=True)
+
+    @pytest.fixture
+    def scheduler_kwargs(self):
+        yield dict(max_session_len=256, enable_chunked_prefill=True)
+
+    def _cache_prefix(self, scheduler, token_ids):
+        """prefill and decode a sequence so its blocks are cached."""
+        session = scheduler.add_session(0)
+        seq = session.add_sequence(torch.tensor(token_ids))
+        scheduler.add_sequence(seq)
+        scheduler.schedule(is_prefill=True)
+        seq.update_token_ids(torch.tensor([0]))
+        scheduler.schedule(is_prefill=False)
+        return seq
+
+    def test_rest_fits(self, scheduler, block_size):
+        prefix = [1] * block_size * 4
+        seq1 = self._cache_prefix(scheduler, prefix)
+
+        session = scheduler.add_session(1)
+        seq2 = session.add_sequence(torch.tensor(prefix +
+                                                 [2] * block_size * 2))
+        scheduler.add_sequence(seq2)
+        output = scheduler.schedule(is_prefill=True)
+
+        # the prompt exceeds the budget but the rest after matching fits
+        assert output.running == [seq1, seq2]
+        assert len(output.chunk_sizes) == 0
+        assert seq2.history_len == block_size * 4
+        assert seq2.num_token_ids == block_size * 2
+        assert len(seq2.logical_blocks) == 6
+
+    def test_chunk_after_match(self, scheduler, block_size):
+        prefix = [1] * block_size * 2
+        seq1 = self._cache_prefix(scheduler, prefix)
+
+        session = scheduler.add_session(1)
+        seq2 = session.add_sequence(torch.tensor(prefix +
+                                                 [2] * block_size * 6))
+        scheduler.add_sequence(seq2)
+        output = scheduler.schedule(is_prefill=True)
+
+        # chunk is sized on the tokens left after matching
+        assert output.running == [seq1, seq2]
+        assert seq2.history_len == block_size * 2
+        chunk_size = output.chunk_sizes[seq2.seq_id]
+        assert chunk_size == block_size * 3
+        assert len(seq2.logical_blocks) == 5
+
+        # engine put partially prefilled sequence back
+        seq2.set_step(seq2.history_len + chunk_size)
+        seq2.status = MessageStatus.WAITING
+        assert seq2.num_token_ids == block_size * 3
+        seq1.update_token_ids(torch.tensor([0]))
+        output = scheduler.schedule(is_prefill=True)
+
+        assert output.running == [seq1, seq2]
+        assert len(output.chunk_sizes) == 0
+        assert len(seq2.logical_blocks) == 8
+
+
+class TestSchedulingPolicy:
+
+    @pytest.fixture
+    def policy(self, request):
+        yield request.param
+
+    @pytest.fixture
+    def scheduler_kwargs(self, policy):
+        yield dict(max_batches=1, scheduling_policy=policy)
+
+    def _add_sequence(self, scheduler, session_id, num_tokens, **kwargs):
+        session = scheduler.add_session(session_id)
+        seq = session.add_sequence(torch.tensor([session_id] * num_tokens),
+                                   sampling_param=SamplingParam(**kwargs))
+        scheduler.add_sequence(seq)
+        return seq
+
+    @pytest.mark.parametrize('policy', ['fcfs', 'spf', 'edf'], indirect=True)
+    def test_priority(self, scheduler, block_size):
+        seq0 = self._add_sequence(scheduler, 0, block_size)
+        seq1 = self._add_sequence(scheduler, 1, block_size, priority=-1)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1]
+        assert seq0.status == MessageStatus.WAITING
+
+    @pytest.mark.parametrize('policy', ['spf'], indirect=True)
+    def test_shortest_prompt_first(self, scheduler, block_size):
+        seq0 = self._add_sequence(scheduler, 0, block_size * 2)
+        seq1 = self._add_sequence(scheduler, 1, block_size)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq1]
+        assert seq0.status == MessageStatus.WAITING
+
+    @pytest.mark.parametrize('policy', ['edf'], indirect=True)
+    def test_earliest_deadline_first(self, scheduler, block_size):
+        seq0 = self._add_sequence(scheduler, 0, block_size)
+        seq1 = self._add_sequence(scheduler, 1, block_size, deadline=10.0)
+        seq2 = self._add_sequence(scheduler, 2, block_size, deadline=1.0)
+        output = scheduler.schedule(is_prefill=True)
+        assert output.running == [seq2]
+        assert seq0.status == MessageStatus.WAITING
+        assert seq1.status == MessageStatus.WAITING
+
+
+class TestSwapEviction:
+
+    @pytest.fixture
+    def scheduler_kwargs(self, block_size):
+        yield dict(eviction_type='swap', min_swap_tokens=block_size * 2)
+
+    def test_swap(self, scheduler, block_size, num_gpu_blocks, num_cpu_blocks):
+        block_manager = scheduler.block_manager
+        session = scheduler.add_session(0)
+        seq1 = session.add_sequence(torch.tensor([1] * block_size * 3))
+        scheduler.add_sequence(seq1)
+        seq2 = session.add_sequence(torch.tensor([2] * block_size))
+        scheduler.add_sequence(seq2)
+        scheduler.schedule(is_prefill=True)
+        assert seq1.status == MessageStatus.RUNNING
+        assert seq2.status == MessageStatus.RUNNING
+
+        # long history is swapped out
+        seq1.update_token_ids(torch.tensor([1]))
+        seq1.status = MessageStatus.STOPPED
+        seq2.update_token_ids(torch.tensor([2] * block_size * 2))
+        output = scheduler.schedule(is_prefill=False)
+        assert seq2.status == MessageStatus.RUNNING
+        assert len(output.swap_out_map) == 3
+        assert block_manager.on_device(seq1, 'cpu')
+        assert seq1.history_len == block_size * 3
+        assert block_manager.get_num_free_cpu_blocks() == num_cpu_blocks - 3
+
+        # swap in
+        seq2.status = MessageStatus.STOPPED
+        seq1.status = MessageStatus.WAITING
+        output = scheduler.schedule(is_prefill=True)
+        assert seq1.status == MessageStatus.RUNNING
+        assert len(output.swap_in_map) == 3
+        assert len(output.swap_out_map) == 0
+        assert block_manager.on_device(seq1, 'gpu')
+        assert seq1.history_len == block_size * 3
+        assert seq2.history_len == 0
+        assert block_manager.get_num_free_cpu_blocks() == num_cpu_blocks
+
+    def test_recompute_short(self, scheduler, block_size):
+        block_manager = scheduler.block_manager
+        session = scheduler.add_session(0)
+        seq1 = session.add_sequence(torch.tensor([1] * block_size))
+        scheduler.add_sequence(seq1)
+        scheduler.schedule(is_prefill=True)
+        seq1.update_token_ids(torch.tensor([1]))
+        seq1.status = MessageStatus.STOPPED
+
+        seq2 = session.add_sequence(torch.tensor([2] * block_size * 4))
+        scheduler.add_sequence(seq2)
+        output = scheduler.schedule(is_prefill=True)
+        assert seq2.status == MessageStatus.RUNNING
+        assert len(output.swap_out_map) == 0
+        assert seq1.history_len == 0
+        assert len(seq1.logical_blocks) == 0
+        assert block_manager.get_num_free_gpu_blocks() == 0
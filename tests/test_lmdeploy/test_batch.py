@@ -0,0 +1,151 @@
+import asyncio
+import json
+
+from lmdeploy.serve.openai.batch import BatchManager, BatchRunner
+from lmdeploy.serve.openai.protocol import BatchRequest
+
+
+def _write_requests(path, prompts):
+    with open(path, 'w') as f:
+        for idx, prompt in enumerate(prompts):
+            f.write(
+                json.dumps(
+                    dict(custom_id=f'req-{idx}',
+                         method='POST',
+                         url='/v1/completions',
+                         body=dict(prompt=prompt))) + '\n')
+        f.write('not a json line\n')
+
+
+def _read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class _Handler:
+
+    def __init__(self, fail_at=None):
+        self.prompts = []
+        self.fail_at = fail_at
+
+    async def __call__(self, url, body):
+        if len(self.prompts) == self.fail_at:
+            raise KeyboardInterrupt('interrupted')
+        self.prompts.append(body['prompt'])
+        await asyncio.sleep(0)
+        if body['prompt'] == 'bad':
+            return 400, dict(message='bad prompt')
+        return 200, dict(id=body['prompt'], text=body['prompt'].upper())
+
+
+def test_batch_runner(tmp_path):
+    input_path = str(tmp_path / 'input.jsonl')
+    output_path = str(tmp_path / 'output.jsonl')
+    error_path = str(tmp_path / 'error.jsonl')
+    prompts = ['b1', 'a1', 'bad', 'b2', 'a2']
+    _write_requests(input_path, prompts)
+
+    handler = _Handler()
+    runner = BatchRunner(handler, max_concurrency=1, window_size=4)
+    counts = asyncio.run(runner.run(input_path, output_path, error_path))
+    assert (counts.total, counts.completed, counts.failed) == (6, 4, 2)
+    # requests are sorted in each window
+    assert handler.prompts == ['a1', 'b1', 'b2', 'bad', 'a2']
+    outputs = _read_records(output_path)
+    assert [out['custom_id']
+            for out in outputs] == ['req-1', 'req-0', 'req-3', 'req-4']
+    assert outputs[0]['response']['body']['text'] == 'A1'
+    assert outputs[0]['error'] is None
+    errors = _read_records(error_path)
+    assert sorted(err['response']['status_code']
+                  for err in errors) == [400, 400]
+
+
+def test_batch_runner_resume(tmp_path):
+    input_path = str(tmp_path / 'input.jsonl')
+    output_path = str(tmp_path / 'output.jsonl')
+    prompts = [f'p{idx}' for idx in range(8)]
+    _write_requests(input_path, prompts)
+
+    handler = _Handler(fail_at=3)
+    runner = BatchRunner(handler, max_concurrency=1)
+    try:
+        asyncio.run(runner.run(input_path, output_path))
+    except KeyboardInterrupt:
+        pass
+    # a partially written line of the interrupted job
+    with open(output_path, 'a') as f:
+        f.write('{"custom_id": "req-')
+    assert len(handler.prompts) == 3
+
+    handler = _Handler()
+    runner = BatchRunner(handler, max_concurrency=4)
+    counts = asyncio.run(runner.run(input_path, output_path))
+    assert handler.prompts == prompts[3:]
+    assert (counts.total, counts.completed, counts.failed) == (9, 8, 1)
+    custom_ids = [out['custom_id'] for out in _read_records(output_path)]
+    assert len(custom_ids) == 9
+    assert set(custom_ids) == set(f'req-{idx}'
+                                  for idx in range(8)) | {'line-8'}
+
+
+def test_batch_manager(tmp_path):
+    batch_dir = str(tmp_path / 'batches')
+
+    async def __chunks():
+        for prompt in ['b', 'a']:
+            yield json.dumps(
+                dict(custom_id=prompt,
+                     url='/v1/completions',
+                     body=dict(prompt=prompt))).encode() + b'\n'
+
+    async def __test():
+        manager = BatchManager(batch_dir, _Handler())
+        file = await manager.create_file('input.jsonl', 'batch', __chunks())
+        batch = manager.create_batch(
+            BatchRequest(input_file_id=file.id, endpoint='/v1/completions'))
+        assert batch.status == 'in_progress'
+        await manager._tasks[batch.id]
+        return file, batch
+
+    file, batch = asyncio.run(__test())
+    assert batch.status == 'completed'
+    assert batch.request_counts.completed == 2
+
+    # the files and the batches are reloaded from the batch_dir
+    manager = BatchManager(batch_dir, _Handler())
+    assert manager.files[file.id].bytes == file.bytes
+    batch = manager.get_batch(batch.id)
+    assert batch.status == 'completed'
+    outputs = _read_records(manager.file_path(batch.output_file_id))
+    assert [out['custom_id'] for out in outputs] == ['a', 'b']
+    assert manager.files[batch.output_file_id].purpose == 'batch_output'
+
+
+def test_batch_manager_cancel_and_fail(tmp_path):
+    batch_dir = str(tmp_path / 'batches')
+
+    async def __test():
+        manager = BatchManager(batch_dir, _Handler())
+        # cancelled before it runs
+        cancelled = manager.create_batch(
+            BatchRequest(input_file_id='file-none',
+                         endpoint='/v1/completions'))
+        task = manager._tasks[cancelled.id]
+        manager.cancel_batch(cancelled.id)
+        await asyncio.gather(task, return_exceptions=True)
+        # the input file does not exist
+        failed = manager.create_batch(
+            BatchRequest(input_file_id='file-none',
+                         endpoint='/v1/completions'))
+        await manager._tasks[failed.id]
+        return cancelled, failed
+
+    cancelled, failed = asyncio.run(__test())
+    manager = BatchManager(batch_dir, _Handler())
+    assert manager.get_batch(cancelled.id).status == 'cancelled'
+    batch = manager.get_batch(failed.id)
+    assert batch.status == 'failed'
+    assert batch.request_counts.total == 0
+    assert manager.files[batch.output_file_id].bytes == 0
+    assert manager.files[batch.error_file_id].bytes == 0
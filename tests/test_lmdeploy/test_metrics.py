@@ -0,0 +1,31 @@
+from lmdeploy.metrics import Counter, Gauge, Histogram, render_metrics
+
+
+def test_histogram():
+    hist = Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        hist.observe(value)
+    assert hist.counts == [2, 1, 1]
+    assert hist.count == 4
+    lines = hist.render().splitlines()
+    assert lines == [
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        'latency_seconds_sum 2.65',
+        'latency_seconds_count 4',
+    ]
+
+
+def test_render_metrics():
+    counter = Counter('requests_total', 'Requests.')
+    counter.inc()
+    counter.inc(2)
+    gauge = Gauge('usage', 'Usage.')
+    gauge.set(0.5)
+    text = render_metrics([counter, gauge])
+    assert text.endswith('\n')
+    assert 'requests_total 3\n' in text
+    assert '# TYPE usage gauge\nusage 0.5\n' in text
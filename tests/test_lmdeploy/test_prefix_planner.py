@@ -0,0 +1,22 @@
+from lmdeploy.serve.prefix_planner import plan_prefix_groups
+
+
+def test_plan_prefix_groups():
+    input_ids = [
+        [1, 2, 3, 4, 5],
+        [7, 8],
+        [1, 2, 3, 5],
+        [9],
+        [1, 2, 3, 4, 6, 6],
+        [7, 8, 1, 2],
+    ]
+    groups = plan_prefix_groups(input_ids, block_size=2)
+    # the prompts sharing longer prefixes are adjacent in a group
+    assert groups == [[0, 4, 2], [1, 5], [3]]
+    assert sorted(sum(groups, [])) == list(range(len(input_ids)))
+
+
+def test_plan_prefix_groups_no_shared():
+    input_ids = [[3, 4], [1, 2], [5]]
+    groups = plan_prefix_groups(input_ids, block_size=4)
+    assert groups == [[0], [1], [2]]
@@ -0,0 +1,143 @@
+import asyncio
+
+import httpx
+import pytest
+
+from lmdeploy.serve.proxy.proxy import NodeManager, Status, get_prompt_prefix
+
+
+class TestPrefixAffinity:
+
+    @pytest.fixture
+    def model_name(self):
+        yield 'internlm2'
+
+    @pytest.fixture
+    def node_manager(self, tmp_path, model_name):
+        manager = NodeManager(config_path=str(tmp_path / 'proxy.yml'),
+                              strategy='prefix_affinity',
+                              prefix_affinity_len=32)
+        for port in range(23333, 23337):
+            manager.nodes[f'http://0.0.0.0:{port}'] = Status(
+                models=[model_name])
+        yield manager
+
+    def test_prompt_prefix(self):
+        assert get_prompt_prefix(None) is None
+        assert get_prompt_prefix('abcdef', 3) == 'abc'
+        messages = [
+            dict(role='system', content='you are a robot.'),
+            dict(role='user',
+                 content=[
+                     dict(type='text', text='describe'),
+                     dict(type='image_url', image_url=dict(url='a.png'))
+                 ])
+        ]
+        prefix = get_prompt_prefix(messages, 64)
+        assert prefix == 'system: you are a robot.\nuser: describe\n'
+        assert get_prompt_prefix(messages, 8) == 'system: '
+
+    def test_affinity(self, node_manager, model_name):
+        system = 'a long shared system prompt ' * 4
+        prompts = [system + f'question {i}' for i in range(8)]
+        urls = set(
+            node_manager.get_node_url(model_name, prompt)
+            for prompt in prompts)
+        assert len(urls) == 1
+
+        # stable after adding a node serving another model
+        url = urls.pop()
+        node_manager.nodes['http://0.0.0.0:8000'] = Status(models=['other'])
+        assert node_manager.get_node_url(model_name, prompts[0]) == url
+        assert node_manager.get_node_url('not exist', prompts[0]) is None
+
+        # different prefixes spread over nodes
+        urls = set(
+            node_manager.get_node_url(model_name, f'{i} ' + system)
+            for i in range(64))
+        assert len(urls) > 1
+
+    def test_spillover(self, node_manager, model_name):
+        prompt = 'shared prefix ' * 4
+        url = node_manager.get_node_url(model_name, prompt)
+        node_manager.nodes[url].unfinished = 8
+        spill_url = node_manager.get_node_url(model_name, prompt)
+        assert spill_url != url
+        assert spill_url == node_manager.get_node_url(model_name, prompt)
+
+        node_manager.nodes[url].unfinished = 0
+        assert node_manager.get_node_url(model_name, prompt) == url
+
+
+class TestForward:
+
+    @pytest.fixture
+    def node_url(self):
+        yield 'http://0.0.0.0:23333'
+
+    @pytest.fixture
+    def events(self):
+        yield [
+            b'data: {"id": 0}\n\n', b'data: {"id": 1}\n\n', b'data: [DONE]\n\n'
+        ]
+
+    @pytest.fixture
+    def node_manager(self, tmp_path, node_url, events):
+
+        async def _aiter_events():
+            for event in events:
+                yield event
+
+        def _handler(request: httpx.Request):
+            if request.url.path == '/v1/chat/completions':
+                return httpx.Response(200, content=_aiter_events())
+            raise httpx.ConnectError('refused', request=request)
+
+        manager = NodeManager(config_path=str(tmp_path / 'proxy.yml'))
+        manager.nodes[node_url] = Status(models=['internlm2'])
+        manager.clients[node_url] = httpx.AsyncClient(
+            base_url=node_url, transport=httpx.MockTransport(_handler))
+        yield manager
+
+    def test_stream(self, node_manager, node_url, events):
+
+        async def _gather(path):
+            outputs = []
+            async for chunk in node_manager.stream_generate(
+                    dict(stream=True), node_url, path):
+                outputs.append(chunk)
+            return outputs
+
+        outputs = asyncio.run(_gather('/v1/chat/completions'))
+        assert b''.join(outputs) == b''.join(events)
+        outputs = asyncio.run(_gather('/v1/completions'))
+        assert outputs == [node_manager.handle_api_timeout(node_url)]
+
+    def test_client_pool(self, tmp_path, node_url):
+        manager = NodeManager(config_path=str(tmp_path / 'proxy.yml'))
+        manager.nodes[node_url] = Status(models=['internlm2'])
+        client = manager.get_client(node_url)
+        assert manager.get_client(node_url) is client
+        manager.remove(node_url)
+        assert node_url not in manager.clients
+        asyncio.run(manager.close())
+        assert client.is_closed
+
+    def test_remove_streaming_node(self, node_manager, node_url, events):
+        client = node_manager.clients[node_url]
+
+        async def _remove_in_stream():
+            outputs = []
+            async for chunk in node_manager.stream_generate(
+                    dict(stream=True), node_url, '/v1/chat/completions'):
+                if len(outputs) == 0:
+                    node_manager.remove(node_url)
+                # the in-flight stream keeps the client open
+                assert not client.is_closed
+                outputs.append(chunk)
+            await asyncio.sleep(0)
+            assert client.is_closed
+            return outputs
+
+        outputs = asyncio.run(_remove_in_stream())
+        assert b''.join(outputs) == b''.join(events)
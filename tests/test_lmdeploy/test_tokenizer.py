@@ -2,7 +2,8 @@ import random
 
 import pytest
 
-from lmdeploy.tokenizer import DetokenizeState, HuggingFaceTokenizer
+from lmdeploy.tokenizer import (DetokenizeState, HuggingFaceTokenizer,
+                                Tokenizer, VocabIndex)
 
 
 @pytest.mark.parametrize('model_path', [
@@ -86,3 +87,59 @@ def test_glm4_special_token():
 def test_check_transformers_version(model_path):
     tokenizer = HuggingFaceTokenizer(model_path)
     assert tokenizer is not None
+
+
+@pytest.mark.parametrize('model_path', [
+    'internlm/internlm2-chat-7b', 'Qwen/Qwen2-7B-Instruct',
+    'codellama/CodeLlama-7b-hf', 'meta-llama/Meta-Llama-3-8B-Instruct'
+])
+@pytest.mark.parametrize('input',
+                         [' hi, this is a test 😆😆! 為什麼我還在用繁體字 😆😆       ' * 5])
+@pytest.mark.parametrize('skip_special_tokens', [True, False])
+def test_token_bytes_table(model_path, input, skip_special_tokens):
+    tokenizer = HuggingFaceTokenizer(model_path)
+    table = tokenizer.token_bytes_table
+    assert table is not None
+    encoded = tokenizer.encode(input, add_special_tokens=True)
+    expected = tokenizer.decode(encoded,
+                                skip_special_tokens=skip_special_tokens)
+    output = ''
+    state = DetokenizeState()
+    for i in range(len(encoded)):
+        decoded, state = table.detokenize_incrementally(
+            encoded[:i + 1], state, skip_special_tokens)
+        output += decoded
+    assert output == expected
+
+
+@pytest.mark.parametrize('sub', ['a', 'ab', 'c', '.', 'x'])
+def test_vocab_index(sub):
+    token_strs = ['a', 'ab', 'bc', '', 'c.', 'cab']
+    index = VocabIndex(token_strs)
+    expected = [i for i, tok in enumerate(token_strs) if sub in tok]
+    assert index.find(sub) == expected
+
+
+@pytest.mark.parametrize('model_path', [
+    'internlm/internlm2-chat-7b', 'Qwen/Qwen2-7B-Instruct',
+    'meta-llama/Meta-Llama-3-8B-Instruct'
+])
+@pytest.mark.parametrize('add_bos', [True, False])
+def test_tokenize_service(model_path, add_bos):
+    import asyncio
+
+    from lmdeploy.model import MODELS, best_match_model
+    from lmdeploy.serve.tokenize_service import TokenizeService
+    tokenizer = Tokenizer(model_path)
+    chat_template = MODELS.get(best_match_model(model_path))()
+    service = TokenizeService(tokenizer)
+    prompts = [
+        chat_template.messages2prompt([
+            dict(role='system', content='You are a helpful assistant.'),
+            dict(role='user', content=f'hi, this is test {i} 😆😆!')
+        ]) for i in range(4)
+    ]
+    expected = [tokenizer.encode(p, add_bos=add_bos) for p in prompts]
+    for _ in range(2):
+        outputs = asyncio.run(service.encode_batch(prompts, add_bos))
+        assert outputs == expected
@@ -35,3 +35,67 @@ def test_load_invalid_base64():
     im = load_image(base64)
     assert im.width == 32
     assert im.height == 32
+
+
+def test_image_feature_cache(tmp_path):
+    import torch
+    from PIL import Image
+
+    from lmdeploy.vl.feature_cache import ImageFeatureCache, digest_image
+    feature_size = 1 << 19
+    cache = ImageFeatureCache(1,
+                              cache_dir=str(tmp_path),
+                              max_disk_size=1,
+                              namespace='test')
+    images = [Image.new('RGB', (32, 32), (i, i, i)) for i in range(3)]
+    keys = [digest_image(im) for im in images]
+    assert len(set(keys)) == 3
+    assert digest_image(images[0]) == keys[0]
+    assert digest_image(images[0], dict(max_dynamic_patch=1)) != keys[0]
+    for i, key in enumerate(keys):
+        assert cache.get(key) is None
+        cache.put(key, torch.full((feature_size // 4, ), float(i)))
+
+    # the latest two features are kept in memory, the first one is spilled
+    # to disk
+    assert cache.get(keys[2])[0].item() == 2
+    assert cache.get(keys[0])[0].item() == 0
+    assert cache.metrics.num_hits == 1
+    assert cache.metrics.num_disk_hits == 1
+    assert cache.metrics.num_misses == 3
+
+
+def test_decode_image_draft():
+    from io import BytesIO
+
+    from PIL import Image
+
+    from lmdeploy.vl.utils import decode_image
+    buffered = BytesIO()
+    Image.new('RGB', (1024, 512)).save(buffered, format='JPEG')
+    im = decode_image(buffered.getvalue(), draft_size=(64, 64))
+    assert im.size == (128, 64)
+    im = decode_image(buffered.getvalue())
+    assert im.size == (1024, 512)
+
+
+def test_vision_batch_bucket():
+    import asyncio
+
+    from PIL import Image
+
+    from lmdeploy.vl.engine import Record
+    record = Record(thread_safe=False)
+    sizes = [(448, 448), (1344, 1344), (448, 448), (512, 448)]
+    images = [Image.new('RGB', size) for size in sizes]
+    que = asyncio.Queue()
+    record.enqueue(images, [{}] * len(images), que)
+    items = record.dequeue(4)
+    assert [item.index for item in items] == [0, 2, 3]
+    record.done(items, [0, 2, 3])
+    assert que.empty()
+    items = record.dequeue(4)
+    assert [item.index for item in items] == [1]
+    record.done(items, [1])
+    assert que.get_nowait() == [0, 1, 2, 3]
+    assert record.total == 0